@@ -1,12 +1,52 @@
+import os
+import re
+import time
 import asyncio
+from datetime import datetime
 from collections import deque
 
 from loguru import logger
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from autorecord.core.settings import config
-from autorecord.core.utils import load_rooms
-from autorecord.core.managers import Recorder, AudioMapper, Uploader, Publisher, Cleaner
+from autorecord.core.utils import load_rooms, ROOM_CATALOG
+from autorecord.core.pipeline import Pipeline, Job
+from autorecord.core.journal import UPLOAD_JOURNAL, UPLOADED_FILES
+from autorecord.core.sharding import SHARD
+from autorecord.core.bandwidth import UPLOAD_BANDWIDTH
+from autorecord.core.tracing import TRACER
+from autorecord.core.schedule import SCHEDULE, SCHEDULE_START
+from autorecord.core.storage import (
+    STORAGE,
+    STORAGE_POLICY_EVICT,
+    STORAGE_POLICY_PAUSE_REMUX,
+    STORAGE_POLICY_DEGRADE,
+    VIDEO_FILE_RE,
+)
+from autorecord.core.metrics import (
+    start_metrics_server,
+    register_collector,
+    QUEUE_DEPTH,
+    STREAM_UPTIME,
+    STORAGE_FORECAST_BYTES,
+)
+from autorecord.core.managers import (
+    Recorder,
+    AudioMapper,
+    Analyzer,
+    Previewer,
+    Compositor,
+    Uploader,
+    Publisher,
+    Cleaner,
+    RECORD_MODE_MUXED,
+    COMPOSITE_OFF,
+)
+
+# Имя файла с результатом записи: {дата и время}_{id комнаты}_{id источника}.mp4
+RESULT_FILE_RE = re.compile(
+    r"^(?P<record_dt>\d{4}-\d{2}-\d{2}T\d{2}:\d{2})_(?P<room_id>[^_]+)_(?P<source_id>[^_.]+)\.mp4$"
+)
 
 
 class Autorecord:
@@ -16,21 +56,110 @@ class Autorecord:
         self._recorders = deque()
         self._loop = loop
 
+        # Этапы обработки записей: анализ → наложение звука → превью →
+        # загрузка → публикация → очистка.
+        # Превью только кодируются, загружаются они вместе с записью, чтобы
+        # воркеры кодирования не ждали сеть
+        self._pipeline = Pipeline()
+        if config.analysis_enabled:
+            self._pipeline.add_stage(
+                "analyze",
+                self.analyze_stage,
+                config.analysis_workers,
+                config.pipeline_queue_size,
+            )
+        self._pipeline.add_stage(
+            "map", self.map_stage, config.map_workers, config.pipeline_queue_size
+        )
+        if config.preview_enabled:
+            self._pipeline.add_stage(
+                "preview",
+                self.preview_stage,
+                config.preview_workers,
+                config.pipeline_queue_size,
+            )
+        # Сколько загрузок идёт на самом деле, решает UPLOAD_LIMITER,
+        # воркеров хватает на его верхнюю границу
+        self._pipeline.add_stage(
+            "upload",
+            self.upload_stage,
+            config.google_semaphore,
+            config.pipeline_queue_size,
+        )
+        # Этап, с которого продолжают записи со звуком, которым сведение не нужно
+        self._mapped_stage = "preview" if config.preview_enabled else "upload"
+        self._pipeline.add_stage(
+            "publish", self.publish_stage, config.publish_workers, config.pipeline_queue_size
+        )
+        self._pipeline.add_stage(
+            "clean", self.clean_stage, config.clean_workers, config.pipeline_queue_size
+        )
+        self._pipeline.start(loop)
+
+        # Загрузки на диск получают только ту часть канала, что не занята камерами
+        UPLOAD_BANDWIDTH.set_ingest_probe(self.ingest_rate)
+
+        if config.metrics_port:
+            register_collector(self.collect_metrics)
+            loop.create_task(
+                start_metrics_server(config.metrics_host, config.metrics_port)
+            )
+
         self._scheduler = AsyncIOScheduler()
+        if config.schedule_enabled:
+            # Записи идут по расписанию занятий комнат, а не общими слотами
+            self._schedule_changed = asyncio.Event()
+            self._schedule_changed.set()
+            loop.create_task(self.run_schedule())
+        else:
+            self._scheduler.add_job(
+                func=self.restart_records,
+                name="records",
+                trigger="cron",
+                day_of_week=",".join(config.record_days),
+                hour=f"{config.record_start}-{config.record_end-1}",
+                minute=f"*/{config.record_duration}",
+            )
+            self._scheduler.add_job(
+                func=self.stop_records,
+                name="records_stop",
+                trigger="cron",
+                day_of_week=",".join(config.record_days),
+                hour=config.record_end,
+            )
+        self._scheduler.add_job(
+            func=self.refresh_rooms,
+            name="rooms_refresh",
+            trigger="interval",
+            seconds=config.rooms_refresh_interval,
+            next_run_time=datetime.now(),
+        )
+        if config.shard_enabled:
+            self._scheduler.add_job(
+                func=self.shard_heartbeat,
+                name="shard_heartbeat",
+                trigger="interval",
+                seconds=config.shard_heartbeat_interval,
+                next_run_time=datetime.now(),
+            )
         self._scheduler.add_job(
-            func=self.restart_records,
-            name="records",
-            trigger="cron",
-            day_of_week=",".join(config.record_days),
-            hour=f"{config.record_start}-{config.record_end-1}",
-            minute=f"*/{config.record_duration}",
+            func=self.check_storage,
+            name="storage_check",
+            trigger="interval",
+            seconds=config.storage_check_interval,
         )
+        if TRACER.enabled:
+            self._scheduler.add_job(
+                func=TRACER.flush,
+                name="traces_flush",
+                trigger="interval",
+                seconds=config.tracing_flush_interval,
+            )
         self._scheduler.add_job(
-            func=self.stop_records,
-            name="records_stop",
-            trigger="cron",
-            day_of_week=",".join(config.record_days),
-            hour=config.record_end,
+            func=self.recover_records,
+            name="records_recover",
+            trigger="date",
+            run_date=datetime.now(),
         )
         self._scheduler.start()
 
@@ -38,58 +167,549 @@ class Autorecord:
             f"Created scheduler tasks: {[str(job) for job in self._scheduler.get_jobs()]}"
         )
 
+    def collect_metrics(self):
+        for stage_name, depth in self._pipeline.queue_depth.items():
+            QUEUE_DEPTH.labels(stage_name).set(depth)
+
+        # Показываем только потоки, которые пишутся сейчас
+        STREAM_UPTIME.clear()
+        for recorder in self._recorders:
+            for stream in recorder.streams:
+                STREAM_UPTIME.labels(stream.key).set(stream.uptime_ratio)
+
+    def ingest_rate(self) -> float:
+        """Сколько байт в секунду сейчас пишется со всех камер"""
+        return sum(
+            STORAGE.stream_rate(key)
+            for recorder in self._recorders
+            for key in recorder.stream_keys
+        )
+
+    async def refresh_rooms(self):
+        """Фоновое обновление кэша комнат, чтобы старт записи не ждал бд"""
+        try:
+            await ROOM_CATALOG.refresh()
+        except Exception as err:
+            logger.warning(f"Failed to refresh rooms: {err}")
+            return
+
+        if config.schedule_enabled:
+            self._schedule_changed.set()
+
+    async def shard_heartbeat(self):
+        """Отметить узел живым и обновить распределение комнат между узлами"""
+        try:
+            await SHARD.heartbeat()
+        except Exception as err:
+            logger.warning(f"Failed to send shard heartbeat: {err}")
+
+    async def run_schedule(self):
+        """Запускать и останавливать записи комнат по расписанию их занятий"""
+        while True:
+            if self._schedule_changed.is_set():
+                self._schedule_changed.clear()
+                try:
+                    rooms = [room async for room in load_rooms() if room.sources]
+                    SCHEDULE.rebuild(rooms, Recorder.current_time())
+                except Exception as err:
+                    logger.error(f"Failed to rebuild schedule: {err}")
+
+            # Спим до ближайшего события или до обновления расписания
+            timeout = config.rooms_refresh_interval
+            if SCHEDULE.next_event_at is not None:
+                timeout = (SCHEDULE.next_event_at - Recorder.current_time()).total_seconds()
+            try:
+                await asyncio.wait_for(self._schedule_changed.wait(), max(timeout, 0))
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            stopped, started = deque(), []
+            for action, session in SCHEDULE.pop_due(Recorder.current_time()):
+                if action == SCHEDULE_START:
+                    # Если сервис запустился посреди занятия – пишем его остаток
+                    record_dt = max(session.start, Recorder.current_record_dt())
+                    session.recorder = Recorder(
+                        session.room, record_dt, session.end - record_dt
+                    )
+                    started.append(session.recorder)
+                elif session.recorder in started:
+                    # Сессия закончилась, не успев начаться
+                    started.remove(session.recorder)
+                elif session.recorder in self._recorders:
+                    self._recorders.remove(session.recorder)
+                    stopped.append(session.recorder)
+
+            if stopped:
+                self.stop_records(stopped)
+            if started:
+                try:
+                    await self.start_records(started)
+                except Exception as err:
+                    logger.error(f"Failed to start scheduled records: {err}")
+
     async def restart_records(self):
-        self.stop_records()
-        await self.start_records()
+        if not config.gapless_rotation:
+            self.stop_records()
+            await self.start_records()
+            return
+
+        # Сначала запускаем записи нового слота и, пока они подключаются к камерам,
+        # продолжаем писать старый слот, чтобы на границе не терялось ни секунды
+        previous_recorders = self._recorders
+        self._recorders = deque()
+        try:
+            await self.start_records()
+            await asyncio.sleep(config.rotation_overlap)
+        finally:
+            # Даже если новый слот не стартовал, старый нужно остановить и обработать
+            self.stop_records(previous_recorders)
+
+    def stop_records(self, recorders: deque = None):
+        """
+        Остановить записи и отправить их на обработку
 
-    def stop_records(self):
+        :param recorders: какие записи остановить, по умолчанию – все текущие
+        """
         logger.info("Stopping recording")
-        while self._recorders:
-            recorder = self._recorders.pop()
-            self._loop.create_task(recorder.stop_record())
-            self._loop.create_task(self.process_records(recorder))
+        if recorders is None:
+            recorders = self._recorders
 
-    async def start_records(self):
+        while recorders:
+            recorder = recorders.pop()
+            self._loop.create_task(self.finish_record(recorder))
+
+    async def start_records(self, recorders: list = None):
+        """
+        Начать записи
+
+        :param recorders: какие записи начать, по умолчанию – все комнаты узла на текущий слот
+        """
         logger.info("Starting recording")
-        async for room in load_rooms():
-            if not room.sources:
-                continue
+        if recorders is None:
+            # Одно время начала на весь слот, чтобы все комнаты стартовали одновременно
+            record_dt = Recorder.current_record_dt()
+            load_started_ns = time.time_ns()
+            recorders = [
+                Recorder(room, record_dt) async for room in load_rooms() if room.sources
+            ]
+            for recorder in recorders:
+                TRACER.start_span(
+                    "db.load_rooms",
+                    recorder.trace_keys(),
+                    start_ns=load_started_ns,
+                    rooms=len(recorders),
+                ).end()
+        await self.admit_records(recorders)
+        self._recorders.extend(recorders)
+
+        await asyncio.gather(*[recorder.start_record() for recorder in recorders])
+
+        skews = [r.start_skew for r in recorders if r.start_skew is not None]
+        if skews:
+            logger.info(
+                f"Started {len(recorders)} recorders, "
+                f"start skew max {max(skews):.3f}s, avg {sum(skews) / len(skews):.3f}s"
+            )
+
+    async def admit_records(self, recorders: list):
+        """
+        Проверить, что записи слота поместятся на диск.
+        Если нет – применять политики storage_policies по порядку, пока не поместятся
+        """
+        free = await self._loop.run_in_executor(None, STORAGE.free_bytes)
+        pending = await self._loop.run_in_executor(None, STORAGE.pending_remux_bytes)
+
+        def storage_needed():
+            remux = not self._pipeline.is_paused("map")
+            needed = sum(
+                STORAGE.forecast([r], r.duration.total_seconds(), remux)
+                for r in recorders
+            )
+            return needed + pending if remux else needed
+
+        for policy in config.storage_policies:
+            if storage_needed() <= free:
+                break
+
+            if policy == STORAGE_POLICY_EVICT:
+                free += await self._loop.run_in_executor(
+                    None, STORAGE.evict, storage_needed() - free
+                )
+
+            elif policy == STORAGE_POLICY_PAUSE_REMUX:
+                if config.record_mode != RECORD_MODE_MUXED:
+                    self._pipeline.pause("map")
+
+            elif policy == STORAGE_POLICY_DEGRADE:
+                # Сначала урезаем комнаты, где камер больше всего
+                for recorder in sorted(recorders, key=lambda r: -len(r.sources)):
+                    if storage_needed() <= free:
+                        break
+                    if len(recorder.sources) <= config.storage_degrade_sources:
+                        continue
 
-            recorder = Recorder(room)
-            self._recorders.append(recorder)
-            self._loop.create_task(recorder.start_record())
+                    logger.warning(
+                        f"Not enough disk space, recording {recorder.room.name} "
+                        f"with {config.storage_degrade_sources} of "
+                        f"{len(recorder.sources)} sources"
+                    )
+                    recorder.sources = recorder.sources[: config.storage_degrade_sources]
+
+        needed = storage_needed()
+        STORAGE_FORECAST_BYTES.set(needed)
+        if needed > free:
+            logger.warning(
+                f"Records of the slot need {needed} bytes, only {free} bytes are free"
+            )
+
+    async def check_storage(self):
+        """
+        Обновить битрейты потоков и, если до конца слота место закончится,
+        освободить его или приостановить наложение звука
+        """
+        STORAGE.observe(self._recorders)
+
+        now = Recorder.current_time()
+        free = await self._loop.run_in_executor(None, STORAGE.free_bytes)
+        pending = await self._loop.run_in_executor(None, STORAGE.pending_remux_bytes)
+        # Пока наложение звука стоит, идущие записи сводить не будут, поэтому для
+        # возобновления достаточно места на их сырые файлы и сведение накопленного
+        remux = not self._pipeline.is_paused("map")
+        needed = pending + sum(
+            STORAGE.forecast([r], max((r.end_dt - now).total_seconds(), 0), remux)
+            for r in self._recorders
+        )
+        STORAGE_FORECAST_BYTES.set(needed)
+
+        # Наложение звука останавливаем только ради идущих записей
+        if needed <= free or not self._recorders:
+            if self._pipeline.is_paused("map"):
+                self._pipeline.resume("map")
+            return
+
+        if STORAGE_POLICY_EVICT in config.storage_policies:
+            free += await self._loop.run_in_executor(
+                None, STORAGE.evict, needed - free
+            )
+
+        if needed > free and STORAGE_POLICY_PAUSE_REMUX in config.storage_policies:
+            self._pipeline.pause("map")
+
+    async def finish_record(self, recorder):
+        """Остановить запись и, когда процессы завершатся, обработать её"""
+        await recorder.stop_record()
+        await self.process_records(recorder)
 
     async def process_records(self, recorder):
         """Обработка записей"""
+        if config.record_mode == RECORD_MODE_MUXED:
+            # Итоговые файлы уже записаны вместе со звуком, сводить нечего
+            sources = [
+                source
+                for source in recorder.sources
+                if Cleaner.is_result_exist(recorder, source)
+            ]
+            stage_name = "analyze" if config.analysis_enabled else self._mapped_stage
+            await self.process_sources(recorder, sources, stage_name)
+            return
+
         if not Cleaner.is_sound_exist(recorder) and not config.upload_without_sound:
             # Если нет звука для рекордера или не выставлен флаг загрузки видео без звука – удаляем все видео рекордера
-            for source in recorder.room.sources:
+            for source in recorder.sources:
                 await self._loop.run_in_executor(
                     None, Cleaner.clear_video, recorder, source
                 )
             return
 
-        # Создаём папки для загрузки видео
-        folder_id = await Uploader.prepare_folders(recorder)
-        await asyncio.gather(
-            *[
-                self.process_source(recorder, source, folder_id)
-                for source in recorder.room.sources
-            ]
+        sources = [
+            source
+            for source in recorder.sources
+            if Cleaner.is_video_exist(recorder, source)
+        ]
+        stage_name = "analyze" if config.analysis_enabled else "map"
+        await self.process_sources(recorder, sources, stage_name)
+
+    async def process_sources(self, recorder, sources: list, stage_name: str):
+        """
+        Отправить источники записи в конвейер обработки и дождаться результата
+
+        :param recorder: запись
+        :param sources: какие источники обрабатывать
+        :param stage_name: с какого этапа конвейера начинать
+        """
+        if not sources:
+            await self._loop.run_in_executor(None, Cleaner.clear_sound, recorder)
+            return
+
+        started_at = self._loop.time()
+
+        jobs = []
+        for source in sources:
+            # Папку записи создаёт этап загрузки, чтобы у пустых записей её не было
+            job = Job(recorder, source)
+            # Файл уже загружен по ходу записи – этап загрузки его пропустит
+            job.file_id = recorder.file_ids.get(source.id)
+            jobs.append(await self._pipeline.submit(job, stage_name))
+        results = await asyncio.gather(*[job.done for job in jobs])
+        if config.composite_mode != COMPOSITE_OFF:
+            results.append(await self.composite_record(recorder, jobs))
+
+        # Если что-то не обработалось – оставляем звук, чтобы можно было повторить
+        if all(results):
+            await self._loop.run_in_executor(None, Cleaner.clear_sound, recorder)
+
+        elapsed = self._loop.time() - started_at
+        if elapsed > recorder.duration.total_seconds():
+            logger.warning(
+                f"Processing {recorder.record_name} took {elapsed:.0f}s, "
+                "longer than a record slot"
+            )
+
+    async def recover_records(self):
+        """
+        Дообработать результаты записей, оставшиеся на диске после прошлого запуска.
+        Начатые загрузки продолжаются с последнего подтверждённого гуглом байта
+        """
+        # Файлы лежат на диске этого узла, поэтому ищем среди всех комнат,
+        # а не только среди тех, что сейчас за ним закреплены
+        active_paths = {
+            path
+            for recorder in self._recorders
+            for stream in recorder.streams
+            for path in stream.pieces
+        }
+        await self._loop.run_in_executor(None, STORAGE.reconcile, active_paths)
+
+        rooms = {str(room.id): room for room in await ROOM_CATALOG.get_rooms()}
+        active = {recorder.record_name for recorder in self._recorders}
+        uploaded = set(UPLOADED_FILES.oldest())
+        recorders = {}
+
+        for file_name in sorted(os.listdir(config.records_folder)):
+            if f"{config.records_folder}/{file_name}" in uploaded:
+                continue
+
+            # Исходное видео без результата – запись оборвалась до наложения звука
+            match = RESULT_FILE_RE.match(file_name) or VIDEO_FILE_RE.match(file_name)
+            if not match:
+                continue
+
+            room = rooms.get(match["room_id"])
+            if room is None:
+                logger.warning(f"Unknown room for record {file_name}, skipping")
+                continue
+
+            source = next(
+                (s for s in room.sources if str(s.id) == match["source_id"]), None
+            )
+            if source is None:
+                logger.warning(f"Unknown source for record {file_name}, skipping")
+                continue
+
+            record_name = f"{match['record_dt']}_{match['room_id']}"
+            if record_name in active:
+                continue
+
+            if record_name not in recorders:
+                record_dt = datetime.fromisoformat(match["record_dt"])
+                recorders[record_name] = (Recorder(room, record_dt), [])
+            if source not in recorders[record_name][1]:
+                recorders[record_name][1].append(source)
+
+        for recorder, sources in recorders.values():
+            logger.info(f"Recovering {len(sources)} records of {recorder.record_name}")
+            self._loop.create_task(self.recover_record(recorder, sources))
+
+    async def recover_record(self, recorder, sources):
+        """Дообработать оставшиеся на диске источники одной записи"""
+        entries = {
+            source.id: UPLOAD_JOURNAL.get(Uploader.file_path(recorder, source))
+            for source in sources
+        }
+        folder_ids = [entry["parent_id"] for entry in entries.values() if entry]
+        folder_id = folder_ids[0] if folder_ids else None
+
+        jobs = []
+        for source in sources:
+            # Если загрузка не начиналась, а исходное видео на месте –
+            # наложение звука могло не завершиться, делаем его заново
+            if entries[source.id] is None and Cleaner.is_video_exist(recorder, source):
+                stage_name = "map"
+            else:
+                stage_name = self._mapped_stage
+            jobs.append(
+                await self._pipeline.submit(Job(recorder, source, folder_id), stage_name)
+            )
+
+        results = await asyncio.gather(*[job.done for job in jobs])
+        if config.composite_mode != COMPOSITE_OFF:
+            results.append(await self.composite_record(recorder, jobs))
+        if all(results):
+            await self._loop.run_in_executor(None, Cleaner.clear_sound, recorder)
+
+    async def composite_record(self, recorder, jobs: list) -> bool:
+        """
+        Собрать, загрузить и опубликовать общую картинку всех камер комнаты,
+        когда источники записи обработаны, затем удалить их итоговые файлы
+
+        :return: удалось ли
+        """
+        sources = [
+            job.source
+            for job in jobs
+            if job.source.id not in recorder.empty_sources
+            and Cleaner.is_result_exist(recorder, job.source)
+        ]
+        success = True
+        try:
+            if sources:
+                if await Compositor.compose(recorder, sources) is None:
+                    success = False
+                else:
+                    folder_id = await Uploader.record_folder(recorder)
+                    file_id = await Uploader.upload_composite(recorder, folder_id)
+                    # Главная камера раскладки – первая
+                    await Publisher.send_to_erudite(recorder, sources[0], file_id)
+        except Exception:
+            logger.exception(f"Failed to publish composite of {recorder.record_name}")
+            success = False
+        finally:
+            await self._loop.run_in_executor(None, Cleaner.clear_composite, recorder)
+
+        if not success and config.composite_only:
+            # Записи камер нигде больше не опубликованы – оставляем их
+            # на диске, чтобы собрать общую картинку заново после перезапуска
+            logger.warning(f"Keeping records of {recorder.record_name} to retry")
+            return False
+
+        for job in jobs:
+            # Не загруженный или не опубликованный источник оставляем на диске,
+            # чтобы его можно было дообработать после перезапуска
+            if job.done.result():
+                await self.release_result(job)
+        return success
+
+    async def release_result(self, job: Job):
+        """Удалить итоговый файл источника или оставить загруженный до нехватки места"""
+        if config.keep_uploaded_files and job.file_id:
+            # Загруженный файл удалится, когда понадобится место
+            UPLOADED_FILES.add(Uploader.file_path(job.recorder, job.source))
+            return
+
+        await self._loop.run_in_executor(
+            None, Cleaner.clear_result, job.recorder, job.source
         )
-        await self._loop.run_in_executor(None, Cleaner.clear_sound, recorder)
 
-    async def process_source(self, recorder, source, folder_id):
-        """Обработка источника"""
-        if not Cleaner.is_video_exist(recorder, source):
+    async def analyze_stage(self, job: Job):
+        if await Analyzer.is_empty(job.recorder, job.source):
+            # Пустую запись не сводим, не загружаем и не публикуем, только удаляем
+            job.jump_to = "clean"
+        elif config.record_mode == RECORD_MODE_MUXED:
+            # Сводить нечего. Файл, загруженный по ходу записи, этап загрузки пропустит
+            job.jump_to = self._mapped_stage
+
+    async def map_stage(self, job: Job):
+        recorder = job.recorder
+        if config.shared_audio_map:
+            if recorder.map_task is None:
+                # Общий процесс занимает воркер той задачи, что его запустила
+                recorder.map_task = asyncio.ensure_future(
+                    AudioMapper.map_room(recorder)
+                )
+                await asyncio.gather(
+                    asyncio.shield(recorder.map_task), return_exceptions=True
+                )
+            elif not recorder.map_task.done():
+                # Остальные источники ждут его вне воркера и возвращаются на этот этап
+                job.wait_for = recorder.map_task
+                job.jump_to = "map"
+                return
+
+            if AudioMapper.room_mapped(recorder):
+                return
+
+        await AudioMapper.map_video_and_sound(recorder, job.source)
+
+    async def upload_stage(self, job: Job):
+        if config.composite_only:
+            # Публикуется только общая картинка комнаты, её собирают из итоговых файлов
+            job.jump_to = "clean"
+            return
+
+        try:
+            if job.folder_id is None:
+                # Папку могла уже создать загрузка по ходу записи
+                job.folder_id = await Uploader.record_folder(job.recorder)
+            if job.file_id is None:
+                job.file_id = await Uploader.upload(
+                    job.recorder, job.source, job.folder_id
+                )
+            await self.upload_previews(job)
+        finally:
+            if job.preview_kinds:
+                await self._loop.run_in_executor(
+                    None, Cleaner.clear_previews, job.recorder, job.source
+                )
+
+    async def upload_previews(self, job: Job):
+        """Превью не обязательны: если не загрузились, запись публикуется без них"""
+        for kind in job.preview_kinds:
+            try:
+                job.previews[kind] = await Uploader.upload_preview(
+                    job.recorder, job.source, kind, job.folder_id
+                )
+            except Exception as err:
+                logger.warning(f"Failed to upload {kind} of {job}: {err}")
+
+    async def preview_stage(self, job: Job):
+        """
+        Прокси и лист миниатюр не обязательны: если не вышло, запись
+        всё равно публикуется, просто без них. Здесь они только кодируются,
+        загружает их этап загрузки
+        """
+        if config.composite_only:
+            # Отдельные записи не публикуются, превью им не нужны
             return
 
-        await AudioMapper.map_video_and_sound(recorder, source)
-        file_id = await Uploader.upload(recorder, source, folder_id)
-        await Publisher.send_to_erudite(recorder, source, file_id)
+        try:
+            previews = await Previewer.make_previews(job.recorder, job.source)
+            job.preview_kinds = list(previews)
+        except Exception as err:
+            logger.warning(f"Failed to make previews of {job}: {err}")
+            await self._loop.run_in_executor(
+                None, Cleaner.clear_previews, job.recorder, job.source
+            )
+
+    async def publish_stage(self, job: Job):
+        await Publisher.send_to_erudite(
+            job.recorder, job.source, job.file_id, job.previews
+        )
+
+    async def clean_stage(self, job: Job):
+        if job.file_id and job.source.id in job.recorder.empty_sources:
+            # Пустая запись успела загрузиться по ходу записи – убираем её с диска,
+            # иначе она так и останется в папке неопубликованной
+            try:
+                await Uploader.delete(job.file_id)
+                job.file_id = None
+            except Exception as err:
+                logger.warning(f"Failed to delete uploaded empty record {job}: {err}")
+
+        if job.recorder.map_task is not None:
+            # Общее наложение звука могло захватить и пропущенный пустой источник
+            await asyncio.gather(
+                asyncio.shield(job.recorder.map_task), return_exceptions=True
+            )
+
+        await self._loop.run_in_executor(
+            None, Cleaner.clear_video, job.recorder, job.source
+        )
+        if config.composite_mode != COMPOSITE_OFF:
+            # Итоговый файл ещё нужен для общей картинки, его удалит её сборка
+            return
 
-        await self._loop.run_in_executor(None, Cleaner.clear_video, recorder, source)
-        await self._loop.run_in_executor(None, Cleaner.clear_result, recorder, source)
+        await self.release_result(job)
 
 
 if __name__ == "__main__":
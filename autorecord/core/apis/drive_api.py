@@ -1,18 +1,78 @@
 import os
+import re
+import json
+import time
 import pickle
+import asyncio
+from datetime import datetime
 from typing import List
 from functools import wraps
-from asyncio import Semaphore
 
 from loguru import logger
 from aiohttp import ClientSession
-from aiofile import AIOFile, Reader
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 from autorecord.core.settings import config
+from autorecord.core.journal import UPLOAD_JOURNAL
+from autorecord.core.bandwidth import UPLOAD_BANDWIDTH, UPLOAD_LIMITER
+from autorecord.core.tracing import TRACER
+from autorecord.core.metrics import (
+    DRIVE_API_LATENCY,
+    UPLOAD_CHUNK_DURATION,
+    UPLOAD_CHUNK_THROUGHPUT,
+)
+
+# Размер части при загрузке должен быть кратен 256KB
+UPLOAD_CHUNK_ALIGN = 256 * 1024
+UPLOAD_CHUNK_SIZE = config.upload_chunk_size * 1024 * 1024
+UPLOAD_CHUNK_MIN_SIZE = config.upload_chunk_min_size * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = config.upload_chunk_max_size * 1024 * 1024
+
+
+def _read_into(fd: int, buffer: bytearray, offset: int, size: int) -> memoryview:
+    """
+    Прочитать кусок файла в заранее выделенный буфер без лишних копий
+
+    :return: view на прочитанные данные внутри буфера
+    """
+    view = memoryview(buffer)[:size]
+    read = os.preadv(fd, [view], offset)
+    return view[:read]
+
+
+def _parse_range(range_header: str) -> int:
+    """
+    Из хедера Range вида bytes=0-1234 достаём сколько байт принято.
+    Если хедера нет – гугл ещё ничего не принял
+    """
+    if range_header is None:
+        return 0
+
+    _, bytes_data = range_header.split("=")
+    _, received_bytes_upper = bytes_data.split("-")
+    return int(received_bytes_upper) + 1
+
 
-GOOGLE_SEMAPHORE = Semaphore(config.google_semaphore)
+def _observe_upload_error(status: int) -> None:
+    """На 429 и 5xx гугл просит грузить медленнее – уменьшаем число загрузок"""
+    if status == 429 or status >= 500:
+        UPLOAD_LIMITER.on_overload(status)
+
+
+def _adapt_chunk_size(chunk_size: int, sent: int, elapsed: float) -> int:
+    """
+    Подбираем размер части так, чтобы одна отправка занимала около
+    upload_chunk_target_time секунд при текущей скорости сети
+    """
+    if elapsed <= 0 or not sent:
+        return chunk_size
+
+    wanted = sent / elapsed * config.upload_chunk_target_time
+    # Сглаживаем, чтобы размер не скакал от одного медленного запроса
+    wanted = (chunk_size + wanted) / 2
+    wanted = max(UPLOAD_CHUNK_MIN_SIZE, min(UPLOAD_CHUNK_MAX_SIZE, wanted))
+    return int(wanted) // UPLOAD_CHUNK_ALIGN * UPLOAD_CHUNK_ALIGN
 
 
 class GoogleBase:
@@ -26,19 +86,23 @@ class GoogleBase:
         self._creds = None
         self._headers = {"Authorization": ""}
         self._client = ClientSession()
+        self._refresh_task = None
+        self._renew_handle = None
 
-    def refresh_token(self) -> None:
-        """
-        Пересоздаем токен и сохраняем в файл
+    def _load_creds(self, creds, force: bool = False):
         """
-        creds = None
+        Пересоздаем токен и сохраняем в файл.
+        Функция блокирующая, поэтому вызывается в отдельном потоке
 
-        if os.path.exists(self.TOKEN_PATH):
+        :param creds: текущий токен, если уже загружен
+        :param force: обновить токен, даже если он ещё действителен
+        """
+        if creds is None and os.path.exists(self.TOKEN_PATH):
             with open(self.TOKEN_PATH, "rb") as token:
                 creds = pickle.load(token)
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
+        if not creds or not creds.valid or force:
+            if creds and creds.refresh_token:
                 creds.refresh(Request())
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
@@ -49,21 +113,66 @@ class GoogleBase:
             with open(self.TOKEN_PATH, "wb") as token:
                 pickle.dump(creds, token)
 
+        return creds
+
+    async def refresh_token(self, force: bool = False) -> None:
+        """
+        Обновить токен, не блокируя event loop.
+        Одновременные вызовы ждут одно общее обновление
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh(force))
+            self._refresh_task.add_done_callback(self._reset_refresh_task)
+
+        await asyncio.shield(self._refresh_task)
+
+    def _reset_refresh_task(self, _) -> None:
+        self._refresh_task = None
+
+    async def _refresh(self, force: bool) -> None:
+        loop = asyncio.get_event_loop()
+        creds = await loop.run_in_executor(None, self._load_creds, self._creds, force)
+
         self._creds = creds
         self._headers["Authorization"] = f"Bearer {creds.token}"
+        self._schedule_renewal()
+
+    def _schedule_renewal(self) -> None:
+        """Заранее обновить токен за google_token_renew_margin секунд до истечения"""
+        if self._renew_handle is not None:
+            self._renew_handle.cancel()
+            self._renew_handle = None
+
+        if self._creds.expiry is None:
+            return
+
+        # expiry у гугловых токенов – наивное время в UTC
+        delay = (self._creds.expiry - datetime.utcnow()).total_seconds()
+        delay = max(delay - config.google_token_renew_margin, 0)
+        self._renew_handle = asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._renew())
+        )
+
+    async def _renew(self) -> None:
+        logger.info("Renewing google tokens ahead of expiry")
+        try:
+            await self.refresh_token(force=True)
+        except Exception as err:
+            # Не получилось заранее – токен обновится при следующем запросе
+            logger.warning(f"Failed to renew google tokens: {err}")
 
 
 def token_check(func):
     """
     Каждый час токен гугла протухает, поэтому нужно смотреть жив ли он ещё,
-    если нет – создать новый токен
+    если нет – создать новый токен
     """
 
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
         if not self._creds or self._creds.expired:
             logger.info("Refresh google tokens")
-            self.refresh_token()
+            await self.refresh_token()
 
         return await func(self, *args, **kwargs)
 
@@ -73,94 +182,481 @@ def token_check(func):
 def semaphore(func):
     """
     Семафора, чтобы не грузить одновременно большое количество видео,
-    иначе сеть будет провисать
+    иначе сеть будет провисать. Сколько загрузок пускать, решает UPLOAD_LIMITER
+    по ответам гугла и скорости отправки
     """
 
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
-        async with GOOGLE_SEMAPHORE:
+        async with UPLOAD_LIMITER:
             return await func(self, *args, **kwargs)
 
     return wrapper
 
 
+class DriveError(Exception):
+    """Ошибка отдельного запроса внутри пачки"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class DriveBatch:
+    """
+    Собирает мелкие запросы к Drive API от всех комнат за короткое окно
+    и отправляет их одной пачкой через batch endpoint.
+    Каждый вызывающий получает ответ на свой запрос
+    """
+
+    BATCH_URL = f"{config.google_api_url}/batch/drive/v3"
+    # Больше 100 запросов в одной пачке гугл не принимает
+    MAX_BATCH_SIZE = 100
+    BOUNDARY = "autorecord_batch"
+
+    def __init__(self, drive: GoogleBase, window: float):
+        """
+        :param drive: объект гугл сервиса, чей клиент и токен используются
+        :param window: сколько секунд ждать остальные запросы перед отправкой пачки
+        """
+        self._drive = drive
+        self._window = window
+        self._pending = []
+        self._flush_handle = None
+
+    async def request(self, method: str, path: str, body: dict = None) -> dict:
+        """
+        Добавить запрос в пачку и дождаться ответа на него
+
+        :param method: http метод
+        :param path: путь запроса, например /drive/v3/files
+        :param body: json тело запроса
+        :return: json ответа
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((method, path, body, future))
+
+        if len(self._pending) >= self.MAX_BATCH_SIZE:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        requests, self._pending = self._pending, []
+        if requests:
+            asyncio.ensure_future(self._send(requests))
+
+    async def _send(self, requests: list) -> None:
+        logger.debug(f"Sending batch of {len(requests)} Drive requests")
+
+        parts = []
+        for index, (method, path, body, _) in enumerate(requests):
+            parts.append(
+                f"--{self.BOUNDARY}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <item{index}>\r\n\r\n"
+                f"{method} {path}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(body or {})}\r\n"
+            )
+        parts.append(f"--{self.BOUNDARY}--\r\n")
+
+        try:
+            with DRIVE_API_LATENCY.labels("batch").time():
+                resp = await self._drive._client.post(
+                    self.BATCH_URL,
+                    data="".join(parts).encode(),
+                    headers={
+                        **self._drive._headers,
+                        "Content-Type": f"multipart/mixed; boundary={self.BOUNDARY}",
+                    },
+                    ssl=False,
+                )
+            resp.raise_for_status()
+            responses = _parse_batch_response(
+                resp.headers.get("Content-Type", ""), await resp.text()
+            )
+        except Exception as err:
+            for *_, future in requests:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for index, (*_, future) in enumerate(requests):
+            if future.done():
+                continue
+
+            status, body = responses.get(index, (500, "No response in batch"))
+            if status >= 400:
+                future.set_exception(DriveError(status, body))
+                continue
+
+            try:
+                future.set_result(json.loads(body) if body else {})
+            except ValueError as err:
+                future.set_exception(DriveError(status, f"Bad response body: {err}"))
+
+
+def _parse_batch_response(content_type: str, text: str) -> dict:
+    """
+    Разбираем multipart/mixed ответ batch endpoint`а
+
+    :return: словарь номер запроса в пачке: (http статус, тело ответа)
+    """
+    boundary_match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if boundary_match:
+        boundary = boundary_match.group(1)
+    else:
+        # Если граница не указана в заголовке – берём её из первой строки тела
+        boundary = text.lstrip().split("\n", 1)[0].strip()[2:]
+    responses = {}
+
+    for part in text.split(f"--{boundary}"):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+
+        # Заголовки части, затем вложенный http ответ: статус, заголовки, тело
+        part_headers, _, http_response = part.replace("\r\n", "\n").partition("\n\n")
+        content_id = re.search(r"Content-ID:\s*<response-item(\d+)>", part_headers, re.I)
+        if not content_id:
+            continue
+
+        status_line, _, rest = http_response.partition("\n")
+        _, _, body = rest.partition("\n\n")
+        status = int(status_line.split(" ")[1])
+        responses[int(content_id.group(1))] = (status, body.strip())
+
+    return responses
+
+
 class GoogleDrive(GoogleBase):
     """
     Класс работы с гугл драйвом
     """
 
-    UPLOAD_API_URL = "https://www.googleapis.com/upload/drive/v3"
-    API_URL = "https://www.googleapis.com/drive/v3"
+    UPLOAD_API_URL = f"{config.google_api_url}/upload/drive/v3"
+    API_URL = f"{config.google_api_url}/drive/v3"
     SCOPES = config.google_drive_scopes
     TOKEN_PATH = config.google_drive_token_path
 
+    def __init__(self):
+        super().__init__()
+        self._batch = DriveBatch(self, config.google_batch_window)
+
     @token_check
-    # @semaphore
-    async def upload(self, file_path: str, parent_id: str) -> str:
+    @semaphore
+    async def upload(
+        self,
+        file_path: str,
+        parent_id: str,
+        share: str = None,
+        mime_type: str = "video/mp4",
+        traces: list = None,
+    ) -> str:
         """
         Функция загрузки видео на диск.
 
         :param file_path: путь к файлу на сервере
         :param parent_id: id папки на гугл диске
+        :param share: кто делит полосу загрузки поровну с другими, обычно комната.
+            По умолчанию – папка на диске
+        :param mime_type: тип файла, для превью записи – картинка
+        :param traces: трассы источников записи, в которые пишутся спаны частей
 
         :return: id загруженного файла
         """
         logger.info(f"Started uploading {file_path}")
 
+        file_size = os.stat(file_path).st_size
+        session_url = None
+        offset = 0
+
+        # Если загрузка этого файла уже начиналась – пробуем продолжить её
+        entry = UPLOAD_JOURNAL.get(file_path)
+        if entry and entry["parent_id"] == parent_id and entry["file_size"] == file_size:
+            status = await self._get_upload_status(entry["session_url"], file_size)
+            if status is not None:
+                offset, drive_file_id = status
+                if drive_file_id:
+                    UPLOAD_JOURNAL.remove(file_path)
+                    logger.info(f"Upload of {file_path} was already finished")
+                    return drive_file_id
+
+                session_url = entry["session_url"]
+                logger.info(f"Resuming upload of {file_path} from byte {offset}")
+
+        if session_url is None:
+            session_url = await self._create_upload_session(
+                file_path, parent_id, mime_type
+            )
+            UPLOAD_JOURNAL.start(file_path, session_url, parent_id, file_size)
+
+        drive_file_id = await self._upload_chunks(
+            session_url,
+            file_path,
+            offset,
+            on_progress=lambda confirmed: UPLOAD_JOURNAL.update_confirmed(
+                file_path, confirmed
+            ),
+            share=share or parent_id,
+            traces=traces,
+        )
+        UPLOAD_JOURNAL.remove(file_path)
+
+        logger.info(f"Uploaded {file_path}")
+
+        return drive_file_id
+
+    @token_check
+    async def create_upload_session(self, file_path: str, parent_id: str) -> str:
+        """
+        Создать канал передачи для файла, который ещё пишется
+
+        :return: url канала передачи
+        """
+        return await self._create_upload_session(file_path, parent_id)
+
+    async def _create_upload_session(
+        self, file_path: str, parent_id: str, mime_type: str = "video/mp4"
+    ) -> str:
         meta_data = {"name": file_path.split("/")[-1], "parents": [parent_id]}
 
         # Создание канала передачи видео
-        resp = await self._client.post(
-            f"{self.UPLOAD_API_URL}/files?uploadType=resumable",
-            headers={**self._headers, **{"X-Upload-Content-Type": "video/mp4"}},
-            json=meta_data,
-            ssl=False,
+        with DRIVE_API_LATENCY.labels("create_upload").time():
+            resp = await self._client.post(
+                f"{self.UPLOAD_API_URL}/files?uploadType=resumable",
+                headers={**self._headers, **{"X-Upload-Content-Type": mime_type}},
+                json=meta_data,
+                ssl=False,
+            )
+        resp.raise_for_status()
+        return resp.headers.get("Location")
+
+    @token_check
+    async def upload_range(
+        self,
+        session_url: str,
+        file_path: str,
+        buffer: bytearray,
+        offset: int,
+        size: int,
+        share: str = None,
+        traces: list = None,
+    ) -> int:
+        """
+        Отправить часть файла, который ещё пишется, – итоговый размер неизвестен.
+        Такие части гугл принимает только кратными 256KB
+
+        :param buffer: буфер для чтения части, не меньше size
+        :param offset: с какого байта
+        :param size: сколько байт отправить
+        :param share: кто делит полосу загрузки, см. upload
+        :param traces: трассы источников записи, см. upload
+        :return: сколько байт файла гугл подтвердил
+        """
+        loop = asyncio.get_event_loop()
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            chunk = await loop.run_in_executor(
+                None, _read_into, fd, buffer, offset, size
+            )
+        finally:
+            os.close(fd)
+
+        with TRACER.span(
+            "drive.upload_live_chunk", traces, offset=offset, size=len(chunk)
+        ) as span:
+            waited_at = time.monotonic()
+            await UPLOAD_BANDWIDTH.acquire(share or session_url, len(chunk))
+            started_at = time.monotonic()
+            resp = await self._client.put(
+                session_url,
+                data=chunk,
+                headers={
+                    "Content-Length": str(len(chunk)),
+                    "Content-Range": f"bytes {offset}-{offset + len(chunk) - 1}/*",
+                },
+                ssl=False,
+            )
+            elapsed = time.monotonic() - started_at
+            span.set(status=resp.status, bandwidth_wait=started_at - waited_at)
+            DRIVE_API_LATENCY.labels("upload_live_chunk").observe(elapsed)
+            if resp.status != 308:
+                _observe_upload_error(resp.status)
+                resp.raise_for_status()
+        UPLOAD_LIMITER.on_success(len(chunk), elapsed)
+
+        return _parse_range(resp.headers.get("Range"))
+
+    @token_check
+    @semaphore
+    async def finish_upload(
+        self,
+        session_url: str,
+        file_path: str,
+        offset: int,
+        share: str = None,
+        traces: list = None,
+    ) -> str:
+        """
+        Догрузить файл, часть которого уже отправлена, теперь уже с известным размером
+
+        :param offset: сколько байт гугл уже подтвердил
+        :param share: кто делит полосу загрузки, см. upload
+        :param traces: трассы источников записи, см. upload
+        :return: id загруженного файла
+        """
+        drive_file_id = await self._upload_chunks(
+            session_url, file_path, offset, share=share or session_url, traces=traces
         )
-        session_url = resp.headers.get("Location")
+        logger.info(f"Uploaded {file_path}")
+        return drive_file_id
 
-        async with AIOFile(file_path, "rb") as afp:
-            # Асинхронное чтение файла по частям
-            file_size = str(os.stat(file_path).st_size)
-            reader = Reader(afp, chunk_size=256 * 1024 * 100)  # 25MB
-            received_bytes_lower = 0
-            async for chunk in reader:
-                chunk_size = len(chunk)
-                chunk_range = f"bytes {received_bytes_lower}-{received_bytes_lower + chunk_size - 1}"
+    async def _get_upload_status(self, session_url: str, file_size: int):
+        """
+        Узнать у гугла, сколько байт канал передачи уже принял
+
+        :param session_url: url канала передачи
+        :param file_size: размер файла
+        :return: (сколько байт принято, id файла если загрузка завершена)
+            или None, если канал больше не действителен
+        """
+        with DRIVE_API_LATENCY.labels("upload_status").time():
+            resp = await self._client.put(
+                session_url,
+                headers={"Content-Length": "0", "Content-Range": f"bytes */{file_size}"},
+                ssl=False,
+            )
+        if resp.status in (200, 201):
+            resp_json = await resp.json()
+            return file_size, resp_json["id"]
+
+        if resp.status == 308:
+            return _parse_range(resp.headers.get("Range")), None
+
+        logger.info(f"Upload session is no longer valid, status {resp.status}")
+        return None
+
+    async def _upload_chunks(
+        self,
+        session_url: str,
+        file_path: str,
+        offset: int = 0,
+        on_progress=None,
+        share: str = None,
+        traces: list = None,
+    ) -> str:
+        """
+        Загрузка файла по частям в канал передачи.
+        Пока отправляется часть N, часть N+1 уже читается с диска в другой буфер.
+        Буферы выделяются один раз, размер части подстраивается под скорость сети.
+
+        :param session_url: url канала передачи
+        :param file_path: путь к файлу на сервере
+        :param offset: с какого байта начинать
+        :param on_progress: вызывается с числом подтверждённых гуглом байт
+        :param share: кто делит полосу загрузки, см. upload
+        :param traces: трассы источников записи, см. upload
+        :return: id загруженного файла
+        """
+        loop = asyncio.get_event_loop()
+        file_size = os.stat(file_path).st_size
+        chunk_size = min(UPLOAD_CHUNK_SIZE, UPLOAD_CHUNK_MAX_SIZE)
+        # Маленьким файлам, например превью, не нужны буферы во всю часть
+        buffer_size = max(min(file_size - offset, UPLOAD_CHUNK_MAX_SIZE), 0)
+        buffers = [bytearray(buffer_size), bytearray(buffer_size)]
+        buffer_index = 0
+
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            read_future = loop.run_in_executor(
+                None, _read_into, fd, buffers[buffer_index], offset, chunk_size
+            )
+            while True:
+                chunk = await read_future
+                chunk_end = offset + len(chunk)
+
+                # Заранее читаем следующую часть во второй буфер
+                read_future = None
+                if chunk_end < file_size:
+                    read_future = loop.run_in_executor(
+                        None, _read_into, fd, buffers[1 - buffer_index], chunk_end, chunk_size
+                    )
 
                 # Отправляем часть данных видео.
                 # Гугл хочет в headers запроса флаги Content-Length и Content-Range
                 # где Content-Length – размер отправляемых данных,
                 # Content-Range – какой кусок данных шлём.
-                resp = await self._client.put(
-                    session_url,
-                    data=chunk,
-                    headers={
-                        "Content-Length": str(chunk_size),
-                        "Content-Range": f"{chunk_range}/{file_size}",
-                    },
-                    ssl=False,
-                )
-                # В ответ, если файл не до конца загружен гугл присылает тот же Content-Range в хедере Range.
-                # Если файл загружен, то Range не будет
-                chunk_range = resp.headers.get("Range")
-
-                try:
-                    resp_json = await resp.json()
-                    drive_file_id = resp_json["id"]
-                except Exception:
-                    pass
-
-                if chunk_range is None:
-                    break
-
-                # Из Range берём верхнее значение и по нему определяем следующий range
-                _, bytes_data = chunk_range.split("=")
-                _, received_bytes_lower = bytes_data.split("-")
-                received_bytes_lower = int(received_bytes_lower) + 1
+                with TRACER.span(
+                    "drive.upload_chunk", traces, offset=offset, size=len(chunk)
+                ) as span:
+                    waited_at = time.monotonic()
+                    await UPLOAD_BANDWIDTH.acquire(share or session_url, len(chunk))
+                    started_at = time.monotonic()
+                    resp = await self._client.put(
+                        session_url,
+                        data=chunk,
+                        headers={
+                            "Content-Length": str(len(chunk)),
+                            "Content-Range": f"bytes {offset}-{chunk_end - 1}/{file_size}",
+                        },
+                        ssl=False,
+                    )
+                    elapsed = time.monotonic() - started_at
+                    span.set(status=resp.status, bandwidth_wait=started_at - waited_at)
+                    DRIVE_API_LATENCY.labels("upload_chunk").observe(elapsed)
+                    UPLOAD_CHUNK_DURATION.observe(elapsed)
+                    if elapsed > 0:
+                        UPLOAD_CHUNK_THROUGHPUT.observe(len(chunk) / elapsed)
+
+                    if resp.status in (200, 201):
+                        resp_json = await resp.json()
+                        return resp_json["id"]
+
+                    if resp.status != 308:
+                        _observe_upload_error(resp.status)
+                        resp.raise_for_status()
+                UPLOAD_LIMITER.on_success(len(chunk), elapsed)
+
+                # В ответ, если файл не до конца загружен, гугл присылает в хедере Range
+                # сколько байт он уже принял, следующая часть начинается после них
+                confirmed = _parse_range(resp.headers.get("Range"))
+                if confirmed != chunk_end:
+                    # Гугл принял не всё – перечитываем с подтверждённого байта
+                    if read_future is not None:
+                        await read_future
+                    read_future = loop.run_in_executor(
+                        None, _read_into, fd, buffers[1 - buffer_index], confirmed, chunk_size
+                    )
+
+                if on_progress is not None:
+                    on_progress(confirmed)
+
+                chunk_size = _adapt_chunk_size(chunk_size, len(chunk), elapsed)
+                offset = confirmed
+                buffer_index = 1 - buffer_index
+        finally:
+            if read_future is not None:
+                await asyncio.wait([read_future])
+            os.close(fd)
 
-        logger.info(f"Uploaded {file_path}")
+    @token_check
+    async def delete_file(self, file_id: str) -> None:
+        """
+        Удалить файл с диска
 
-        return drive_file_id
+        :param file_id: id файла
+        """
+        logger.info(f"Deleting file {file_id}")
+        await self._batch.request("DELETE", f"/drive/v3/files/{file_id}")
 
     @token_check
     async def create_folder(
@@ -186,49 +682,50 @@ class GoogleDrive(GoogleBase):
         if folder_parent_id:
             meta_data["parents"] = [folder_parent_id]
 
-        resp = await self._client.post(
-            f"{self.API_URL}/files",
-            headers=self._headers,
-            json=meta_data,
-            ssl=False,
-        )
-        resp_json = await resp.json()
-        folder_id = resp_json["id"]
-
-        resp = await self._client.post(
-            f"{self.API_URL}/files/{folder_id}/permissions",
-            headers=self._headers,
-            json={"type": "anyone", "role": "reader"},
-            ssl=False,
+        # Создание папки и выдача прав идут через общую пачку запросов,
+        # чтобы папки всех комнат на границе слота создавались парой http запросов
+        folder = await self._batch.request("POST", "/drive/v3/files", meta_data)
+        folder_id = folder["id"]
+
+        await self._batch.request(
+            "POST",
+            f"/drive/v3/files/{folder_id}/permissions",
+            {"type": "anyone", "role": "reader"},
         )
 
         return folder_id
 
     @token_check
-    async def get_folder_by_name(self, name: str) -> dict:
+    async def get_folder_by_name(self, name: str, parent_id: str = "") -> dict:
         """
         Собираем папки на диске по имени
 
         :param name: имя папки
+        :param parent_id: id родительской папки. Если пустая строка – ищем по всему диску
         :return: словарь id папки: список id родительских папок
         """
         logger.info(f"Getting the id of folder with name {name}")
 
+        query = f"mimeType='application/vnd.google-apps.folder' and name='{name}' and trashed=false"
+        if parent_id:
+            query += f" and '{parent_id}' in parents"
+
         params = dict(
             fields="nextPageToken, files(name, id, parents)",
-            q=f"mimeType='application/vnd.google-apps.folder'and name='{name}'",
+            q=query,
             spaces="drive",
         )
         folders = []
         page_token = ""
 
         while page_token != False:
-            resp = await self._client.get(
-                f"{self.API_URL}/files?pageToken={page_token}",
-                headers=self._headers,
-                params=params,
-                ssl=False,
-            )
+            with DRIVE_API_LATENCY.labels("list_folders").time():
+                resp = await self._client.get(
+                    f"{self.API_URL}/files?pageToken={page_token}",
+                    headers=self._headers,
+                    params=params,
+                    ssl=False,
+                )
             resp_json = await resp.json()
             folders.extend(resp_json.get("files", []))
             page_token = resp_json.get("nextPageToken", False)
@@ -1,46 +1,163 @@
-from aiohttp import ClientSession
+import random
+import asyncio
+
+from aiohttp import ClientSession, ClientTimeout, ClientError, TCPConnector
 from loguru import logger
 
 from autorecord.core.settings import config
+from autorecord.core.metrics import PUBLISH_LATENCY
 
 NVR_API_URL = config.nvr_api_url
 NVR_API_KEY = config.nvr_api_key
 
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class NvrApiError(Exception):
+    """NVR API отклонил запрос, повторять его бессмысленно"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
 
-async def send_record(
-    room_name: str,
-    date: str,
-    start_time: str,
-    end_time: str,
-    record_url: str,
-    camera_ip: str,
-):
+class NvrApi:
     """
-    Отправить данные о записи в эрудит
-
-    :param room_name: имя комнаты
-    :param date: дата записи
-    :param start_time: время начала записи
-    :param end_time: время окончания записи
-    :param record_url: ссылка на запись на гугл диске
-    :param camera_ip: ip камеры с которой была запись
+    Клиент NVR API.
+    Одна сессия с пулом keep-alive соединений на всё приложение,
+    запросы с таймаутом и повторами с случайной задержкой
     """
-    data = {
-        "room_name": room_name,
-        "date": date,
-        "start_time": start_time,
-        "end_time": end_time,
-        "url": record_url,
-        "type": "Autorecord",
-        "camera_ip": camera_ip,
-    }
-
-    async with ClientSession() as session:
-        resp = await session.post(
-            f"{NVR_API_URL}/erudite/records",
-            json=data,
-            headers={"key": NVR_API_KEY},
-            ssl=False,
+
+    def __init__(self, url: str = NVR_API_URL, key: str = NVR_API_KEY):
+        self._url = url
+        self._key = key
+        self._session = None
+        self._pending = []
+        self._flush_handle = None
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=config.nvr_api_connections,
+                    keepalive_timeout=config.nvr_api_keepalive,
+                    ssl=False,
+                ),
+                timeout=ClientTimeout(total=config.nvr_api_timeout),
+                headers={"key": self._key},
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    async def _post(self, path: str, data: dict):
+        """
+        POST запрос с повторами при сетевых ошибках и ответах 429/5xx.
+        Задержка между попытками растёт экспоненциально со случайным разбросом.
+        На остальные ответы 4xx сразу бросает NvrApiError
+        """
+        for attempt in range(config.nvr_api_retries + 1):
+            try:
+                with PUBLISH_LATENCY.time():
+                    async with self.session.post(f"{self._url}{path}", json=data) as resp:
+                        if resp.status not in RETRY_STATUSES:
+                            if resp.status >= 400:
+                                raise NvrApiError(resp.status, await resp.text())
+                            return await resp.json(content_type=None)
+                        error = f"status {resp.status}"
+            except (ClientError, asyncio.TimeoutError) as err:
+                error = repr(err)
+
+            if attempt == config.nvr_api_retries:
+                raise ConnectionError(f"NVR API request to {path} failed: {error}")
+
+            delay = config.nvr_api_retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(
+                f"NVR API request to {path} failed ({error}), retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def send_record(
+        self,
+        room_name: str,
+        date: str,
+        start_time: str,
+        end_time: str,
+        record_url: str,
+        camera_ip: str,
+        proxy_url: str = None,
+        sprite_url: str = None,
+    ):
+        """
+        Отправить данные о записи в эрудит.
+        Записи, отправленные в течение nvr_batch_window секунд, уходят одной пачкой
+
+        :param room_name: имя комнаты
+        :param date: дата записи
+        :param start_time: время начала записи
+        :param end_time: время окончания записи
+        :param record_url: ссылка на запись на гугл диске
+        :param camera_ip: ip камеры с которой была запись
+        :param proxy_url: ссылка на лёгкую версию записи, если она есть
+        :param sprite_url: ссылка на лист миниатюр записи, если он есть
+        """
+        data = {
+            "room_name": room_name,
+            "date": date,
+            "start_time": start_time,
+            "end_time": end_time,
+            "url": record_url,
+            "type": "Autorecord",
+            "camera_ip": camera_ip,
+        }
+        if proxy_url:
+            data["proxy_url"] = proxy_url
+        if sprite_url:
+            data["sprite_url"] = sprite_url
+
+        if not config.nvr_batch_window:
+            return (await self.send_records([data]))[0]
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((data, future))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(config.nvr_batch_window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        asyncio.ensure_future(self._send_pending(pending))
+
+    async def _send_pending(self, pending: list) -> None:
+        results = await self.send_records(
+            [data for data, _ in pending], return_exceptions=True
         )
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
-    logger.debug(f"Erudite response: {await resp.json()}")
+    async def send_records(self, records: list, return_exceptions: bool = False) -> list:
+        """
+        Отправить пачку записей в эрудит. API принимает по одной записи,
+        поэтому запросы уходят разом по уже открытым соединениям пула
+
+        :param records: список словарей с данными записей
+        :return: список ответов эрудита
+        """
+        results = await asyncio.gather(
+            *[self._post("/erudite/records", data) for data in records],
+            return_exceptions=return_exceptions,
+        )
+        logger.debug(f"Erudite responses: {results}")
+        return results
@@ -0,0 +1,248 @@
+import time
+import asyncio
+from datetime import datetime
+from collections import OrderedDict, deque
+
+import pytz
+from loguru import logger
+
+from autorecord.core.settings import config
+from autorecord.core.metrics import UPLOAD_BANDWIDTH_LIMIT, UPLOAD_CONCURRENCY
+
+# Байт в секунду в одном Mbit/s
+MBIT = 1024 * 1024 / 8
+
+# Сколько байт за круг добавляется каждой комнате при делении полосы
+SHARE_QUANTUM = config.upload_chunk_min_size * 1024 * 1024
+
+# Как часто пересчитывать ограничение полосы в секундах
+RATE_REFRESH_INTERVAL = 1
+
+# Часть, отправленная медленнее этой доли от обычной скорости, – признак провисания сети
+SAG_RATIO = 0.5
+THROUGHPUT_SMOOTHING = 0.2
+
+
+def profile_rate(profile: dict, hour: int, default: float) -> float:
+    """
+    Ограничение полосы в Mbit/s на час hour по профилю времени суток.
+    Действует значение последнего часа профиля не позже hour,
+    до первого часа профиля – значение последнего, как с прошлых суток
+
+    :param profile: час начала -> Mbit/s
+    :param default: ограничение, если профиль пуст
+    """
+    if not profile:
+        return default
+
+    hours = sorted(profile)
+    earlier = [start for start in hours if start <= hour]
+    return profile[earlier[-1] if earlier else hours[-1]]
+
+
+class BandwidthGovernor:
+    """
+    Общий на все загрузки на диск ограничитель полосы – ведро токенов.
+    Полоса делится между комнатами поровну по кругу (deficit round robin):
+    комната с пятью загрузками получает столько же, сколько комната с одной.
+    Если задана ширина канала, из неё сначала вычитается поток с камер,
+    чтобы загрузки не мешали записи
+    """
+
+    def __init__(self):
+        self._tokens = 0.0
+        self._refilled_at = time.monotonic()
+        self._rate = None
+        self._rate_at = None
+        # Ожидающие отправки по комнатам: комната -> очередь (размер, future)
+        self._waiters = OrderedDict()
+        self._deficits = {}
+        self._task = None
+        self._ingest_probe = None
+        # Ждём ли сейчас токены, то есть упираются ли загрузки в ограничение
+        self.throttled = False
+
+    def set_ingest_probe(self, probe) -> None:
+        """
+        :param probe: функция без аргументов, возвращающая сколько байт в секунду
+            сейчас пишется с камер
+        """
+        self._ingest_probe = probe
+
+    @property
+    def rate(self):
+        """Текущее ограничение в байтах в секунду или None, если его нет"""
+        now = time.monotonic()
+        if self._rate_at is not None and now - self._rate_at < RATE_REFRESH_INTERVAL:
+            return self._rate
+
+        hour = datetime.now(tz=pytz.timezone("Europe/Moscow")).hour
+        limit = profile_rate(
+            config.upload_bandwidth_profile, hour, config.upload_bandwidth
+        )
+        rate = limit * MBIT
+
+        if config.link_bandwidth:
+            ingest = self._ingest_probe() if self._ingest_probe is not None else 0
+            available = max(
+                config.link_bandwidth * MBIT - ingest * (1 + config.ingest_headroom),
+                config.upload_bandwidth_min * MBIT,
+            )
+            rate = min(rate, available) if rate else available
+
+        self._rate = rate or None
+        self._rate_at = now
+        UPLOAD_BANDWIDTH_LIMIT.set(rate)
+        return self._rate
+
+    async def acquire(self, share: str, size: int) -> None:
+        """
+        Дождаться своей доли полосы перед отправкой size байт
+
+        :param share: кто делит полосу, обычно комната
+        """
+        if self.rate is None and not self._waiters:
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(share, deque()).append((size, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._dispatch())
+
+        await future
+
+    async def _dispatch(self) -> None:
+        """Раздаём полосу по кругу между комнатами, пока есть ожидающие"""
+        while self._waiters:
+            share, queue = next(iter(self._waiters.items()))
+
+            # Ход комнаты: добавляем ей квант и отправляем, пока его хватает
+            self._deficits[share] = self._deficits.get(share, 0) + SHARE_QUANTUM
+            while queue:
+                size, future = queue[0]
+                if future.done():
+                    # Загрузку отменили, пока она ждала
+                    queue.popleft()
+                    continue
+                if self._deficits[share] < size:
+                    break
+
+                await self._take(size)
+                self._deficits[share] -= size
+                queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+
+            if queue:
+                self._waiters.move_to_end(share)
+            else:
+                del self._waiters[share]
+                self._deficits.pop(share, None)
+
+    async def _take(self, size: int) -> None:
+        """
+        Списать size байт из ведра. Часть может быть больше ведра, поэтому
+        токены уходят в минус, и следующая отправка ждёт, пока долг погасится
+        """
+        while True:
+            rate = self.rate
+            if rate is None:
+                self.throttled = False
+                return
+
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._refilled_at) * rate, rate)
+            self._refilled_at = now
+            if self._tokens > 0:
+                self._tokens -= size
+                self.throttled = False
+                return
+
+            # Ограничение может поменяться, пока ждём, поэтому спим не дольше секунды
+            self.throttled = True
+            await asyncio.sleep(min(-self._tokens / rate, RATE_REFRESH_INTERVAL))
+
+
+class AdaptiveLimiter:
+    """
+    Ограничение числа одновременных загрузок, которое подстраивается под сеть:
+    после каждой удачно отправленной части растёт на 1/limit, то есть примерно
+    на одну загрузку за круг, а на 429 и 5xx от гугла падает вдвое.
+    Не растёт, пока загрузки упираются в ограничение полосы или сеть провисает
+    """
+
+    def __init__(self, governor: BandwidthGovernor, min_limit: int, max_limit: int):
+        self._governor = governor
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit, self._min_limit)
+        self._limit = float(self._min_limit)
+        self._active = 0
+        self._condition = None
+        # Обычная скорость отправки одной части, байт в секунду
+        self._throughput = None
+
+        UPLOAD_CONCURRENCY.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def on_success(self, size: int, elapsed: float) -> None:
+        """Часть размером size отправлена за elapsed секунд"""
+        if elapsed <= 0:
+            return
+
+        throughput = size / elapsed
+        sagging = (
+            self._throughput is not None and throughput < self._throughput * SAG_RATIO
+        )
+        if self._throughput is None:
+            self._throughput = throughput
+        else:
+            self._throughput += THROUGHPUT_SMOOTHING * (throughput - self._throughput)
+
+        # Больше загрузок не ускорят отправку, если полоса уже вся занята
+        if sagging or self._governor.throttled:
+            return
+
+        self._set_limit(min(self._limit + 1 / self._limit, self._max_limit))
+
+    def on_overload(self, status: int) -> None:
+        """Гугл ответил 429 или 5xx – уменьшаем число загрузок вдвое"""
+        limit = max(self._limit / 2, self._min_limit)
+        if int(limit) < self.limit:
+            logger.warning(
+                f"Drive responded {status}, reducing simultaneous uploads "
+                f"from {self.limit} to {int(limit)}"
+            )
+        self._set_limit(limit)
+
+    def _set_limit(self, limit: float) -> None:
+        grown = int(limit) > self.limit
+        self._limit = limit
+        UPLOAD_CONCURRENCY.set(self.limit)
+        if grown and self._condition is not None:
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+
+UPLOAD_BANDWIDTH = BandwidthGovernor()
+UPLOAD_LIMITER = AdaptiveLimiter(
+    UPLOAD_BANDWIDTH, config.upload_concurrency_min, config.google_semaphore
+)
@@ -1,17 +1,63 @@
-import asyncpg
+import json
+import asyncio
 from contextlib import asynccontextmanager
 
+import asyncpg
+
 from autorecord.core.settings import config
 
+_POOL = None
+_POOL_LOCK = asyncio.Lock()
+
+
+async def get_pool():
+    """Пул подключений к бд, создаётся один раз на всё приложение"""
+    global _POOL
+
+    async with _POOL_LOCK:
+        if _POOL is None:
+            pool = await asyncpg.create_pool(
+                config.psql_url,
+                min_size=config.psql_pool_min_size,
+                max_size=config.psql_pool_max_size,
+            )
+            try:
+                async with pool.acquire() as conn:
+                    await create_tables(conn)
+            except BaseException:
+                await pool.close()
+                raise
+            _POOL = pool
+
+    return _POOL
+
+
+async def create_tables(conn):
+    """
+    Создать служебные таблицы autorecord. Вызывается один раз при создании пула,
+    чтобы в частых запросах не было DDL и блокировок каталога
+    """
+    if config.schedule_enabled:
+        await create_schedule_table(conn)
+    if config.shard_enabled:
+        await create_nodes_table(conn)
+
+
+async def close_pool():
+    """Закрыть пул подключений"""
+    global _POOL
+
+    if _POOL is not None:
+        await _POOL.close()
+        _POOL = None
+
 
 @asynccontextmanager
 async def db_connect():
-    """Контекстный менеджер для подключения к бд"""
-    conn = await asyncpg.connect(config.psql_url)
-    try:
+    """Контекстный менеджер для получения подключения к бд из пула"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         yield conn
-    finally:
-        await conn.close()
 
 
 async def get_rooms():
@@ -27,3 +73,108 @@ async def get_room_sources(room_id):
     """
     async with db_connect() as conn:
         return await conn.fetch("SELECT * from sources where room_id = $1", room_id)
+
+
+async def get_rooms_with_sources(with_schedule: bool = False):
+    """
+    Собрать все комнаты вместе с их источниками одним запросом
+
+    :param with_schedule: собрать заодно расписание занятий комнат
+    :return: список словарей комнат, в каждом ключ sources – список словарей источников,
+        а при with_schedule ключ schedule – список словарей занятий
+    """
+    schedule_column = ""
+    if with_schedule:
+        schedule_column = """,
+                   coalesce(
+                       (SELECT json_agg(lectures.* ORDER BY lectures.start_time)
+                        FROM autorecord_schedule AS lectures
+                        WHERE lectures.room_id = rooms.id),
+                       '[]'
+                   ) AS room_schedule"""
+
+    async with db_connect() as conn:
+        records = await conn.fetch(
+            f"""
+            SELECT rooms.*,
+                   coalesce(
+                       json_agg(sources.*) FILTER (WHERE sources.id IS NOT NULL),
+                       '[]'
+                   ) AS room_sources{schedule_column}
+            FROM rooms
+            LEFT JOIN sources ON sources.room_id = rooms.id
+            GROUP BY rooms.id
+            """
+        )
+
+    rooms = []
+    for record in records:
+        room_dict = dict(record)
+        room_dict["sources"] = json.loads(room_dict.pop("room_sources"))
+        if with_schedule:
+            room_dict["schedule"] = json.loads(room_dict.pop("room_schedule"))
+        rooms.append(room_dict)
+
+    return rooms
+
+
+async def create_schedule_table(conn):
+    """
+    Таблица расписания занятий комнат. Занятие повторяется каждую неделю
+    в день day_of_week (1 – понедельник, 7 – воскресенье) или проходит один раз в date.
+    Запись занятия делится на части по slot_duration минут, если он задан
+    """
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS autorecord_schedule (
+            id SERIAL PRIMARY KEY,
+            room_id INTEGER NOT NULL,
+            day_of_week SMALLINT,
+            date DATE,
+            start_time TIME NOT NULL,
+            end_time TIME NOT NULL,
+            slot_duration INTEGER
+        )
+        """
+    )
+
+
+async def create_nodes_table(conn):
+    """Таблица живых узлов autorecord для распределения комнат между ними"""
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS autorecord_nodes (
+            node_id TEXT PRIMARY KEY,
+            heartbeat_at TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+
+async def heartbeat_node(node_id: str):
+    """
+    Отметить, что узел autorecord жив
+    :param node_id: id узла
+    """
+    async with db_connect() as conn:
+        await conn.execute(
+            """
+            INSERT INTO autorecord_nodes (node_id, heartbeat_at) VALUES ($1, now())
+            ON CONFLICT (node_id) DO UPDATE SET heartbeat_at = now()
+            """,
+            node_id,
+        )
+
+
+async def get_alive_nodes(ttl: int):
+    """
+    Собрать id узлов autorecord, присылавших heartbeat за последние ttl секунд
+    :param ttl: сколько секунд узел считается живым после heartbeat
+    """
+    async with db_connect() as conn:
+        records = await conn.fetch(
+            "SELECT node_id FROM autorecord_nodes "
+            "WHERE heartbeat_at > now() - make_interval(secs => $1)",
+            ttl,
+        )
+    return [record["node_id"] for record in records]
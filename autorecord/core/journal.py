@@ -0,0 +1,143 @@
+import os
+import time
+import sqlite3
+
+from autorecord.core.settings import config
+
+JOURNAL_PATH = f"{config.records_folder}/.autorecord.sqlite"
+
+
+class Journal:
+    """
+    Базовый класс таблицы в локальной sqlite базе рядом с записями.
+    Подключение открывается при первом обращении
+    """
+
+    SCHEMA = ""
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        self._path = path
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            self._conn = sqlite3.connect(
+                self._path, isolation_level=None, check_same_thread=False
+            )
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(self.SCHEMA)
+        return self._conn
+
+
+class UploadJournal(Journal):
+    """
+    Журнал незавершённых загрузок на гугл диск.
+    Для каждого файла хранится url канала передачи и сколько байт гугл уже подтвердил,
+    чтобы после перезапуска продолжить загрузку, а не начинать заново
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            file_path TEXT PRIMARY KEY,
+            session_url TEXT NOT NULL,
+            parent_id TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            confirmed_bytes INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    """
+
+    def get(self, file_path: str) -> dict:
+        row = self.conn.execute(
+            "SELECT * FROM uploads WHERE file_path = ?", (file_path,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def all(self) -> list:
+        return [dict(row) for row in self.conn.execute("SELECT * FROM uploads")]
+
+    def start(self, file_path: str, session_url: str, parent_id: str, file_size: int):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO uploads "
+            "(file_path, session_url, parent_id, file_size, confirmed_bytes, updated_at) "
+            "VALUES (?, ?, ?, ?, 0, ?)",
+            (file_path, session_url, parent_id, file_size, time.time()),
+        )
+
+    def update_confirmed(self, file_path: str, confirmed_bytes: int) -> None:
+        self.conn.execute(
+            "UPDATE uploads SET confirmed_bytes = ?, updated_at = ? WHERE file_path = ?",
+            (confirmed_bytes, time.time(), file_path),
+        )
+
+    def remove(self, file_path: str) -> None:
+        self.conn.execute("DELETE FROM uploads WHERE file_path = ?", (file_path,))
+
+
+class FolderCache(Journal):
+    """Кэш id папок на гугл диске: (id родительской папки, имя папки) -> id папки"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS folders (
+            parent_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            folder_id TEXT NOT NULL,
+            PRIMARY KEY (parent_id, name)
+        )
+    """
+
+    def get(self, parent_id: str, name: str) -> str:
+        row = self.conn.execute(
+            "SELECT folder_id FROM folders WHERE parent_id = ? AND name = ?",
+            (parent_id, name),
+        ).fetchone()
+        return row["folder_id"] if row else None
+
+    def set(self, parent_id: str, name: str, folder_id: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO folders (parent_id, name, folder_id) VALUES (?, ?, ?)",
+            (parent_id, name, folder_id),
+        )
+
+    def remove(self, parent_id: str, name: str) -> None:
+        self.conn.execute(
+            "DELETE FROM folders WHERE parent_id = ? AND name = ?", (parent_id, name)
+        )
+
+
+class UploadedFiles(Journal):
+    """Уже загруженные на диск файлы, которые пока оставлены на сервере"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            file_path TEXT PRIMARY KEY,
+            uploaded_at REAL NOT NULL
+        )
+    """
+
+    def add(self, file_path: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO uploaded_files (file_path, uploaded_at) VALUES (?, ?)",
+            (file_path, time.time()),
+        )
+
+    def oldest(self) -> list:
+        """Пути файлов, начиная с загруженных раньше всех"""
+        return [
+            row["file_path"]
+            for row in self.conn.execute(
+                "SELECT file_path FROM uploaded_files ORDER BY uploaded_at"
+            )
+        ]
+
+    def remove(self, file_path: str) -> None:
+        self.conn.execute("DELETE FROM uploaded_files WHERE file_path = ?", (file_path,))
+
+
+UPLOAD_JOURNAL = UploadJournal()
+FOLDER_CACHE = FolderCache()
+UPLOADED_FILES = UploadedFiles()
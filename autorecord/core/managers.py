@@ -1,37 +1,93 @@
 import os
+import re
+import math
+import time
 import asyncio
 from datetime import datetime, timedelta
 
 import pytz
 from loguru import logger
 
-from autorecord.core.utils import run_cmd, remove_file
-from autorecord.core.apis.drive_api import GoogleDrive
-from autorecord.core.apis.nvr_api import send_record
+from autorecord.core.utils import run_cmd, remove_file, RateLimiter
+from autorecord.core.journal import FOLDER_CACHE
+from autorecord.core.tracing import TRACER
+from autorecord.core.metrics import (
+    START_SKEW,
+    REMUX_DURATION,
+    STREAM_RESTARTS,
+    EMPTY_RECORDS,
+    PREVIEW_DURATION,
+    COMPOSITE_DURATION,
+)
+from autorecord.core.apis.drive_api import (
+    GoogleDrive,
+    DriveError,
+    UPLOAD_CHUNK_ALIGN,
+)
+from autorecord.core.apis.nvr_api import NvrApi
 from autorecord.core.settings import config
 
 
 RECORDS_FOLDER = config.records_folder
 
+# Режимы записи:
+#  – separate: звук и видео пишутся в отдельные файлы и сводятся после записи
+#  – muxed: каждый источник сразу пишется вместе со звуком комнаты в итоговый файл
+RECORD_MODE_SEPARATE = "separate"
+RECORD_MODE_MUXED = "muxed"
+
+# Режимы общей картинки комнаты: нет, сетка, картинка в картинке
+COMPOSITE_OFF = "off"
+COMPOSITE_GRID = "grid"
+COMPOSITE_PIP = "pip"
+
+# В режиме pip маленькие камеры в PIP_SCALE раз меньше кадра,
+# отступ между ними и от края в пикселях
+PIP_SCALE = 4
+PIP_MARGIN = 16
+
+# Общий на все комнаты ограничитель частоты запуска процессов записи
+SPAWN_LIMITER = RateLimiter(config.record_spawn_rate)
+
 # Шаблон команды ffmpeg для записи видео, в которую подставляются:
 #  – rtsp источника
-#  – имя комнаты
+#  – путь к файлу записи
 FFMPEG_SOUND_RECORD_CMD_TEMPLATE = (
     "ffmpeg -use_wallclock_as_timestamps true -rtsp_transport tcp -i {source_rtsp} "
-    f"-y -c:a copy -vn -f mp4 {RECORDS_FOLDER}/sound_"
-    "{record_name}.aac"
+    "-y -c:a copy -vn -f mp4 {output}"
 )
 
 # Шаблон команды ffmpeg для записи аудио, в которую подставляются:
 #  – rtsp источника
-#  – имя комнаты
-#  – id источника из бд
+#  – путь к файлу записи
 FFMPEG_VIDEO_RECORD_CMD_TEMPLATE = (
     "ffmpeg -use_wallclock_as_timestamps true -rtsp_transport tcp -i {source_rtsp} "
-    f"-y -c:v copy -an -f mp4 {RECORDS_FOLDER}/vid_"
-    "{record_name}_{source_id}.mp4"
+    "-y -c:v copy -an -f mp4 {output}"
+)
+
+# Шаблон команды ffmpeg для записи видео сразу со звуком комнаты, без отдельного
+# наложения звука после записи. Подставляются:
+#  – rtsp звука комнаты
+#  – rtsp источника
+#  – путь к файлу записи
+FFMPEG_MUXED_RECORD_CMD_TEMPLATE = (
+    "ffmpeg -use_wallclock_as_timestamps true -rtsp_transport tcp -i {sound_rtsp} "
+    "-use_wallclock_as_timestamps true -rtsp_transport tcp -i {source_rtsp} "
+    "-y -map 1:v -map 0:a -c copy -shortest -f mp4 {output}"
 )
 
+# То же, но файл пишется фрагментами: заголовок в начале, дальше данные только
+# дописываются в конец, поэтому уже записанные байты можно загружать на диск,
+# не дожидаясь конца записи
+FFMPEG_LIVE_RECORD_CMD_TEMPLATE = FFMPEG_MUXED_RECORD_CMD_TEMPLATE.replace(
+    "-f mp4", "-movflags frag_keyframe+empty_moov -f mp4"
+)
+
+# Шаблон команды ffmpeg для склейки кусков записи после перезапусков, подставляются:
+#  – файл со списком кусков
+#  – путь к итоговому файлу
+FFMPEG_CONCAT_CMD_TEMPLATE = "ffmpeg -f concat -safe 0 -i {list_path} -y -c copy -f mp4 {output}"
+
 # Шаблон команды ffmpeg для наложения звука на видео, в которую подставляются:
 #  – имя комнаты
 #  – id источника из бд
@@ -44,55 +100,461 @@ FFMPEG_MAP_CMD_TEMPLATE = (
     "{record_name}_{source_id}.mp4"
 )
 
+# Шаблон команды ffmpeg для лёгкой версии записи. Кодируется только процессором
+# с пониженным приоритетом и ограниченным числом потоков, подставляются:
+#  – приоритет процесса для nice
+#  – путь к записи и к прокси
+#  – высота кадра, битрейт видео в kbit/s и число потоков
+FFMPEG_PROXY_CMD_TEMPLATE = (
+    "nice -n {nice} ffmpeg -i {input} -y -vf scale=-2:{height} "
+    "-c:v libx264 -preset veryfast -b:v {bitrate}k -maxrate {bitrate}k "
+    "-bufsize {buffer}k -c:a aac -b:a 64k -ac 1 -threads {threads} "
+    "-movflags +faststart -f mp4 {output}"
+)
+
+# Шаблон команды ffmpeg для листа миниатюр: один кадр раз в interval секунд,
+# декодируются только ключевые кадры. Подставляются:
+#  – приоритет процесса для nice
+#  – путь к записи и к картинке
+#  – промежуток между миниатюрами, ширина миниатюры и сетка листа
+FFMPEG_SPRITE_CMD_TEMPLATE = (
+    "nice -n {nice} ffmpeg -skip_frame nokey -i {input} -y -an "
+    "-vf fps=1/{interval},scale={width}:-2,tile={columns}x{rows} "
+    "-frames:v 1 -q:v 5 -threads {threads} {output}"
+)
+
+# Шаблон команды ffmpeg для поиска тишины в звуке, подставляются:
+#  – путь к файлу
+#  – порог тишины в dB и её минимальная длительность в секундах
+FFMPEG_SILENCE_CMD_TEMPLATE = (
+    "ffmpeg -i {input} -vn -af silencedetect=noise={noise}dB:d={duration} -f null -"
+)
+
+# Шаблон команды ffmpeg для поиска чёрной картинки и смен сцены в видео.
+# Декодируются только ключевые кадры, поэтому проход дешёвый. Подставляются:
+#  – путь к файлу
+#  – минимальная длительность чёрной картинки в секундах
+#  – порог смены сцены от 0 до 1
+FFMPEG_SCENE_CMD_TEMPLATE = (
+    "ffmpeg -skip_frame nokey -i {input} -an "
+    "-vf blackdetect=d={duration}:pix_th=0.10,select='gt(scene,{scene})',showinfo "
+    "-f null -"
+)
+
+SILENCE_START_RE = re.compile(r"silence_start:\s*(-?[\d.]+)")
+SILENCE_DURATION_RE = re.compile(r"silence_duration:\s*([\d.]+)")
+BLACK_DURATION_RE = re.compile(r"black_duration:\s*([\d.]+)")
+SCENE_CHANGE_RE = re.compile(r"Parsed_showinfo.*\bn:\s*\d+")
+
+
+class Stream:
+    """
+    Один поток записи – звук комнаты или камера.
+    Если процесс ffmpeg упал или перестал писать, поток перезапускается
+    в новый кусок файла, после остановки куски склеиваются в один файл
+    """
+
+    def __init__(
+        self,
+        name: str,
+        key: str,
+        cmd_template: str,
+        output_path: str,
+        traces: list = None,
+        **cmd_params,
+    ):
+        """
+        :param name: имя потока для логов
+        :param key: постоянный между слотами ключ потока, например vid_{room}_{source}
+        :param cmd_template: шаблон команды ffmpeg с параметром {output}
+        :param output_path: путь к итоговому файлу потока
+        :param traces: трассы источников, которые пишет поток
+        :param cmd_params: остальные параметры шаблона команды
+        """
+        self.name = name
+        self.key = key
+        self.output_path = output_path
+        self.traces = traces or []
+        self._cmd_template = cmd_template
+        self._cmd_params = cmd_params
+
+        self.process = None
+        self.pieces = []
+        self.restarts = 0
+        self.uptime = 0
+
+        self._created_at = time.monotonic()
+        self._started_at = None
+        self._last_size = 0
+        self._last_growth_at = None
+        self._backoff = config.watchdog_backoff_min
+        self._next_restart_at = 0
+        self._capture_span = None
+
+    @property
+    def piece_path(self) -> str:
+        """Путь к текущему куску: первый кусок пишется сразу в итоговый файл"""
+        if not self.pieces:
+            return self.output_path
+
+        base, ext = os.path.splitext(self.output_path)
+        return f"{base}.part{len(self.pieces)}{ext}"
+
+    @property
+    def bytes_written(self) -> int:
+        size = 0
+        for path in self.pieces:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Средняя скорость записи потока на диск"""
+        elapsed = time.monotonic() - self._created_at
+        return self.bytes_written / elapsed if elapsed > 0 else 0
+
+    @property
+    def uptime_ratio(self) -> float:
+        """Доля времени с начала записи, когда поток действительно писался"""
+        uptime = self.uptime
+        if self._started_at is not None:
+            uptime += (self.process.exited_at or time.monotonic()) - self._started_at
+
+        elapsed = time.monotonic() - self._created_at
+        return min(uptime / elapsed, 1) if elapsed > 0 else 1
+
+    async def start(self) -> None:
+        path = self.piece_path
+        with TRACER.span(
+            "stream.spawn", self.traces, stream=self.name, restarts=self.restarts
+        ) as span:
+            await SPAWN_LIMITER.wait()
+            self.process = await run_cmd(
+                self._cmd_template.format(output=path, **self._cmd_params), self.name
+            )
+            span.set(pid=self.process.pid)
+        self._capture_span = TRACER.start_span(
+            "stream.capture",
+            self.traces,
+            stream=self.name,
+            pid=self.process.pid,
+            piece=path,
+        )
+        self.pieces.append(path)
+        self._started_at = time.monotonic()
+        self._last_size = 0
+        self._last_growth_at = self._started_at
+
+    async def stop(self, timeout: float = None) -> None:
+        """
+        :param timeout: сколько ждать выхода ffmpeg перед тем, как убить,
+            по умолчанию process_stop_timeout
+        """
+        if self.process is None:
+            return
+
+        # Если процесс упал раньше, время записи считаем до момента падения
+        stopped_at = self.process.exited_at or time.monotonic()
+        crashed = self.process.returncode is not None
+        await self.process.stop(timeout)
+        if self._capture_span is not None:
+            self._capture_span.set(returncode=self.process.returncode, crashed=crashed)
+            self._capture_span.end()
+            self._capture_span = None
+        if self._started_at is not None:
+            self.uptime += stopped_at - self._started_at
+            self._started_at = None
+
+    def check(self):
+        """
+        Проверить здоровье потока
+
+        :return: причина, по которой поток нужно перезапустить, или None
+        """
+        now = time.monotonic()
+
+        if self.process is None or self.process.returncode is not None:
+            return "process exited"
+
+        try:
+            size = os.path.getsize(self.pieces[-1])
+        except OSError:
+            size = 0
+        if size > self._last_size:
+            self._last_size = size
+            self._last_growth_at = now
+        elif now - self._last_growth_at > config.watchdog_stall_timeout:
+            return "output file is not growing"
+
+        # Пока ffmpeg подключается к камере, скорость занижена – даём ему время
+        speed = self.process.metrics.speed
+        running = now - self._started_at
+        if (
+            speed is not None
+            and speed < config.watchdog_min_speed
+            and running > config.watchdog_stall_timeout
+        ):
+            return f"speed dropped to {speed}x"
+
+        # Поток работает дольше максимальной задержки – сбрасываем её
+        if running > config.watchdog_backoff_max:
+            self._backoff = config.watchdog_backoff_min
+
+        return None
+
+    async def restart(self, reason: str) -> None:
+        """Перезапустить поток в новый кусок, не чаще чем позволяет задержка"""
+        now = time.monotonic()
+        if now < self._next_restart_at:
+            return
+
+        self.restarts += 1
+        STREAM_RESTARTS.inc()
+        self._next_restart_at = now + self._backoff
+        self._backoff = min(self._backoff * 2, config.watchdog_backoff_max)
+
+        logger.warning(f"Restarting stream {self.name}: {reason}")
+        # Зависший ffmpeg может так и не ответить на q – долго его не ждём
+        await self.stop(config.watchdog_kill_timeout)
+        await self.start()
+
+    async def join_pieces(self) -> None:
+        """Склеить куски после перезапусков в итоговый файл"""
+        pieces = [path for path in self.pieces if os.path.exists(path)]
+        if not pieces:
+            return
+        if len(pieces) == 1:
+            # Первый запуск не создал файл, например камера была недоступна, –
+            # единственный кусок и есть запись слота
+            if pieces[0] != self.output_path:
+                os.replace(pieces[0], self.output_path)
+            return
+
+        list_path = f"{self.output_path}.list"
+        joined_path = f"{self.output_path}.joined"
+        with open(list_path, "w") as list_file:
+            list_file.writelines(f"file '{path}'\n" for path in pieces)
+
+        proc = await run_cmd(
+            FFMPEG_CONCAT_CMD_TEMPLATE.format(list_path=list_path, output=joined_path),
+            f"concat_{self.name}",
+        )
+        returncode = await proc.wait()
+        remove_file(list_path)
+
+        if returncode:
+            # Склеить не вышло – оставляем хотя бы первый кусок
+            remove_file(joined_path)
+            if pieces[0] != self.output_path:
+                os.replace(pieces[0], self.output_path)
+            return
+
+        os.replace(joined_path, self.output_path)
+        for path in pieces[1:]:
+            remove_file(path)
+
 
 class Recorder:
     """Класс для управления процессом записи"""
 
-    def __init__(self, room):
+    def __init__(self, room, record_dt: datetime = None, duration: timedelta = None):
         """
         Один объект создается на одну комнату.
         Объект Recorder`а содержит в себе:
             – комнату, в которой будет записывать
-            – список процессов записи
-            – datetime начала записи
+            – потоки записи
+            – datetime начала и длительность записи
             – имя записи, составленное из даты и времени записи, и id комнаты
+
+        :param room: комната
+        :param record_dt: datetime начала слота, общий для всех комнат слота.
+            Если не передан – берётся текущее время
+        :param duration: длительность записи, по умолчанию – record_duration минут
         """
         self.room = room
-        self.record_processes = []
+        # Источники, которые пишутся в этом слоте. При нехватке места на диске
+        # их может быть меньше, чем у комнаты
+        self.sources = list(room.sources)
+        self.streams = []
 
-        self.record_dt = datetime.now(tz=pytz.timezone("Europe/Moscow")).replace(
-            tzinfo=None,
-            second=0,
-            microsecond=0,
-        )
+        self.record_dt = record_dt or self.current_record_dt()
+        self.duration = duration or timedelta(minutes=config.record_duration)
         self.record_name = self.record_dt.isoformat(timespec="minutes") + f"_{room.id}"
+        self.start_skew = None
+        # Общий для всех источников процесс наложения звука
+        self.map_task = None
+        # Общие для всех источников анализы файлов: путь -> задача
+        self.analysis_tasks = {}
+        # id источников, запись которых оказалась пустой
+        self.empty_sources = set()
+        # Общая для всех источников задача создания папки записи на диске
+        self.folder_task = None
+        # Загрузки файлов по ходу записи и их результат: id источника -> id файла
+        self.live_uploads = []
+        self.file_ids = {}
+        self._watchdog_task = None
 
-    async def start_record(self):
-        sound_source_rtsp = self.room.sound_source
-        sound_proc = await run_cmd(
-            FFMPEG_SOUND_RECORD_CMD_TEMPLATE.format(
-                source_rtsp=sound_source_rtsp,
-                record_name=self.record_name,
+    @staticmethod
+    def current_time() -> datetime:
+        """Текущее московское время"""
+        return datetime.now(tz=pytz.timezone("Europe/Moscow")).replace(tzinfo=None)
+
+    @staticmethod
+    def current_record_dt() -> datetime:
+        """Текущее московское время с точностью до минуты – начало слота записи"""
+        return Recorder.current_time().replace(second=0, microsecond=0)
+
+    @property
+    def end_dt(self) -> datetime:
+        """Запланированное время окончания записи"""
+        return self.record_dt + self.duration
+
+    @property
+    def uptime(self) -> dict:
+        """Доля времени записи каждого потока"""
+        return {stream.name: stream.uptime_ratio for stream in self.streams}
+
+    def trace_keys(self, sources: list = None) -> list:
+        """Ключи трасс источников записи, по умолчанию – всех"""
+        if sources is None:
+            sources = self.sources
+        return [(self.record_name, source.id) for source in sources]
+
+    @property
+    def stream_keys(self) -> list:
+        """Ключи потоков, которые пишет этот рекордер"""
+        if config.record_mode == RECORD_MODE_MUXED:
+            return [f"{self.room.id}_{source.id}" for source in self.sources]
+
+        return [f"sound_{self.room.id}"] + [
+            f"vid_{self.room.id}_{source.id}" for source in self.sources
+        ]
+
+    def _create_streams(self) -> list:
+        if config.record_mode == RECORD_MODE_MUXED:
+            template = (
+                FFMPEG_LIVE_RECORD_CMD_TEMPLATE
+                if config.live_upload
+                else FFMPEG_MUXED_RECORD_CMD_TEMPLATE
             )
-        )
-        self.record_processes.append(sound_proc)
+            return [
+                Stream(
+                    f"{self.record_name}_{source.id}",
+                    f"{self.room.id}_{source.id}",
+                    template,
+                    f"{RECORDS_FOLDER}/{self.record_name}_{source.id}.mp4",
+                    traces=self.trace_keys([source]),
+                    sound_rtsp=self.room.sound_source,
+                    source_rtsp=source.rtsp,
+                )
+                for source in self.sources
+            ]
 
-        for source in self.room.sources:
-            proc = await run_cmd(
-                FFMPEG_VIDEO_RECORD_CMD_TEMPLATE.format(
+        streams = [
+            Stream(
+                f"sound_{self.record_name}",
+                f"sound_{self.room.id}",
+                FFMPEG_SOUND_RECORD_CMD_TEMPLATE,
+                f"{RECORDS_FOLDER}/sound_{self.record_name}.aac",
+                # Звук комнаты общий для всех источников
+                traces=self.trace_keys(),
+                source_rtsp=self.room.sound_source,
+            )
+        ]
+        for source in self.sources:
+            streams.append(
+                Stream(
+                    f"vid_{self.record_name}_{source.id}",
+                    f"vid_{self.room.id}_{source.id}",
+                    FFMPEG_VIDEO_RECORD_CMD_TEMPLATE,
+                    f"{RECORDS_FOLDER}/vid_{self.record_name}_{source.id}.mp4",
+                    traces=self.trace_keys([source]),
                     source_rtsp=source.rtsp,
-                    record_name=self.record_name,
-                    source_id=source.id,
                 )
             )
-            self.record_processes.append(proc)
+        return streams
+
+    async def start_record(self):
+        # Все процессы комнаты запускаются одновременно
+        streams = self._create_streams()
+        results = await asyncio.gather(
+            *[stream.start() for stream in streams],
+            return_exceptions=True,
+        )
+        for stream, result in zip(streams, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to start {stream.name}: {result}")
+                continue
+            self.streams.append(stream)
+
+        # Отставание старта записи от начала слота
+        self.start_skew = (self.current_time() - self.record_dt).total_seconds()
+        START_SKEW.observe(self.start_skew)
+        logger.info(
+            f"Started recording {self.room.name}, start skew {self.start_skew:.3f}s"
+        )
+
+        if config.watchdog_enabled:
+            self._watchdog_task = asyncio.ensure_future(self._watchdog())
+
+        # Если публикуется только общая картинка, отдельные камеры не загружаются
+        if (
+            config.live_upload
+            and config.record_mode == RECORD_MODE_MUXED
+            and not config.composite_only
+        ):
+            streams = {stream.output_path: stream for stream in self.streams}
+            for source in self.sources:
+                stream = streams.get(Uploader.file_path(self, source))
+                if stream is not None:
+                    live_upload = LiveUpload(self, source, stream)
+                    live_upload.start()
+                    self.live_uploads.append(live_upload)
+
+    async def _watchdog(self):
+        """Следим за потоками и перезапускаем упавшие или зависшие"""
+        while True:
+            await asyncio.sleep(config.watchdog_interval)
+            # Потоки перезапускаются одновременно, чтобы один зависший
+            # не задерживал проверку остальных
+            restarts = []
+            for stream in self.streams:
+                reason = stream.check()
+                if reason is not None:
+                    restarts.append(self._restart_stream(stream, reason))
+            await asyncio.gather(*restarts)
 
-        logger.info(f"Started recording {self.room.name}")
+    @staticmethod
+    async def _restart_stream(stream: Stream, reason: str):
+        try:
+            await stream.restart(reason)
+        except Exception as err:
+            logger.error(f"Failed to restart stream {stream.name}: {err}")
 
     async def stop_record(self):
-        await asyncio.gather(*[proc.communicate(b"q") for proc in self.record_processes])
+        if self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            await asyncio.gather(self._watchdog_task, return_exceptions=True)
+
+        await asyncio.gather(*[stream.stop() for stream in self.streams])
+        await asyncio.gather(*[stream.join_pieces() for stream in self.streams])
 
-        logger.info(f"Stopped recording {self.room.name}")
+        # Догружаем хвосты файлов, которые загружались по ходу записи
+        file_ids = await asyncio.gather(
+            *[live_upload.finish() for live_upload in self.live_uploads]
+        )
+        for live_upload, file_id in zip(self.live_uploads, file_ids):
+            if file_id is not None:
+                self.file_ids[live_upload.source.id] = file_id
+
+        uptime = ", ".join(
+            f"{stream.name} {stream.uptime_ratio:.1%} ({stream.restarts} restarts)"
+            for stream in self.streams
+        )
+        logger.info(f"Stopped recording {self.room.name}, uptime: {uptime}")
 
 
 class AudioMapper:
@@ -100,56 +562,675 @@ class AudioMapper:
 
     @staticmethod
     async def map_video_and_sound(recorder: Recorder, source):
-        proc = await run_cmd(
-            FFMPEG_MAP_CMD_TEMPLATE.format(
-                record_name=recorder.record_name,
-                source_id=source.id,
+        with REMUX_DURATION.time(), TRACER.span(
+            "ffmpeg.map", recorder.trace_keys([source])
+        ) as span:
+            proc = await run_cmd(
+                FFMPEG_MAP_CMD_TEMPLATE.format(
+                    record_name=recorder.record_name,
+                    source_id=source.id,
+                ),
+                f"map_{recorder.record_name}_{source.id}",
+            )
+            span.set(pid=proc.pid, returncode=await proc.wait())
+
+    @staticmethod
+    async def map_room(recorder: Recorder) -> bool:
+        """
+        Наложить звук на видео всех источников комнаты одним процессом ffmpeg:
+        файл звука читается один раз, сколько бы камер ни было в комнате
+
+        :return: удалось ли. Если нет, например одно из видео не читается,
+            источники нужно свести по отдельности
+        """
+        sources = [
+            source
+            for source in recorder.sources
+            if Cleaner.is_video_exist(recorder, source)
+            and source.id not in recorder.empty_sources
+        ]
+        if not sources:
+            return True
+
+        cmd = ["ffmpeg", "-i", f"{RECORDS_FOLDER}/sound_{recorder.record_name}.aac"]
+        for source in sources:
+            cmd += ["-i", f"{RECORDS_FOLDER}/vid_{recorder.record_name}_{source.id}.mp4"]
+
+        # Отдельный выход на каждый источник: его видео и общий звук
+        for index, source in enumerate(sources, start=1):
+            cmd += [
+                "-map",
+                f"{index}:v",
+                "-map",
+                "0:a",
+                "-y",
+                "-shortest",
+                "-c",
+                "copy",
+                f"{RECORDS_FOLDER}/{recorder.record_name}_{source.id}.mp4",
+            ]
+
+        with REMUX_DURATION.time(), TRACER.span(
+            "ffmpeg.map", recorder.trace_keys(sources), sources=len(sources)
+        ) as span:
+            proc = await run_cmd(cmd, f"map_{recorder.record_name}")
+            returncode = await proc.wait()
+            span.set(pid=proc.pid, returncode=returncode)
+
+        if returncode:
+            logger.warning(
+                f"Shared sound mapping of {recorder.record_name} failed, "
+                "mapping sources separately"
             )
+        return returncode == 0
+
+    @staticmethod
+    def room_mapped(recorder: Recorder) -> bool:
+        """Удалось ли уже завершившееся общее наложение звука записи"""
+        task = recorder.map_task
+        return not task.cancelled() and task.exception() is None and task.result()
+
+
+class Previewer:
+    """Класс подготовки лёгких версий записи для просмотра: прокси и листа миниатюр"""
+
+    # Вид превью: (суффикс файла, mime тип)
+    PREVIEWS = {
+        "proxy": (".proxy.mp4", "video/mp4"),
+        "sprite": (".sprite.jpg", "image/jpeg"),
+    }
+
+    @staticmethod
+    def file_path(recorder: Recorder, source, kind: str) -> str:
+        suffix, _ = Previewer.PREVIEWS[kind]
+        return f"{RECORDS_FOLDER}/{recorder.record_name}_{source.id}{suffix}"
+
+    @staticmethod
+    def sprite_interval(recorder: Recorder) -> int:
+        """Через сколько секунд брать миниатюры, чтобы вся запись уместилась в лист"""
+        thumbnails = config.sprite_columns * config.sprite_rows
+        return max(math.ceil(recorder.duration.total_seconds() / thumbnails), 1)
+
+    @staticmethod
+    async def make_previews(recorder: Recorder, source) -> dict:
+        """
+        Закодировать прокси и лист миниатюр записи источника.
+        Кодирования идут друг за другом, так что на задачу один процесс ffmpeg
+
+        :return: словарь вид превью -> путь к файлу, только удавшиеся
+        """
+        input_path = Uploader.file_path(recorder, source)
+        params = {
+            "proxy": {
+                "height": config.preview_height,
+                "bitrate": config.preview_bitrate,
+                "buffer": config.preview_bitrate * 2,
+            },
+            "sprite": {
+                "interval": Previewer.sprite_interval(recorder),
+                "width": config.sprite_width,
+                "columns": config.sprite_columns,
+                "rows": config.sprite_rows,
+            },
+        }
+        templates = {
+            "proxy": FFMPEG_PROXY_CMD_TEMPLATE,
+            "sprite": FFMPEG_SPRITE_CMD_TEMPLATE,
+        }
+
+        previews = {}
+        with PREVIEW_DURATION.time():
+            for kind, template in templates.items():
+                output_path = Previewer.file_path(recorder, source, kind)
+                proc = await run_cmd(
+                    template.format(
+                        nice=config.preview_nice,
+                        input=input_path,
+                        output=output_path,
+                        threads=config.preview_threads,
+                        **params[kind],
+                    ),
+                    f"{kind}_{recorder.record_name}_{source.id}",
+                )
+                if await proc.wait() or not os.path.exists(output_path):
+                    logger.warning(
+                        f"Failed to make {kind} of {recorder.record_name}_{source.id}"
+                    )
+                    remove_file(output_path)
+                    continue
+                previews[kind] = output_path
+
+        return previews
+
+
+def _even(value: int) -> int:
+    """libx264 принимает только чётные размеры кадра"""
+    return value - value % 2
+
+
+def _fit(index: int, width: int, height: int) -> str:
+    """Фильтр, вписывающий видео входа index в рамку width x height с чёрными полями"""
+    return (
+        f"[{index}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    )
+
+
+class Compositor:
+    """
+    Класс сборки общей картинки всех камер комнаты.
+    Вся раскладка – один граф фильтров ffmpeg, так что кодирование одно на комнату
+    """
+
+    # Сколько общих картинок кодируется одновременно
+    SLOTS = asyncio.Semaphore(config.composite_workers)
+
+    @staticmethod
+    def file_path(recorder: Recorder) -> str:
+        return f"{RECORDS_FOLDER}/{recorder.record_name}.composite.mp4"
+
+    @staticmethod
+    def filter_graph(count: int, mode: str, width: int, height: int) -> str:
+        """
+        Граф фильтров раскладки count камер в кадр width x height, выход – [v]
+
+        :param mode: grid – сетка, pip – первая камера на весь кадр,
+            остальные маленькими рядами у нижнего края
+        """
+        width, height = _even(width), _even(height)
+        if count == 1:
+            return _fit(0, width, height) + "[v]"
+
+        if mode == COMPOSITE_PIP:
+            small_width = _even(width // PIP_SCALE)
+            small_height = _even(height // PIP_SCALE)
+            per_row = max(width // (small_width + PIP_MARGIN), 1)
+
+            parts = [_fit(0, width, height) + "[base0]"]
+            for index in range(1, count):
+                parts.append(_fit(index, small_width, small_height) + f"[pip{index}]")
+
+            # Маленькие камеры идут справа налево, не влезшие – рядом выше
+            for index in range(1, count):
+                row, column = divmod(index - 1, per_row)
+                x = width - (column + 1) * (small_width + PIP_MARGIN)
+                y = height - (row + 1) * (small_height + PIP_MARGIN)
+                output = "v" if index == count - 1 else f"base{index}"
+                parts.append(f"[base{index - 1}][pip{index}]overlay={x}:{y}[{output}]")
+            return ";".join(parts)
+
+        columns = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        cell_width, cell_height = _even(width // columns), _even(height // rows)
+
+        parts = [
+            _fit(index, cell_width, cell_height) + f"[cell{index}]"
+            for index in range(count)
+        ]
+        inputs = "".join(f"[cell{index}]" for index in range(count))
+        layout = "|".join(
+            f"{index % columns * cell_width}_{index // columns * cell_height}"
+            for index in range(count)
         )
-        await proc.wait()
+        # Незанятые клетки сетки остаются чёрными
+        parts.append(
+            f"{inputs}xstack=inputs={count}:layout={layout},pad={width}:{height}[v]"
+        )
+        return ";".join(parts)
+
+    @staticmethod
+    async def compose(recorder: Recorder, sources: list):
+        """
+        Собрать общую картинку из итоговых файлов источников, звук берётся
+        из первого: он у всех источников один – звук комнаты.
+        Кодирование только процессором, с пониженным приоритетом и ограниченным
+        числом потоков, одновременно не больше composite_workers
+
+        :param sources: источники в порядке раскладки, первый – главный
+        :return: путь к файлу или None, если собрать не удалось
+        """
+        output_path = Compositor.file_path(recorder)
+        bitrate = config.composite_bitrate
+
+        cmd = ["nice", "-n", str(config.composite_nice), "ffmpeg"]
+        for source in sources:
+            cmd += ["-i", Uploader.file_path(recorder, source)]
+        graph = Compositor.filter_graph(
+            len(sources),
+            config.composite_mode,
+            config.composite_width,
+            config.composite_height,
+        )
+        cmd += ["-filter_complex", graph, "-map", "[v]", "-map", "0:a?"]
+        cmd += ["-c:v", "libx264", "-preset", "veryfast"]
+        cmd += ["-b:v", f"{bitrate}k", "-maxrate", f"{bitrate}k"]
+        cmd += ["-bufsize", f"{bitrate * 2}k"]
+        cmd += ["-threads", str(config.composite_threads), "-c:a", "copy"]
+        cmd += ["-movflags", "+faststart", "-y", "-f", "mp4", output_path]
+
+        async with Compositor.SLOTS:
+            with COMPOSITE_DURATION.time(), TRACER.span(
+                "ffmpeg.composite",
+                recorder.trace_keys(sources),
+                mode=config.composite_mode,
+            ) as span:
+                proc = await run_cmd(cmd, f"composite_{recorder.record_name}")
+                returncode = await proc.wait()
+                span.set(pid=proc.pid, returncode=returncode)
+
+        if returncode or not os.path.exists(output_path):
+            logger.warning(f"Failed to compose {recorder.record_name}")
+            remove_file(output_path)
+            return None
+
+        return output_path
+
+
+class Analyzer:
+    """Класс оценки, было ли в записи что-то кроме тишины и статичной картинки"""
+
+    @staticmethod
+    async def audio_activity(recorder: Recorder, file_path: str):
+        """
+        Доля времени, когда в файле есть звук. Несколько источников одной записи
+        ждут один общий анализ файла
+
+        :return: доля от 0 до 1 или None, если файла нет или анализ не удался
+        """
+        task = recorder.analysis_tasks.get(file_path)
+        if task is None:
+            task = asyncio.ensure_future(Analyzer._audio_activity(file_path))
+            recorder.analysis_tasks[file_path] = task
+
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _audio_activity(file_path: str):
+        if not os.path.exists(file_path):
+            return None
+
+        silence = {"total": 0, "start": None}
+
+        def on_line(line: str):
+            match = SILENCE_START_RE.search(line)
+            if match:
+                silence["start"] = float(match.group(1))
+                return
+            match = SILENCE_DURATION_RE.search(line)
+            if match:
+                silence["total"] += float(match.group(1))
+                silence["start"] = None
+
+        proc = await run_cmd(
+            FFMPEG_SILENCE_CMD_TEMPLATE.format(
+                input=file_path,
+                noise=config.analysis_silence_noise,
+                duration=config.analysis_silence_duration,
+            ),
+            f"silence_{os.path.basename(file_path)}",
+            on_line,
+        )
+        if await proc.wait() or not proc.metrics.time:
+            return None
+
+        duration = proc.metrics.time
+        # Тишина до самого конца файла может остаться без silence_end
+        if silence["start"] is not None:
+            silence["total"] += max(duration - silence["start"], 0)
+
+        return max(1 - silence["total"] / duration, 0)
+
+    @staticmethod
+    async def video_activity(file_path: str):
+        """
+        Статистика картинки: доля времени с чёрным кадром и смены сцены в минуту
+
+        :return: словарь black_ratio, scene_changes или None, если анализ не удался
+        """
+        if not os.path.exists(file_path):
+            return None
+
+        stats = {"black": 0, "scenes": 0}
+
+        def on_line(line: str):
+            match = BLACK_DURATION_RE.search(line)
+            if match:
+                stats["black"] += float(match.group(1))
+            elif SCENE_CHANGE_RE.search(line):
+                stats["scenes"] += 1
+
+        proc = await run_cmd(
+            FFMPEG_SCENE_CMD_TEMPLATE.format(
+                input=file_path,
+                duration=config.analysis_silence_duration,
+                scene=config.analysis_scene_threshold,
+            ),
+            f"scene_{os.path.basename(file_path)}",
+            on_line,
+        )
+        if await proc.wait() or not proc.metrics.time:
+            return None
+
+        duration = proc.metrics.time
+        return {
+            "black_ratio": min(stats["black"] / duration, 1),
+            "scene_changes": stats["scenes"] / (duration / 60),
+        }
+
+    @staticmethod
+    async def is_empty(recorder: Recorder, source) -> bool:
+        """
+        Пустая ли запись источника: в комнате тихо и картинка чёрная или не меняется.
+        Если что-то не удалось проанализировать – считаем запись не пустой
+        """
+        if config.record_mode == RECORD_MODE_MUXED:
+            sound_path = video_path = Uploader.file_path(recorder, source)
+        else:
+            sound_path = f"{RECORDS_FOLDER}/sound_{recorder.record_name}.aac"
+            video_path = f"{RECORDS_FOLDER}/vid_{recorder.record_name}_{source.id}.mp4"
+
+        audio = await Analyzer.audio_activity(recorder, sound_path)
+        if audio is None:
+            # Без звука решаем по картинке, только если файла звука и правда нет
+            if os.path.exists(sound_path):
+                return False
+        elif audio >= config.analysis_min_audio_activity:
+            return False
+
+        video = await Analyzer.video_activity(video_path)
+        if video is None:
+            return False
+
+        static = (
+            video["black_ratio"] >= config.analysis_max_black_ratio
+            or video["scene_changes"] < config.analysis_min_scene_changes
+        )
+        if not static:
+            return False
+
+        audio_info = f"{audio:.1%}" if audio is not None else "no sound"
+        logger.info(
+            f"Record {recorder.record_name}_{source.id} is empty: audio {audio_info}, "
+            f"{video['black_ratio']:.0%} black, "
+            f"{video['scene_changes']:.2f} scene changes per minute"
+        )
+        EMPTY_RECORDS.inc()
+        recorder.empty_sources.add(source.id)
+        return True
 
 
 class Uploader:
     """Класс прослойка работы с гуглом"""
 
     GDRIVE = GoogleDrive()
+    # Текущие поиски папок на диске: (id родителя, имя) -> задача
+    _FOLDER_TASKS = {}
+
+    @staticmethod
+    def file_path(recorder: Recorder, source):
+        return f"{RECORDS_FOLDER}/{recorder.record_name}_{source.id}.mp4"
 
     @staticmethod
     async def upload(recorder: Recorder, source, folder_id):
-        file_path = f"{RECORDS_FOLDER}/{recorder.record_name}_{source.id}.mp4"
-        return await Uploader.GDRIVE.upload(file_path, folder_id)
+        # Полоса загрузки делится поровну между комнатами
+        return await Uploader.GDRIVE.upload(
+            Uploader.file_path(recorder, source),
+            folder_id,
+            share=str(recorder.room.id),
+            traces=recorder.trace_keys([source]),
+        )
+
+    @staticmethod
+    async def upload_preview(recorder: Recorder, source, kind: str, folder_id):
+        _, mime_type = Previewer.PREVIEWS[kind]
+        return await Uploader.GDRIVE.upload(
+            Previewer.file_path(recorder, source, kind),
+            folder_id,
+            share=str(recorder.room.id),
+            mime_type=mime_type,
+            traces=recorder.trace_keys([source]),
+        )
+
+    @staticmethod
+    async def upload_composite(recorder: Recorder, folder_id):
+        return await Uploader.GDRIVE.upload(
+            Compositor.file_path(recorder),
+            folder_id,
+            share=str(recorder.room.id),
+            traces=recorder.trace_keys(),
+        )
+
+    @staticmethod
+    async def delete(file_id: str):
+        await Uploader.GDRIVE.delete_file(file_id)
+
+    @staticmethod
+    async def record_folder(recorder: Recorder) -> str:
+        """
+        id папки записи на диске. Папка создаётся один раз на запись,
+        даже если её одновременно запрашивают загрузки нескольких источников
+        """
+        if recorder.folder_task is None:
+            recorder.folder_task = asyncio.ensure_future(
+                Uploader.prepare_folders(recorder)
+            )
+        try:
+            return await asyncio.shield(recorder.folder_task)
+        except Exception:
+            # Не вышло – следующий запрос попробует создать папку заново
+            recorder.folder_task = None
+            raise
 
     @staticmethod
     async def prepare_folders(recorder: Recorder):
+        with TRACER.span("drive.prepare_folders", recorder.trace_keys()) as span:
+            folder_id = await Uploader._prepare_folders(recorder)
+            span.set(folder_id=folder_id)
+        return folder_id
+
+    @staticmethod
+    async def _prepare_folders(recorder: Recorder):
         gdrive = Uploader.GDRIVE
 
         room_folder_id = recorder.room.drive.split("/")[-1]
         record_date = str(recorder.record_dt.date())
         record_time = recorder.record_dt.strftime("%H:%M")
 
-        folders = await gdrive.get_folder_by_name(record_date)
-        for folder_id, folder_parent_ids in folders.items():
-            if room_folder_id in folder_parent_ids:
-                return await gdrive.create_folder(record_time, folder_id)
+        date_folder_id = await Uploader.get_folder(room_folder_id, record_date)
+        try:
+            return await gdrive.create_folder(record_time, date_folder_id)
+        except DriveError as err:
+            if err.status != 404:
+                raise
 
-        date_folder_id = await gdrive.create_folder(record_date, room_folder_id)
+        # Папку даты удалили с диска – забываем её и создаём заново
+        logger.info(f"Cached folder {date_folder_id} not found, recreating")
+        FOLDER_CACHE.remove(room_folder_id, record_date)
+        date_folder_id = await Uploader.get_folder(room_folder_id, record_date)
         return await gdrive.create_folder(record_time, date_folder_id)
 
+    @staticmethod
+    async def get_folder(parent_id: str, name: str) -> str:
+        """
+        id папки с именем name внутри parent_id. Берётся из кэша,
+        иначе ищется на диске или создаётся. Одновременные запросы
+        одной и той же папки ждут один общий поиск, чтобы не плодить дубликаты
+        """
+        folder_id = FOLDER_CACHE.get(parent_id, name)
+        if folder_id:
+            return folder_id
+
+        key = (parent_id, name)
+        task = Uploader._FOLDER_TASKS.get(key)
+        if task is None:
+            task = asyncio.ensure_future(Uploader._find_or_create_folder(parent_id, name))
+            Uploader._FOLDER_TASKS[key] = task
+            task.add_done_callback(lambda _: Uploader._FOLDER_TASKS.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _find_or_create_folder(parent_id: str, name: str) -> str:
+        gdrive = Uploader.GDRIVE
+
+        folders = await gdrive.get_folder_by_name(name, parent_id)
+        if folders:
+            folder_id = next(iter(folders))
+        else:
+            folder_id = await gdrive.create_folder(name, parent_id)
+
+        FOLDER_CACHE.set(parent_id, name, folder_id)
+        return folder_id
+
+
+class LiveUpload:
+    """
+    Загрузка файла записи на диск, пока он ещё пишется.
+    Фрагментированный mp4 только дописывается в конец, поэтому всё, что уже
+    на диске, отправляется в канал передачи частями, кратными 256KB.
+    После остановки записи остаётся догрузить только хвост
+    """
+
+    def __init__(self, recorder: Recorder, source, stream: Stream):
+        self.recorder = recorder
+        self.source = source
+        self.stream = stream
+        self.session_url = None
+        # Сколько байт файла гугл уже подтвердил
+        self.confirmed = 0
+        self.failed = False
+
+        self._min_chunk = config.live_upload_min_chunk * 1024 * 1024
+        self._max_chunk = max(
+            config.upload_chunk_max_size * 1024 * 1024, self._min_chunk
+        )
+        self._task = None
+
+    @property
+    def file_path(self) -> str:
+        return self.stream.output_path
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        gdrive = Uploader.GDRIVE
+        try:
+            folder_id = await Uploader.record_folder(self.recorder)
+            self.session_url = await gdrive.create_upload_session(
+                self.file_path, folder_id
+            )
+            logger.info(f"Started live upload of {self.file_path}")
+
+            while True:
+                await asyncio.sleep(config.live_upload_interval)
+                if self.stream.restarts:
+                    # После перезапуска куски склеятся в новый файл, и уже
+                    # отправленные байты перестанут ему соответствовать
+                    logger.warning(
+                        f"Stream {self.stream.name} restarted, "
+                        f"live upload of {self.file_path} is abandoned"
+                    )
+                    self.failed = True
+                    return
+                await self._send_ready()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(f"Live upload of {self.file_path} failed: {err}")
+            self.failed = True
+
+    async def _send_ready(self) -> None:
+        """Отправить все целые части по 256KB, которые уже есть на диске"""
+        try:
+            size = os.path.getsize(self.file_path)
+        except OSError:
+            return
+
+        # Последний фрагмент может быть дописан не до конца, но байты
+        # фрагментированного mp4 не переписываются – отправляем всё кратное 256KB
+        ready = (size - self.confirmed) // UPLOAD_CHUNK_ALIGN * UPLOAD_CHUNK_ALIGN
+        if ready < self._min_chunk:
+            return
+
+        # Буфер живёт только на время отправки, а не весь слот, и не больше
+        # готового куска – иначе сотни камер держали бы гигабайты памяти
+        buffer = bytearray(min(ready, self._max_chunk))
+        while ready >= self._min_chunk:
+            chunk_size = min(ready, len(buffer))
+            confirmed = await Uploader.GDRIVE.upload_range(
+                self.session_url,
+                self.file_path,
+                buffer,
+                self.confirmed,
+                chunk_size,
+                share=str(self.recorder.room.id),
+                traces=self.recorder.trace_keys([self.source]),
+            )
+            if confirmed <= self.confirmed:
+                return
+            ready -= confirmed - self.confirmed
+            self.confirmed = confirmed
+
+    async def finish(self):
+        """
+        Остановить отправку по ходу записи и догрузить хвост файла
+
+        :return: id загруженного файла или None, если файл надо загрузить обычным путём
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+        if (
+            self.failed
+            or self.session_url is None
+            or self.stream.restarts
+            or not os.path.exists(self.file_path)
+        ):
+            return None
+
+        try:
+            return await Uploader.GDRIVE.finish_upload(
+                self.session_url,
+                self.file_path,
+                self.confirmed,
+                share=str(self.recorder.room.id),
+                traces=self.recorder.trace_keys([self.source]),
+            )
+        except Exception as err:
+            logger.warning(f"Failed to finish live upload of {self.file_path}: {err}")
+            return None
+
 
 class Publisher:
     """Класс публикации записей"""
 
+    NVR_API = NvrApi()
+
     @staticmethod
-    async def send_to_erudite(recorder: Recorder, source, file_id: str):
-        await send_record(
+    async def send_to_erudite(
+        recorder: Recorder, source, file_id: str, previews: dict = None
+    ):
+        """
+        :param previews: id загруженных превью записи: вид превью -> id файла
+        """
+        previews = previews or {}
+        proxy_url = sprite_url = None
+        if "proxy" in previews:
+            proxy_url = f"https://drive.google.com/file/d/{previews['proxy']}/preview"
+        if "sprite" in previews:
+            sprite_url = f"https://drive.google.com/uc?id={previews['sprite']}"
+
+        await Publisher.NVR_API.send_record(
             room_name=recorder.room.name,
             date=str(recorder.record_dt.date()),
             start_time=str(recorder.record_dt.time()),
-            end_time=str(
-                (recorder.record_dt + timedelta(minutes=config.record_duration)).time()
-            ),
+            end_time=str(recorder.end_dt.time()),
             record_url=f"https://drive.google.com/file/d/{file_id}/preview",
             camera_ip=source.ip,
+            proxy_url=proxy_url,
+            sprite_url=sprite_url,
         )
 
 
@@ -187,6 +1268,15 @@ class Cleaner:
     def clear_video(recorder: Recorder, source):
         remove_file(f"{RECORDS_FOLDER}/vid_{recorder.record_name}_{source.id}.mp4")
 
+    @staticmethod
+    def clear_previews(recorder: Recorder, source):
+        for kind in Previewer.PREVIEWS:
+            remove_file(Previewer.file_path(recorder, source, kind))
+
+    @staticmethod
+    def clear_composite(recorder: Recorder):
+        remove_file(Compositor.file_path(recorder))
+
     @staticmethod
     def clear_sound(recorder: Recorder):
         remove_file(f"{RECORDS_FOLDER}/sound_{recorder.record_name}.aac")
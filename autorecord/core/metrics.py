@@ -0,0 +1,151 @@
+import os
+import shutil
+import asyncio
+
+from aiohttp import web
+from loguru import logger
+from prometheus_client import (
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    CONTENT_TYPE_LATEST,
+)
+
+from autorecord.core.settings import config
+
+START_SKEW = Histogram(
+    "autorecord_start_skew_seconds",
+    "Delay between slot start and room recording start",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+REMUX_DURATION = Histogram(
+    "autorecord_remux_duration_seconds",
+    "Duration of mapping sound onto video",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+)
+PREVIEW_DURATION = Histogram(
+    "autorecord_preview_duration_seconds",
+    "Duration of encoding a proxy and a thumbnail sprite",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+)
+COMPOSITE_DURATION = Histogram(
+    "autorecord_composite_duration_seconds",
+    "Duration of encoding a room composite of all cameras",
+    buckets=(10, 30, 60, 120, 300, 600, 1200, 1800),
+)
+UPLOAD_CHUNK_DURATION = Histogram(
+    "autorecord_upload_chunk_duration_seconds",
+    "Duration of a single Drive upload chunk",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+)
+UPLOAD_CHUNK_THROUGHPUT = Histogram(
+    "autorecord_upload_chunk_throughput_bytes_per_second",
+    "Drive upload chunk throughput, bytes per second",
+    buckets=tuple(2 ** power * 1024 * 1024 / 8 for power in range(0, 12)),
+)
+DRIVE_API_LATENCY = Histogram(
+    "autorecord_drive_api_latency_seconds",
+    "Drive API latency by call type",
+    ["call"],
+)
+PUBLISH_LATENCY = Histogram(
+    "autorecord_erudite_publish_latency_seconds",
+    "Erudite record publish latency",
+)
+STREAM_RESTARTS = Counter(
+    "autorecord_stream_restarts_total",
+    "Recording stream restarts inside a slot",
+)
+STREAM_UPTIME = Gauge(
+    "autorecord_stream_uptime_ratio",
+    "Share of the current slot the recording stream was running",
+    ["stream"],
+)
+EMPTY_RECORDS = Counter(
+    "autorecord_empty_records_total",
+    "Records skipped as silent and static",
+)
+FFMPEG_PROCESSES = Gauge(
+    "autorecord_ffmpeg_processes",
+    "Running ffmpeg processes",
+)
+QUEUE_DEPTH = Gauge(
+    "autorecord_queue_depth",
+    "Jobs waiting in a processing stage queue",
+    ["stage"],
+)
+PENDING_BYTES = Gauge(
+    "autorecord_pending_bytes",
+    "Bytes of records on disk waiting for processing",
+)
+FREE_DISK_BYTES = Gauge(
+    "autorecord_free_disk_bytes",
+    "Free space on the records disk",
+)
+STORAGE_FORECAST_BYTES = Gauge(
+    "autorecord_storage_forecast_bytes",
+    "Bytes expected to be written until the end of the current slot",
+)
+UPLOAD_BANDWIDTH_LIMIT = Gauge(
+    "autorecord_upload_bandwidth_limit_bytes",
+    "Current upload bandwidth limit in bytes per second, 0 – unlimited",
+)
+UPLOAD_CONCURRENCY = Gauge(
+    "autorecord_upload_concurrency_limit",
+    "Current limit of simultaneous uploads",
+)
+
+# Функции, обновляющие показатели непосредственно перед отдачей метрик
+_COLLECTORS = []
+
+
+def register_collector(collector) -> None:
+    """
+    :param collector: функция без аргументов, вызывается при каждом запросе метрик
+    """
+    _COLLECTORS.append(collector)
+
+
+def _collect_disk() -> None:
+    pending = 0
+    for entry in os.scandir(config.records_folder):
+        if entry.is_file() and not entry.name.startswith("."):
+            pending += entry.stat().st_size
+    PENDING_BYTES.set(pending)
+    FREE_DISK_BYTES.set(shutil.disk_usage(config.records_folder).free)
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    for collector in _COLLECTORS:
+        collector()
+
+    # Обход папки с записями может быть долгим – не в event loop
+    await asyncio.get_event_loop().run_in_executor(None, _collect_disk)
+
+    return web.Response(
+        body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Запустить http сервер с метриками в текущем event loop
+
+    :return: запущенный сервер или None, если порт занять не удалось
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as err:
+        # Порт занят или адрес недоступен – запись работает и без метрик
+        logger.error(f"Failed to serve metrics on {host}:{port}: {err}")
+        await runner.cleanup()
+        return None
+
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import itertools
+
+from loguru import logger
+
+from autorecord.core.tracing import TRACER
+
+
+class Job:
+    """Задача обработки одного источника одной записи"""
+
+    def __init__(self, recorder, source, folder_id: str = None):
+        self.recorder = recorder
+        self.source = source
+        self.folder_id = folder_id
+        self.file_id = None
+        # Виды закодированных, но ещё не загруженных превью записи
+        self.preview_kinds = []
+        # id загруженных превью записи: вид превью -> id файла
+        self.previews = {}
+        # Имя этапа, на который перейти вместо следующего по порядку
+        self.jump_to = None
+        # Future, завершения которой дождаться перед переходом на следующий этап.
+        # Пока она не завершилась, задача не занимает воркер и не стоит в очереди
+        self.wait_for = None
+        # time.monotonic() момента постановки в очередь текущего этапа
+        self.enqueued_at = None
+        self.done = asyncio.get_event_loop().create_future()
+
+    @property
+    def priority(self):
+        """Чем раньше начался слот, тем раньше обрабатываем"""
+        return self.recorder.record_dt
+
+    def finish(self, success: bool) -> None:
+        if not self.done.done():
+            self.done.set_result(success)
+
+    @property
+    def traces(self) -> list:
+        return [(self.recorder.record_name, self.source.id)]
+
+    def __str__(self):
+        return f"{self.recorder.record_name}_{self.source.id}"
+
+
+class Stage:
+    """Этап обработки со своей очередью и пулом воркеров"""
+
+    def __init__(self, name: str, handler, workers: int, maxsize: int):
+        """
+        :param name: имя этапа
+        :param handler: корутина, принимающая Job. Если вернула False –
+            дальнейшие этапы для задачи не выполняются. Если выставила job.jump_to –
+            задача переходит сразу на этот этап
+        :param workers: сколько задач этапа выполняется одновременно
+        :param maxsize: размер очереди этапа, при заполнении предыдущий этап ждёт
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue(maxsize)
+        self.next_stage = None
+        # Пока событие сброшено, воркеры этапа не берут новые задачи
+        self.running = asyncio.Event()
+        self.running.set()
+
+
+class Pipeline:
+    """
+    Конвейер обработки записей: задача проходит этапы по порядку,
+    у каждого этапа ограниченная очередь и свой пул воркеров.
+    Внутри очереди задачи более старых слотов обрабатываются первыми
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._first_stage = None
+        self._last_stage = None
+        self._counter = itertools.count()
+        self._workers = []
+        # Задачи, ждущие job.wait_for перед постановкой в очередь
+        self._waiting = set()
+
+    def add_stage(self, name: str, handler, workers: int, maxsize: int = 0) -> None:
+        stage = Stage(name, handler, workers, maxsize)
+        if self._last_stage is None:
+            self._first_stage = stage
+        else:
+            self._last_stage.next_stage = stage
+        self._last_stage = stage
+        self._stages[name] = stage
+
+    def start(self, loop) -> None:
+        for stage in self._stages.values():
+            for _ in range(stage.workers):
+                self._workers.append(loop.create_task(self._worker(stage)))
+
+        logger.info(
+            "Started pipeline: "
+            + ", ".join(f"{s.name} x{s.workers}" for s in self._stages.values())
+        )
+
+    async def stop(self) -> None:
+        """Остановить воркеры, задачи в очередях не обрабатываются"""
+        for task in [*self._workers, *self._waiting]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._waiting, return_exceptions=True)
+        self._workers = []
+        self._waiting = set()
+
+    def pause(self, stage_name: str) -> None:
+        """Приостановить этап: уже начатые задачи доделываются, новые ждут"""
+        stage = self._stages[stage_name]
+        if stage.running.is_set():
+            logger.warning(f"Pausing pipeline stage {stage_name}")
+            stage.running.clear()
+
+    def resume(self, stage_name: str) -> None:
+        stage = self._stages[stage_name]
+        if not stage.running.is_set():
+            logger.info(f"Resuming pipeline stage {stage_name}")
+            stage.running.set()
+
+    def is_paused(self, stage_name: str) -> bool:
+        return not self._stages[stage_name].running.is_set()
+
+    @property
+    def queue_depth(self) -> dict:
+        return {name: stage.queue.qsize() for name, stage in self._stages.items()}
+
+    async def submit(self, job: Job, stage_name: str = None) -> Job:
+        """
+        Поставить задачу в очередь. Ждёт, если очередь этапа заполнена
+
+        :param job: задача
+        :param stage_name: с какого этапа начать, по умолчанию – с первого
+        """
+        stage = self._stages[stage_name] if stage_name else self._first_stage
+        await self._put(stage, job)
+        return job
+
+    async def _put(self, stage: Stage, job: Job) -> None:
+        if job.wait_for is not None:
+            waiting, job.wait_for = job.wait_for, None
+            task = asyncio.ensure_future(self._put_after(waiting, stage, job))
+            self._waiting.add(task)
+            task.add_done_callback(self._waiting.discard)
+            return
+
+        job.enqueued_at = time.monotonic()
+        await stage.queue.put((job.priority, next(self._counter), job))
+
+    async def _put_after(self, waiting, stage: Stage, job: Job) -> None:
+        # Результат future проверит обработчик следующего этапа
+        await asyncio.wait([waiting])
+        await self._put(stage, job)
+
+    async def _worker(self, stage: Stage) -> None:
+        while True:
+            await stage.running.wait()
+            _, _, job = await stage.queue.get()
+            # Этап могли приостановить, пока воркер ждал задачу
+            await stage.running.wait()
+            try:
+                with TRACER.span(
+                    f"stage.{stage.name}",
+                    job.traces,
+                    queue_wait=time.monotonic() - job.enqueued_at,
+                ) as span:
+                    proceed = await stage.handler(job)
+                    span.set(proceed=proceed is not False, jump_to=job.jump_to)
+            except Exception:
+                logger.exception(f"Stage {stage.name} failed for {job}")
+                job.finish(False)
+            else:
+                if proceed is False:
+                    job.finish(False)
+                elif job.jump_to is not None:
+                    next_stage, job.jump_to = self._stages[job.jump_to], None
+                    await self._put(next_stage, job)
+                elif stage.next_stage is not None:
+                    await self._put(stage.next_stage, job)
+                else:
+                    job.finish(True)
+            finally:
+                stage.queue.task_done()
@@ -0,0 +1,185 @@
+import re
+import time
+import asyncio
+from collections import deque
+from asyncio.subprocess import PIPE, DEVNULL
+
+from loguru import logger
+
+from autorecord.core.settings import config
+from autorecord.core.metrics import FFMPEG_PROCESSES
+
+# Строки прогресса ffmpeg вида
+# frame=  250 fps= 25 q=-1.0 size=    1024kB time=00:00:10.00 bitrate= 838.9kbits/s speed=   1x
+PROGRESS_FIELD_RE = re.compile(r"(frame|fps|size|time|bitrate|speed)=\s*(\S+)")
+LINE_SPLIT_RE = re.compile(rb"[\r\n]")
+
+
+def _parse_number(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _parse_size(value: str):
+    """'1024kB' / '1024KiB' -> байты"""
+    match = re.match(r"([\d.]+)([a-zA-Z]*)", value)
+    if not match:
+        return None
+
+    number, unit = match.groups()
+    multiplier = {"b": 1, "kb": 1024, "kib": 1024, "mb": 1024 ** 2, "mib": 1024 ** 2}
+    return int(float(number) * multiplier.get(unit.lower(), 1))
+
+
+def _parse_time(value: str):
+    """'00:01:02.50' -> секунды"""
+    try:
+        hours, minutes, seconds = value.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+class ProcessMetrics:
+    """Последние показатели прогресса ffmpeg"""
+
+    def __init__(self):
+        self.frame = None
+        self.fps = None
+        self.size = None  # байты
+        self.time = None  # секунды записанного потока
+        self.bitrate = None  # кбит/с
+        self.speed = None
+        self.updated_at = None  # time.monotonic() последнего обновления
+
+    def update(self, line: str) -> None:
+        fields = dict(PROGRESS_FIELD_RE.findall(line))
+        if "frame" in fields:
+            frame = _parse_number(fields["frame"])
+            self.frame = int(frame) if frame is not None else None
+        if "fps" in fields:
+            self.fps = _parse_number(fields["fps"])
+        if "size" in fields:
+            self.size = _parse_size(fields["size"])
+        if "time" in fields:
+            self.time = _parse_time(fields["time"])
+        if "bitrate" in fields:
+            self.bitrate = _parse_number(fields["bitrate"].replace("kbits/s", ""))
+        if "speed" in fields:
+            self.speed = _parse_number(fields["speed"].rstrip("x"))
+        self.updated_at = time.monotonic()
+
+    def as_dict(self) -> dict:
+        return {
+            "frame": self.frame,
+            "fps": self.fps,
+            "size": self.size,
+            "time": self.time,
+            "bitrate": self.bitrate,
+            "speed": self.speed,
+        }
+
+
+class SupervisedProcess:
+    """
+    Обёртка над процессом ffmpeg.
+    stderr постоянно вычитывается, чтобы процесс не встал на заполненном пайпе:
+    строки прогресса разбираются в метрики, остальные хранятся в ограниченном буфере
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process, name: str, on_line=None):
+        """
+        :param proc: запущенный процесс
+        :param name: имя процесса для логов
+        :param on_line: вызывается с каждой строкой stderr, кроме строк прогресса
+        """
+        self._proc = proc
+        self.name = name
+        self._on_line = on_line
+        self.metrics = ProcessMetrics()
+        self.log = deque(maxlen=config.process_log_lines)
+        # time.monotonic() момента, когда процесс закрыл stderr, т.е. завершился
+        self.exited_at = None
+        FFMPEG_PROCESSES.inc()
+        self._drain_task = asyncio.ensure_future(self._drain())
+
+    @classmethod
+    async def start(cls, cmd: list, name: str = None, on_line=None):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=PIPE, stdout=DEVNULL, stderr=PIPE
+        )
+        return cls(proc, name or cmd[0], on_line)
+
+    @property
+    def pid(self) -> int:
+        return self._proc.pid
+
+    @property
+    def returncode(self):
+        return self._proc.returncode
+
+    async def _drain(self) -> None:
+        buffer = b""
+        while True:
+            chunk = await self._proc.stderr.read(4096)
+            if not chunk:
+                break
+
+            *lines, buffer = LINE_SPLIT_RE.split(buffer + chunk)
+            for line in lines:
+                self._handle_line(line)
+
+        self._handle_line(buffer)
+        self.exited_at = time.monotonic()
+        FFMPEG_PROCESSES.dec()
+
+    def _handle_line(self, raw_line: bytes) -> None:
+        line = raw_line.decode(errors="replace").strip()
+        if not line:
+            return
+
+        # У видео прогресс начинается с frame=, у звука – с size=
+        if line.startswith("frame=") or line.startswith("size="):
+            self.metrics.update(line)
+        else:
+            self.log.append(line)
+            if self._on_line is not None:
+                self._on_line(line)
+
+    async def wait(self) -> int:
+        returncode = await self._proc.wait()
+        await self._drain_task
+
+        if returncode:
+            tail = " | ".join(list(self.log)[-5:])
+            logger.warning(f"Process {self.name} exited with code {returncode}: {tail}")
+
+        return returncode
+
+    async def stop(self, timeout: float = None) -> int:
+        """
+        Корректно остановить ffmpeg, отправив ему q.
+        Если процесс не завершился за timeout секунд – убиваем
+
+        :param timeout: по умолчанию process_stop_timeout
+        """
+        if timeout is None:
+            timeout = config.process_stop_timeout
+
+        if self._proc.returncode is None:
+            try:
+                self._proc.stdin.write(b"q")
+                await self._proc.stdin.drain()
+                self._proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+            try:
+                await asyncio.wait_for(asyncio.shield(self._proc.wait()), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Process {self.name} did not stop in time, killing")
+                self._proc.kill()
+
+        return await self.wait()
@@ -0,0 +1,150 @@
+import heapq
+import itertools
+from datetime import date, datetime, time, timedelta
+
+from loguru import logger
+
+from autorecord.core.settings import config
+
+SCHEDULE_START = "start"
+SCHEDULE_STOP = "stop"
+
+
+def _parse_time(value) -> time:
+    return value if isinstance(value, time) else time.fromisoformat(value)
+
+
+def _parse_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+
+class Session:
+    """Одна запись комнаты по расписанию: занятие целиком или его часть"""
+
+    def __init__(self, room, start: datetime, end: datetime):
+        self.room = room
+        self.start = start
+        self.end = end
+        # Рекордер, который пишет сессию, появляется после её старта
+        self.recorder = None
+
+    @property
+    def key(self) -> tuple:
+        return self.room.id, self.start
+
+    def __str__(self):
+        return f"{self.room.name} {self.start:%Y-%m-%d %H:%M}-{self.end:%H:%M}"
+
+
+def room_sessions(room, day: date) -> list:
+    """
+    Сессии записи комнаты в день day по её расписанию
+
+    :param room: комната, у которой в schedule список словарей занятий
+    """
+    sessions = []
+    for lecture in getattr(room, "schedule", []):
+        lecture_date = _parse_date(lecture.get("date"))
+        if lecture_date is not None:
+            if lecture_date != day:
+                continue
+        elif lecture.get("day_of_week") != day.isoweekday():
+            continue
+
+        start = datetime.combine(day, _parse_time(lecture["start_time"]))
+        end = datetime.combine(day, _parse_time(lecture["end_time"]))
+        if end <= start:
+            logger.warning(f"Skipping lecture {lecture} of {room.name}: ends before start")
+            continue
+
+        # Длинное занятие пишется частями по slot_duration минут
+        slot = lecture.get("slot_duration")
+        step = timedelta(minutes=slot) if slot else end - start
+        while start < end:
+            sessions.append(Session(room, start, min(start + step, end)))
+            start += step
+
+    return sessions
+
+
+class ScheduleEngine:
+    """
+    Очередь событий старта и остановки записей по расписанию комнат.
+    События хранятся в куче по времени, так что ближайшее событие
+    достаётся без перебора всего расписания
+    """
+
+    def __init__(self, horizon: int):
+        """
+        :param horizon: на сколько дней вперёд раскладывать расписание
+        """
+        self._horizon = horizon
+        self._events = []
+        self._counter = itertools.count()
+        # Идущие сейчас сессии: ключ сессии -> сессия
+        self._active = {}
+
+    def _push(self, at: datetime, action: str, session: Session) -> None:
+        # При бесшовной смене сначала стартует новая запись, потом останавливается
+        # старая, иначе на одной и той же минуте сначала останавливаем
+        if config.gapless_rotation:
+            order = 0 if action == SCHEDULE_START else 1
+        else:
+            order = 0 if action == SCHEDULE_STOP else 1
+        heapq.heappush(self._events, (at, order, next(self._counter), action, session))
+
+    def rebuild(self, rooms: list, now: datetime) -> None:
+        """
+        Пересобрать очередь по текущему расписанию комнат.
+        Идущие сессии дописываются до своего конца, даже если занятие убрали
+        """
+        self._events = []
+        for session in self._active.values():
+            self._push(self._stop_at(session), SCHEDULE_STOP, session)
+
+        sessions = 0
+        for room in rooms:
+            for offset in range(self._horizon):
+                for session in room_sessions(room, now.date() + timedelta(days=offset)):
+                    if session.end <= now or session.key in self._active:
+                        continue
+                    self._push(session.start, SCHEDULE_START, session)
+                    sessions += 1
+
+        logger.info(
+            f"Schedule rebuilt: {sessions} sessions planned, {len(self._active)} running"
+        )
+
+    @staticmethod
+    def _stop_at(session: Session) -> datetime:
+        if config.gapless_rotation:
+            return session.end + timedelta(seconds=config.rotation_overlap)
+        return session.end
+
+    @property
+    def next_event_at(self):
+        """Время ближайшего события или None, если событий нет"""
+        return self._events[0][0] if self._events else None
+
+    def pop_due(self, now: datetime) -> list:
+        """
+        Достать наступившие события
+
+        :return: список (действие, сессия) в порядке выполнения
+        """
+        due = []
+        while self._events and self._events[0][0] <= now:
+            _, _, _, action, session = heapq.heappop(self._events)
+            if action == SCHEDULE_START:
+                self._active[session.key] = session
+                self._push(self._stop_at(session), SCHEDULE_STOP, session)
+            else:
+                self._active.pop(session.key, None)
+            due.append((action, session))
+
+        return due
+
+
+SCHEDULE = ScheduleEngine(config.schedule_horizon)
@@ -1,5 +1,6 @@
 import sys
-from typing import Set
+import socket
+from typing import Set, List, Dict, Literal
 from pydantic import BaseSettings, Field
 
 from loguru import logger
@@ -10,12 +11,67 @@ class Settings(BaseSettings):
     google_drive_token_path: str = Field(..., env="GOOGLE_DRIVE_TOKEN_PATH")
     google_drive_scopes: Set[str] = Field(..., env="GOOGLE_DRIVE_SCOPES")
     google_semaphore: int = Field(15, env="GOOGLE_SEMAPHORE")
+    # Адрес Google API, меняется на локальную заглушку в бенчмарках
+    google_api_url: str = Field("https://www.googleapis.com", env="GOOGLE_API_URL")
+    # За сколько секунд до истечения токена гугла обновлять его заранее
+    google_token_renew_margin: int = Field(300, env="GOOGLE_TOKEN_RENEW_MARGIN")
+    # Сколько секунд копить мелкие запросы к Drive API перед отправкой пачкой
+    google_batch_window: float = Field(0.5, env="GOOGLE_BATCH_WINDOW")
+    # Размер части при загрузке на диск в MB: начальный, минимальный и максимальный
+    upload_chunk_size: int = Field(16, env="UPLOAD_CHUNK_SIZE")
+    upload_chunk_min_size: int = Field(4, env="UPLOAD_CHUNK_MIN_SIZE")
+    upload_chunk_max_size: int = Field(32, env="UPLOAD_CHUNK_MAX_SIZE")
+    # Сколько секунд в среднем должна занимать отправка одной части
+    upload_chunk_target_time: int = Field(10, env="UPLOAD_CHUNK_TARGET_TIME")
     upload_without_sound: bool = Field(False, env="UPLOAD_WITHOUT_SOUND")
+    # Общее ограничение полосы загрузки на диск в Mbit/s, 0 – без ограничений
+    upload_bandwidth: float = Field(0, env="UPLOAD_BANDWIDTH")
+    # Ограничение по времени суток: час начала -> Mbit/s, например {"0": 400, "8": 100}.
+    # Действует до следующего часа профиля и заменяет upload_bandwidth
+    upload_bandwidth_profile: Dict[int, float] = Field(
+        {}, env="UPLOAD_BANDWIDTH_PROFILE"
+    )
+    # Пропускная способность канала в Mbit/s, общего с камерами. Если задана,
+    # загрузкам достаётся только то, что не занято записью с камер
+    link_bandwidth: float = Field(0, env="LINK_BANDWIDTH")
+    # Запас сверх текущего потока с камер, доля от него
+    ingest_headroom: float = Field(0.2, env="INGEST_HEADROOM")
+    # Меньше этого в Mbit/s загрузки не получают, даже если камеры заняли весь канал
+    upload_bandwidth_min: float = Field(1, env="UPLOAD_BANDWIDTH_MIN")
+    # Число одновременных загрузок подстраивается под сеть
+    # от upload_concurrency_min до google_semaphore. Воркеров этапа загрузки
+    # столько же, сколько google_semaphore, так что других ограничений нет
+    upload_concurrency_min: int = Field(1, env="UPLOAD_CONCURRENCY_MIN")
+    # Загружать записи на диск по ходу записи, только в режиме muxed:
+    # файл пишется фрагментами, и готовые части отправляются, пока идёт запись
+    live_upload: bool = Field(False, env="LIVE_UPLOAD")
+    # Как часто в секундах проверять, дописались ли новые части
+    live_upload_interval: int = Field(10, env="LIVE_UPLOAD_INTERVAL")
+    # Сколько MB должно накопиться, чтобы отправить часть
+    live_upload_min_chunk: int = Field(8, env="LIVE_UPLOAD_MIN_CHUNK")
 
     psql_url: str = Field(..., env="PSQL_URL")
+    psql_pool_min_size: int = Field(1, env="PSQL_POOL_MIN_SIZE")
+    psql_pool_max_size: int = Field(5, env="PSQL_POOL_MAX_SIZE")
+    rooms_cache_ttl: int = Field(900, env="ROOMS_CACHE_TTL")
+    rooms_refresh_interval: int = Field(300, env="ROOMS_REFRESH_INTERVAL")
+
+    # Распределение комнат между несколькими узлами autorecord
+    shard_enabled: bool = Field(False, env="SHARD_ENABLED")
+    node_id: str = Field(default_factory=socket.gethostname, env="NODE_ID")
+    shard_heartbeat_interval: int = Field(30, env="SHARD_HEARTBEAT_INTERVAL")
+    # Через сколько секунд без heartbeat узел считается упавшим
+    shard_node_ttl: int = Field(90, env="SHARD_NODE_TTL")
 
     nvr_api_url: str = Field(..., env="NVR_API_URL")
     nvr_api_key: str = Field(..., env="NVR_API_KEY")
+    nvr_api_connections: int = Field(10, env="NVR_API_CONNECTIONS")
+    nvr_api_keepalive: int = Field(60, env="NVR_API_KEEPALIVE")
+    nvr_api_timeout: int = Field(30, env="NVR_API_TIMEOUT")
+    nvr_api_retries: int = Field(3, env="NVR_API_RETRIES")
+    nvr_api_retry_delay: float = Field(1, env="NVR_API_RETRY_DELAY")
+    # Сколько секунд копить записи перед отправкой в эрудит пачкой, 0 – сразу
+    nvr_batch_window: float = Field(0.5, env="NVR_BATCH_WINDOW")
 
     record_days: Set[str] = Field(
         {
@@ -35,6 +91,122 @@ class Settings(BaseSettings):
     record_start: int = Field(9, env="RECORD_START")
     record_end: int = Field(21, env="RECORD_END")
     records_folder: str = Field("/records", env="RECORDS_FOLDER")
+    # Записывать комнаты по расписанию занятий из бд, а не все комнаты каждый слот
+    schedule_enabled: bool = Field(False, env="SCHEDULE_ENABLED")
+    # На сколько дней вперёд раскладывать расписание в очередь событий
+    schedule_horizon: int = Field(2, env="SCHEDULE_HORIZON")
+    # separate – звук и видео пишутся отдельно и сводятся после записи,
+    # muxed – видео сразу пишется со звуком комнаты, сведение не нужно
+    record_mode: Literal["separate", "muxed"] = Field("separate", env="RECORD_MODE")
+    # Накладывать звук на все источники комнаты одним процессом ffmpeg
+    shared_audio_map: bool = Field(True, env="SHARED_AUDIO_MAP")
+    # Бесшовная смена слота: новая запись стартует до остановки старой
+    gapless_rotation: bool = Field(False, env="GAPLESS_ROTATION")
+    # Сколько секунд старая и новая записи пишутся одновременно
+    rotation_overlap: int = Field(10, env="ROTATION_OVERLAP")
+    # Сколько процессов ffmpeg можно запускать в секунду, 0 – без ограничений
+    record_spawn_rate: float = Field(0, env="RECORD_SPAWN_RATE")
+
+    # Анализ записей перед обработкой: пустые записи не сводятся и не загружаются
+    analysis_enabled: bool = Field(False, env="ANALYSIS_ENABLED")
+    # Тише какого уровня в dB звук считается тишиной и сколько секунд она должна длиться
+    analysis_silence_noise: int = Field(-50, env="ANALYSIS_SILENCE_NOISE")
+    analysis_silence_duration: float = Field(2, env="ANALYSIS_SILENCE_DURATION")
+    # Запись пустая, если звук есть меньше этой доли времени...
+    analysis_min_audio_activity: float = Field(0.05, env="ANALYSIS_MIN_AUDIO_ACTIVITY")
+    # ...и картинка почти всё время чёрная или меняется реже, чем раз в минуту
+    analysis_scene_threshold: float = Field(0.1, env="ANALYSIS_SCENE_THRESHOLD")
+    analysis_min_scene_changes: float = Field(1, env="ANALYSIS_MIN_SCENE_CHANGES")
+    analysis_max_black_ratio: float = Field(0.95, env="ANALYSIS_MAX_BLACK_RATIO")
+
+    # Лёгкие версии записи для просмотра: прокси низкого битрейта и лист миниатюр
+    preview_enabled: bool = Field(False, env="PREVIEW_ENABLED")
+    # Высота прокси в пикселях и битрейт видео в kbit/s
+    preview_height: int = Field(360, env="PREVIEW_HEIGHT")
+    preview_bitrate: int = Field(500, env="PREVIEW_BITRATE")
+    # Потоков на одно кодирование и приоритет процессов для nice,
+    # чтобы кодирование не отнимало процессор у записи
+    preview_threads: int = Field(2, env="PREVIEW_THREADS")
+    preview_nice: int = Field(10, env="PREVIEW_NICE")
+    # Ширина миниатюры в пикселях и сетка листа миниатюр
+    sprite_width: int = Field(160, env="SPRITE_WIDTH")
+    sprite_columns: int = Field(10, env="SPRITE_COLUMNS")
+    sprite_rows: int = Field(10, env="SPRITE_ROWS")
+
+    # Общая картинка всех камер комнаты со звуком комнаты одним кодированием:
+    # off – нет, grid – сетка, pip – первая камера на весь кадр, остальные поверх
+    composite_mode: Literal["off", "grid", "pip"] = Field("off", env="COMPOSITE_MODE")
+    # Загружать и публиковать только общую картинку, без записей отдельных камер
+    composite_only: bool = Field(False, env="COMPOSITE_ONLY")
+    composite_width: int = Field(1920, env="COMPOSITE_WIDTH")
+    composite_height: int = Field(1080, env="COMPOSITE_HEIGHT")
+    # Битрейт общей картинки в kbit/s
+    composite_bitrate: int = Field(4000, env="COMPOSITE_BITRATE")
+    # Потоков на одно кодирование и приоритет процессов для nice
+    composite_threads: int = Field(4, env="COMPOSITE_THREADS")
+    composite_nice: int = Field(10, env="COMPOSITE_NICE")
+
+    # Размеры пулов воркеров этапов обработки записей
+    analysis_workers: int = Field(2, env="ANALYSIS_WORKERS")
+    map_workers: int = Field(4, env="MAP_WORKERS")
+    preview_workers: int = Field(1, env="PREVIEW_WORKERS")
+    # Сколько общих картинок комнат кодируется одновременно
+    composite_workers: int = Field(1, env="COMPOSITE_WORKERS")
+    publish_workers: int = Field(4, env="PUBLISH_WORKERS")
+    clean_workers: int = Field(2, env="CLEAN_WORKERS")
+    pipeline_queue_size: int = Field(100, env="PIPELINE_QUEUE_SIZE")
+
+    # Наблюдение за потоками записи и их перезапуск внутри слота
+    watchdog_enabled: bool = Field(True, env="WATCHDOG_ENABLED")
+    watchdog_interval: int = Field(5, env="WATCHDOG_INTERVAL")
+    # Через сколько секунд без роста файла поток считается зависшим
+    watchdog_stall_timeout: int = Field(20, env="WATCHDOG_STALL_TIMEOUT")
+    watchdog_min_speed: float = Field(0.5, env="WATCHDOG_MIN_SPEED")
+    # Задержка между перезапусками одного потока растёт от min до max секунд
+    watchdog_backoff_min: int = Field(2, env="WATCHDOG_BACKOFF_MIN")
+    watchdog_backoff_max: int = Field(60, env="WATCHDOG_BACKOFF_MAX")
+    # Сколько секунд при перезапуске ждать выхода зависшего ffmpeg, потом убиваем
+    watchdog_kill_timeout: int = Field(3, env="WATCHDOG_KILL_TIMEOUT")
+
+    # Сколько последних строк лога ffmpeg хранить в памяти
+    process_log_lines: int = Field(50, env="PROCESS_LOG_LINES")
+    process_stop_timeout: int = Field(30, env="PROCESS_STOP_TIMEOUT")
+
+    # Сколько GB на диске с записями всегда оставлять свободными
+    storage_reserve: float = Field(5, env="STORAGE_RESERVE")
+    # Битрейт потока в кбит/с, пока его настоящий битрейт ещё не измерен
+    storage_default_bitrate: int = Field(4096, env="STORAGE_DEFAULT_BITRATE")
+    # Что делать по порядку, если записи слота не помещаются на диск:
+    # evict – удалить самые старые уже загруженные файлы
+    # (только при keep_uploaded_files, иначе они удаляются сразу),
+    # pause_remux – приостановить наложение звука,
+    # degrade – писать меньше камер в комнатах. Камеры пропадают из записи,
+    # поэтому degrade включается только явно
+    storage_policies: List[Literal["evict", "pause_remux", "degrade"]] = Field(
+        ["evict", "pause_remux"], env="STORAGE_POLICIES"
+    )
+    # Сколько камер оставлять в комнате при degrade
+    storage_degrade_sources: int = Field(1, env="STORAGE_DEGRADE_SOURCES")
+    storage_check_interval: int = Field(30, env="STORAGE_CHECK_INTERVAL")
+    # Не удалять загруженные файлы сразу, а держать до нехватки места
+    keep_uploaded_files: bool = Field(False, env="KEEP_UPLOADED_FILES")
+    # Через сколько секунд брошенные после падения куски записей удаляются
+    storage_orphan_age: int = Field(86400, env="STORAGE_ORPHAN_AGE")
+
+    # Http сервер с метриками prometheus, 0 – не запускать.
+    # Сервис работает в сети хоста, поэтому по умолчанию слушаем только localhost
+    metrics_host: str = Field("127.0.0.1", env="METRICS_HOST")
+    metrics_port: int = Field(0, env="METRICS_PORT")
+
+    # Трассировка обработки каждой записи: спаны в формате OTLP JSON
+    tracing_enabled: bool = Field(False, env="TRACING_ENABLED")
+    # Куда дописывать спаны, по умолчанию – .traces.jsonl рядом с записями
+    tracing_file: str = Field("", env="TRACING_FILE")
+    # Адрес OTLP/HTTP коллектора, например http://localhost:4318/v1/traces,
+    # пустой – спаны пишутся только в файл
+    tracing_endpoint: str = Field("", env="TRACING_ENDPOINT")
+    # Как часто в секундах выгружать накопленные спаны
+    tracing_flush_interval: int = Field(5, env="TRACING_FLUSH_INTERVAL")
 
     loguru_level: str = Field("DEBUG", env="LOGURU_LEVEL")
 
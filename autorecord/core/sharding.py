@@ -0,0 +1,47 @@
+import hashlib
+
+from loguru import logger
+
+from autorecord.core.db import heartbeat_node, get_alive_nodes
+from autorecord.core.settings import config
+
+
+class ShardManager:
+    """
+    Распределение комнат между несколькими узлами autorecord.
+    Узлы отмечаются в бд heartbeat`ом, каждая комната достаётся узлу
+    с наибольшим хэшем (id узла, id комнаты) среди живых (rendezvous hashing).
+    Если узел пропал, его комнаты расходятся по остальным, а остальные комнаты
+    остаются на своих местах
+    """
+
+    def __init__(self, node_id: str, ttl: int):
+        """
+        :param node_id: id этого узла
+        :param ttl: сколько секунд узел считается живым после heartbeat
+        """
+        self.node_id = node_id
+        self._ttl = ttl
+        self._nodes = [node_id]
+
+    async def heartbeat(self) -> None:
+        """Отметиться в бд и обновить список живых узлов"""
+        await heartbeat_node(self.node_id)
+        nodes = sorted(set(await get_alive_nodes(self._ttl)) | {self.node_id})
+
+        if nodes != self._nodes:
+            logger.info(f"Autorecord nodes changed: {self._nodes} -> {nodes}")
+        self._nodes = nodes
+
+    @staticmethod
+    def _weight(node_id: str, room_id) -> int:
+        digest = hashlib.md5(f"{node_id}:{room_id}".encode()).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def owns(self, room) -> bool:
+        """Записывает ли этот узел комнату"""
+        owner = max(self._nodes, key=lambda node_id: self._weight(node_id, room.id))
+        return owner == self.node_id
+
+
+SHARD = ShardManager(config.node_id, config.shard_node_ttl)
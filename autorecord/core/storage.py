@@ -0,0 +1,187 @@
+import os
+import re
+import time
+import shutil
+
+from loguru import logger
+
+from autorecord.core.journal import UPLOAD_JOURNAL, UPLOADED_FILES
+from autorecord.core.utils import remove_file
+from autorecord.core.settings import config
+
+STORAGE_POLICY_EVICT = "evict"
+STORAGE_POLICY_PAUSE_REMUX = "pause_remux"
+STORAGE_POLICY_DEGRADE = "degrade"
+
+# Исходное видео камеры: vid_{дата и время}_{id комнаты}_{id источника}.mp4
+VIDEO_FILE_RE = re.compile(
+    r"^vid_(?P<record_dt>\d{4}-\d{2}-\d{2}T\d{2}:\d{2})_(?P<room_id>[^_]+)_(?P<source_id>[^_.]+)\.mp4$"
+)
+# Звук комнаты: sound_{дата и время}_{id комнаты}.aac
+SOUND_FILE_RE = re.compile(
+    r"^sound_(?P<record_dt>\d{4}-\d{2}-\d{2}T\d{2}:\d{2})_(?P<room_id>[^_.]+)\.aac$"
+)
+# Служебные файлы: куски записи после перезапусков потока, их склейка,
+# превью и общая картинка комнаты
+PIECE_FILE_RE = re.compile(
+    r"\.part\d+\.\w+$|\.list$|\.joined$"
+    r"|\.proxy\.mp4$|\.sprite\.jpg$|\.composite\.mp4$"
+)
+
+# Насколько новое измерение битрейта потока сдвигает среднее
+RATE_SMOOTHING = 0.3
+
+
+class StorageManager:
+    """
+    Учёт места на диске с записями.
+    По скорости записи потоков прогнозирует, сколько ещё будет записано,
+    и освобождает место, удаляя самые старые уже загруженные файлы
+    """
+
+    def __init__(self, folder: str, reserve: int):
+        """
+        :param folder: папка с записями
+        :param reserve: сколько байт на диске всегда оставлять свободными
+        """
+        self._folder = folder
+        self._reserve = reserve
+        # Ключ потока -> байт в секунду. Ключ не зависит от слота,
+        # поэтому битрейт камеры известен заранее для следующих слотов
+        self._rates = {}
+
+    def free_bytes(self) -> int:
+        """Сколько байт ещё можно записать, не трогая резерв"""
+        return shutil.disk_usage(self._folder).free - self._reserve
+
+    def observe(self, recorders) -> None:
+        """Обновить битрейты потоков по тому, сколько они уже записали"""
+        for recorder in recorders:
+            for stream in recorder.streams:
+                rate = stream.bytes_per_second
+                if not rate:
+                    continue
+
+                previous = self._rates.get(stream.key)
+                if previous is None:
+                    self._rates[stream.key] = rate
+                else:
+                    self._rates[stream.key] = previous + RATE_SMOOTHING * (
+                        rate - previous
+                    )
+
+    def stream_rate(self, key: str) -> float:
+        """Байт в секунду, которые пишет поток"""
+        return self._rates.get(key, config.storage_default_bitrate * 1024 / 8)
+
+    def forecast(self, recorders, seconds: float, remux: bool = True) -> int:
+        """
+        Сколько байт запишут рекордеры за seconds секунд
+
+        :param remux: учитывать ли файлы, которые появятся при наложении звука
+        """
+        total = 0
+        for recorder in recorders:
+            keys = recorder.stream_keys
+            total += sum(self.stream_rate(key) for key in keys) * seconds
+
+            sound_keys = [key for key in keys if key.startswith("sound_")]
+            if remux and sound_keys:
+                # Каждый итоговый файл – копия видео источника и звука комнаты
+                video_keys = [key for key in keys if key not in sound_keys]
+                sound_rate = self.stream_rate(sound_keys[0])
+                total += sum(
+                    self.stream_rate(key) + sound_rate for key in video_keys
+                ) * seconds
+
+        return int(total)
+
+    def pending_remux_bytes(self) -> int:
+        """Сколько байт займут итоговые файлы ещё не сведённых записей"""
+        total = 0
+        for entry in os.scandir(self._folder):
+            match = VIDEO_FILE_RE.match(entry.name)
+            if not match:
+                continue
+
+            record_name = f"{match['record_dt']}_{match['room_id']}"
+            result_path = f"{self._folder}/{record_name}_{match['source_id']}.mp4"
+            if os.path.exists(result_path):
+                continue
+
+            total += entry.stat().st_size
+            try:
+                total += os.path.getsize(f"{self._folder}/sound_{record_name}.aac")
+            except OSError:
+                pass
+
+        return total
+
+    def evict(self, needed: int) -> int:
+        """
+        Удалить самые старые уже загруженные файлы, пока не освободится needed байт
+
+        :return: сколько байт освобождено
+        """
+        freed = 0
+        for file_path in UPLOADED_FILES.oldest():
+            if freed >= needed:
+                break
+
+            try:
+                freed += os.path.getsize(file_path)
+            except OSError:
+                pass
+            remove_file(file_path)
+            UPLOADED_FILES.remove(file_path)
+
+        if freed:
+            logger.info(f"Evicted {freed} bytes of uploaded records")
+        return freed
+
+    def reconcile(self, active_paths: set) -> None:
+        """
+        Убрать с диска то, что осталось после падения:
+        служебные файлы склейки, звук без видео и записи журналов без файлов
+
+        :param active_paths: пути файлов, которые сейчас пишутся
+        """
+        now = time.time()
+        names = set(os.listdir(self._folder))
+
+        for name in names:
+            path = f"{self._folder}/{name}"
+            if path in active_paths or name.startswith("."):
+                continue
+
+            if PIECE_FILE_RE.search(name):
+                if now - os.path.getmtime(path) > config.storage_orphan_age:
+                    logger.warning(f"Removing orphaned record piece {name}")
+                    remove_file(path)
+                continue
+
+            match = SOUND_FILE_RE.match(name)
+            if match:
+                record_name = f"{match['record_dt']}_{match['room_id']}"
+                has_video = any(
+                    other.startswith(f"vid_{record_name}_")
+                    or other.startswith(f"{record_name}_")
+                    for other in names
+                )
+                if not has_video and now - os.path.getmtime(path) > config.storage_orphan_age:
+                    logger.warning(f"Removing orphaned sound {name}")
+                    remove_file(path)
+
+        for entry in UPLOAD_JOURNAL.all():
+            if not os.path.exists(entry["file_path"]):
+                logger.info(f"Forgetting upload of missing file {entry['file_path']}")
+                UPLOAD_JOURNAL.remove(entry["file_path"])
+
+        for file_path in UPLOADED_FILES.oldest():
+            if not os.path.exists(file_path):
+                UPLOADED_FILES.remove(file_path)
+
+
+STORAGE = StorageManager(
+    config.records_folder, int(config.storage_reserve * 1024 ** 3)
+)
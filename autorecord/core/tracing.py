@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import hashlib
+from contextlib import contextmanager
+
+from aiohttp import ClientSession
+from loguru import logger
+
+from autorecord.core.settings import config
+
+TRACES_PATH = config.tracing_file or f"{config.records_folder}/.traces.jsonl"
+
+# Коды статуса спана OTLP
+STATUS_OK = 1
+STATUS_ERROR = 2
+# Вид спана OTLP: внутренняя операция сервиса
+SPAN_KIND_INTERNAL = 1
+
+
+def trace_id(record_name: str, source_id) -> str:
+    """
+    id трассы источника записи. Считается из имени записи и id источника,
+    поэтому одинаков у всех частей сервиса и после перезапуска
+    """
+    digest = hashlib.sha256(f"{record_name}_{source_id}".encode()).hexdigest()
+    return digest[:32]
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Span:
+    """
+    Одна операция над записью. Если операция касается нескольких источников,
+    например общий процесс звука комнаты, спан попадает в трассу каждого
+    """
+
+    def __init__(
+        self, tracer, name: str, traces: list, attributes: dict, start_ns: int = None
+    ):
+        """
+        :param traces: ключи трасс (имя записи, id источника)
+        :param start_ns: время начала, если операция началась раньше создания спана
+        """
+        self._tracer = tracer
+        self.name = name
+        self.traces = traces
+        self.attributes = attributes
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: str = None) -> None:
+        if self.end_ns is not None:
+            return
+
+        self.end_ns = time.time_ns()
+        self.error = error
+        self._tracer.finish(self)
+
+    def to_otlp(self) -> list:
+        """Спан в формате OTLP JSON, по одному на каждую трассу"""
+        attributes = [
+            _attribute(key, value)
+            for key, value in self.attributes.items()
+            if value is not None
+        ]
+        status = {"code": STATUS_OK}
+        if self.error is not None:
+            status = {"code": STATUS_ERROR, "message": self.error}
+
+        spans = []
+        for record_name, source_id in self.traces:
+            spans.append(
+                {
+                    "traceId": trace_id(record_name, source_id),
+                    "spanId": os.urandom(8).hex(),
+                    "name": self.name,
+                    "kind": SPAN_KIND_INTERNAL,
+                    "startTimeUnixNano": str(self.start_ns),
+                    "endTimeUnixNano": str(self.end_ns),
+                    "attributes": [
+                        _attribute("record.name", record_name),
+                        _attribute("source.id", str(source_id)),
+                        *attributes,
+                    ],
+                    "status": status,
+                }
+            )
+        return spans
+
+
+class _NoopSpan:
+    """Спан выключенной трассировки: ничего не хранит и не выгружает"""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def end(self, error: str = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Собирает спаны всех записей и периодически дописывает их в файл
+    строками OTLP JSON (ExportTraceServiceRequest) и, если задан, отправляет
+    в OTLP/HTTP коллектор
+    """
+
+    def __init__(self, enabled: bool, path: str, endpoint: str = ""):
+        self.enabled = enabled
+        self._path = path
+        self._endpoint = endpoint
+        self._finished = []
+        self._session = None
+        self._resource = {
+            "attributes": [
+                _attribute("service.name", "autorecord"),
+                _attribute("host.name", socket.gethostname()),
+            ]
+        }
+
+    def start_span(self, name: str, traces: list, start_ns: int = None, **attributes):
+        """
+        Начать спан. Закончить его нужно вызовом end()
+
+        :param traces: ключи трасс (имя записи, id источника)
+        :param start_ns: время начала в наносекундах, по умолчанию – сейчас
+        """
+        if not self.enabled or not traces:
+            return NOOP_SPAN
+        return Span(self, name, list(traces), attributes, start_ns)
+
+    @contextmanager
+    def span(self, name: str, traces: list, **attributes):
+        """Спан на время блока. Исключение внутри блока отмечается ошибкой спана"""
+        span = self.start_span(name, traces, **attributes)
+        try:
+            yield span
+        except BaseException as err:
+            span.end(error=repr(err))
+            raise
+        else:
+            span.end()
+
+    def finish(self, span: Span) -> None:
+        self._finished.append(span)
+
+    def _export_request(self, spans: list) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": self._resource,
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "autorecord"},
+                            "spans": [
+                                otlp_span
+                                for span in spans
+                                for otlp_span in span.to_otlp()
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _write(self, request: dict) -> None:
+        with open(self._path, "a") as traces_file:
+            traces_file.write(json.dumps(request) + "\n")
+
+    async def flush(self) -> None:
+        """Выгрузить накопленные спаны"""
+        if not self._finished:
+            return
+
+        spans, self._finished = self._finished, []
+        request = self._export_request(spans)
+
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write, request)
+        except OSError as err:
+            logger.warning(f"Failed to write traces to {self._path}: {err}")
+
+        if not self._endpoint:
+            return
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession()
+        try:
+            async with self._session.post(self._endpoint, json=request) as resp:
+                if resp.status >= 400:
+                    logger.warning(f"Trace collector responded {resp.status}")
+        except Exception as err:
+            logger.warning(f"Failed to send traces to {self._endpoint}: {err}")
+
+
+TRACER = Tracer(config.tracing_enabled, TRACES_PATH, config.tracing_endpoint)
+
+
+def _value(attribute: dict):
+    return next(iter(attribute["value"].values()))
+
+
+def read_spans(path: str, record_name: str) -> list:
+    """Спаны записи из файла трасс, упорядоченные по времени начала"""
+    spans = []
+    with open(path) as traces_file:
+        for line in traces_file:
+            request = json.loads(line)
+            for resource_spans in request["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    for span in scope_spans["spans"]:
+                        attributes = {a["key"]: _value(a) for a in span["attributes"]}
+                        if attributes.get("record.name") != record_name:
+                            continue
+                        spans.append(
+                            {
+                                "name": span["name"],
+                                "source": attributes.get("source.id"),
+                                "start": int(span["startTimeUnixNano"]) / 1e9,
+                                "end": int(span["endTimeUnixNano"]) / 1e9,
+                                "error": span["status"].get("message"),
+                                "attributes": attributes,
+                            }
+                        )
+    return sorted(spans, key=lambda span: span["start"])
+
+
+def main():
+    """
+    Хронология одной записи по файлу трасс и самый долгий её этап:
+    python -m autorecord.core.tracing <имя записи> [файл трасс]
+    """
+    if len(sys.argv) < 2:
+        print(main.__doc__)
+        sys.exit(1)
+
+    record_name = sys.argv[1]
+    spans = read_spans(sys.argv[2] if len(sys.argv) > 2 else TRACES_PATH, record_name)
+    if not spans:
+        print(f"No spans for {record_name}")
+        sys.exit(1)
+
+    started_at = spans[0]["start"]
+    for span in spans:
+        print(
+            f"{span['start'] - started_at:9.3f}s "
+            f"{span['end'] - span['start']:9.3f}s  "
+            f"source {span['source']:>6}  {span['name']}"
+            + (f"  ERROR {span['error']}" if span["error"] else "")
+        )
+
+    # Запись идёт весь слот, поэтому при поиске узкого места её не учитываем
+    stages = [span for span in spans if span["name"] != "stream.capture"]
+    slowest = max(stages or spans, key=lambda span: span["end"] - span["start"])
+    finished_at = max(span["end"] for span in spans)
+    print(
+        f"\nTotal {finished_at - started_at:.3f}s, slowest: {slowest['name']} "
+        f"of source {slowest['source']} {slowest['end'] - slowest['start']:.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
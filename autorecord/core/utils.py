@@ -1,27 +1,119 @@
 import os
+import time
 import asyncio
-from asyncio.subprocess import PIPE
 
 from loguru import logger
 
 from autorecord.core.models import Room
-from autorecord.core.db import get_rooms, get_room_sources
+from autorecord.core.db import get_rooms_with_sources
+from autorecord.core.process import SupervisedProcess
+from autorecord.core.sharding import SHARD
+from autorecord.core.settings import config
+
+
+class RoomCatalog:
+    """
+    Кэш комнат с источниками в памяти.
+    Обновляется фоново по расписанию, чтобы на границе слота
+    не приходилось ждать ответа бд
+    """
+
+    def __init__(self, ttl: int):
+        """
+        :param ttl: через сколько секунд кэш считается устаревшим
+        """
+        self._ttl = ttl
+        self._rooms = []
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+
+        return time.monotonic() - self._loaded_at > self._ttl
+
+    async def refresh(self) -> None:
+        """Перечитать комнаты и источники из бд одним запросом"""
+        async with self._lock:
+            self.load(await get_rooms_with_sources(config.schedule_enabled))
+
+        logger.debug(f"Room catalog refreshed, {len(self._rooms)} rooms loaded")
+
+    def load(self, room_dicts: list) -> None:
+        """
+        Заменить комнаты в кэше
+
+        :param room_dicts: словари комнат, в каждом ключ sources – список словарей источников
+            и, если записи идут по расписанию, ключ schedule – список словарей занятий
+        """
+        rooms = []
+        for room_dict in room_dicts:
+            room_dict = dict(room_dict)
+            sources = room_dict.pop("sources")
+            room = Room(room_dict)
+            room.sources = sources
+            rooms.append(room)
+
+        self._rooms = rooms
+        self._loaded_at = time.monotonic()
+
+    async def get_rooms(self) -> list:
+        """
+        Комнаты из кэша. Если кэш устарел – пробуем обновить,
+        при ошибке бд отдаём старые данные, если они есть
+        """
+        if self.is_stale:
+            try:
+                await self.refresh()
+            except Exception as err:
+                if not self._rooms:
+                    raise
+                logger.warning(f"Failed to refresh room catalog, using stale one: {err}")
+
+        return self._rooms
+
+
+ROOM_CATALOG = RoomCatalog(config.rooms_cache_ttl)
 
 
 async def load_rooms():
-    rooms = [Room(room_dict) for room_dict in await get_rooms()]
-    for room in rooms:
-        room.sources = await get_room_sources(room.id)
+    """Комнаты, которые записывает этот узел"""
+    for room in await ROOM_CATALOG.get_rooms():
+        if config.shard_enabled and not SHARD.owns(room):
+            continue
         yield room
 
 
-async def run_cmd(cmd: str or list):
+class RateLimiter:
+    """Ограничитель частоты действий: не больше rate штук в секунду"""
+
+    def __init__(self, rate: float):
+        """
+        :param rate: сколько действий разрешено в секунду, 0 – без ограничений
+        """
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_at = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self._interval:
+            return
+
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_at > now:
+                await asyncio.sleep(self._next_at - now)
+                now = self._next_at
+            self._next_at = now + self._interval
+
+
+async def run_cmd(cmd: str or list, name: str = None, on_line=None) -> SupervisedProcess:
     if isinstance(cmd, str):
         cmd = cmd.split(" ")
 
-    return await asyncio.create_subprocess_exec(
-        *cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE
-    )
+    return await SupervisedProcess.start(cmd, name, on_line)
 
 
 def remove_file(filename: str) -> None:
@@ -0,0 +1,4 @@
+"""
+Бенчмарки autorecord на локальных заглушках камер, гугл диска и эрудита.
+Запуск: python -m benchmarks --help
+"""
@@ -0,0 +1,65 @@
+import sys
+import json
+import asyncio
+import argparse
+
+from loguru import logger
+
+from benchmarks.scenario import run_scenario, find_regressions, save_report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Record rooms from fake cameras, upload records to a fake Drive "
+        "and publish them to a fake Erudite, then report resource usage",
+    )
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--sources", type=int, default=3, help="cameras per room")
+    parser.add_argument("--slot", type=int, default=1, help="slot length in minutes")
+    parser.add_argument("--slots", type=int, default=2, help="number of slots")
+    parser.add_argument("--mode", choices=("separate", "muxed"), default="separate")
+    parser.add_argument("--bitrate", type=int, default=4096, help="camera kbit/s")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds for cameras to come up")
+    parser.add_argument("--drive-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--drive-throughput", type=float, default=0, help="Mbit/s, 0 – unlimited"
+    )
+    parser.add_argument("--drive-error-rate", type=float, default=0)
+    parser.add_argument("--erudite-latency", type=float, default=0.05)
+    parser.add_argument("--erudite-error-rate", type=float, default=0)
+    parser.add_argument("--mediamtx", default="mediamtx", help="path to mediamtx binary")
+    parser.add_argument("--output", help="save the report to this json file")
+    parser.add_argument("--baseline", help="fail if the report regresses against this one")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep", action="store_true", help="keep records and logs")
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level=options.log_level)
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(run_scenario(options))
+
+    print(json.dumps(report, indent=2))
+    if options.output:
+        save_report(report, options.output)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = find_regressions(report, baseline, options.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import re
+import json
+import uuid
+import random
+import argparse
+import asyncio
+from urllib.parse import parse_qs
+
+from aiohttp import web
+from loguru import logger
+
+
+class FakeDrive:
+    """
+    Заглушка Google Drive API: загрузка файлов через канал передачи,
+    создание и поиск папок, выдача прав и batch endpoint.
+    Содержимое файлов не хранится, считаются только принятые байты
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        throughput: float = 0,
+        error_rate: float = 0,
+    ):
+        """
+        :param latency: задержка ответа на каждый запрос в секундах
+        :param throughput: скорость приёма загружаемых файлов в байтах в секунду,
+            общая на все загрузки, 0 – без ограничений
+        :param error_rate: доля запросов, на которые отвечаем 429
+        """
+        self.latency = latency
+        self.throughput = throughput
+        self.error_rate = error_rate
+
+        self._uploads = {}  # upload_id -> {"name", "received", "file_id"}
+        self._folders = {}  # id папки -> {"name", "parents"}
+        self._throttle_lock = asyncio.Lock()
+        self._base_url = None
+
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "batches": 0,
+            "bytes_received": 0,
+            "files_uploaded": 0,
+            "files_deleted": 0,
+            "folders_created": 0,
+        }
+
+    def app(self, base_url: str) -> web.Application:
+        """
+        :param base_url: адрес, по которому доступна заглушка, для ссылок на каналы передачи
+        """
+        self._base_url = base_url
+        app = web.Application(middlewares=[self._middleware], client_max_size=1024 ** 3)
+        app.router.add_post("/upload/drive/v3/files", self.create_upload)
+        app.router.add_put("/upload/drive/v3/files", self.upload_chunk)
+        app.router.add_post("/drive/v3/files", self.create_file)
+        app.router.add_get("/drive/v3/files", self.list_files)
+        app.router.add_post("/drive/v3/files/{file_id}/permissions", self.create_permission)
+        app.router.add_post("/batch/drive/v3", self.batch)
+        app.router.add_get("/_stats", self.get_stats)
+        return app
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        if request.path == "/_stats":
+            return await handler(request)
+
+        self.stats["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["throttled"] += 1
+            # Тело запроса всё равно вычитываем, иначе клиент может не дождаться ответа
+            await request.read()
+            return web.json_response(
+                {"error": {"code": 429, "message": "Rate Limit Exceeded"}}, status=429
+            )
+
+        return await handler(request)
+
+    async def _throttle(self, size: int) -> None:
+        """Принимаем данные не быстрее throughput байт в секунду на все загрузки"""
+        if not self.throughput:
+            return
+
+        async with self._throttle_lock:
+            await asyncio.sleep(size / self.throughput)
+
+    async def create_upload(self, request: web.Request) -> web.Response:
+        meta_data = await request.json()
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = {
+            "name": meta_data.get("name"),
+            "received": 0,
+            "file_id": None,
+        }
+        location = (
+            f"{self._base_url}/upload/drive/v3/files"
+            f"?uploadType=resumable&upload_id={upload_id}"
+        )
+        return web.Response(headers={"Location": location})
+
+    async def upload_chunk(self, request: web.Request) -> web.Response:
+        upload = self._uploads.get(request.query.get("upload_id"))
+        if upload is None:
+            await request.read()
+            return web.json_response({"error": {"code": 404}}, status=404)
+
+        match = re.match(
+            r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", request.headers.get("Content-Range", "")
+        )
+        if not match:
+            return web.json_response({"error": {"code": 400}}, status=400)
+        start, end, size = match.groups()
+        # Размер файла, который ещё пишется, неизвестен до последней части
+        size = None if size == "*" else int(size)
+
+        if start is not None:
+            data = await request.read()
+            await self._throttle(len(data))
+
+            # Принимаем только продолжение уже полученных данных
+            if int(start) == upload["received"]:
+                upload["received"] = int(end) + 1
+                self.stats["bytes_received"] += len(data)
+
+        if size is not None and upload["received"] >= size:
+            if upload["file_id"] is None:
+                upload["file_id"] = uuid.uuid4().hex
+                self.stats["files_uploaded"] += 1
+            return web.json_response({"id": upload["file_id"], "name": upload["name"]})
+
+        headers = {}
+        if upload["received"]:
+            headers["Range"] = f"bytes=0-{upload['received'] - 1}"
+        return web.Response(status=308, headers=headers)
+
+    def _create(self, body: dict) -> dict:
+        folder_id = uuid.uuid4().hex
+        self._folders[folder_id] = {
+            "name": body.get("name"),
+            "parents": body.get("parents", []),
+        }
+        self.stats["folders_created"] += 1
+        return {"id": folder_id, "name": body.get("name")}
+
+    def _list(self, query: str) -> dict:
+        name = re.search(r"name='([^']*)'", query)
+        parent = re.search(r"'([^']*)' in parents", query)
+        files = [
+            {"id": folder_id, **folder}
+            for folder_id, folder in self._folders.items()
+            if (name is None or folder["name"] == name.group(1))
+            and (parent is None or parent.group(1) in folder["parents"])
+        ]
+        return {"files": files}
+
+    async def create_file(self, request: web.Request) -> web.Response:
+        return web.json_response(self._create(await request.json()))
+
+    async def list_files(self, request: web.Request) -> web.Response:
+        return web.json_response(self._list(request.query.get("q", "")))
+
+    async def create_permission(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response({"id": "anyoneWithLink", "type": "anyone"})
+
+    def _dispatch(self, method: str, path: str, body: dict):
+        """Выполнить один запрос из пачки: (http статус, json ответа)"""
+        path, _, query = path.partition("?")
+        if method == "POST" and path == "/drive/v3/files":
+            return 200, self._create(body)
+        if method == "POST" and re.fullmatch(r"/drive/v3/files/[^/]+/permissions", path):
+            return 200, {"id": "anyoneWithLink", "type": "anyone"}
+        if method == "GET" and path == "/drive/v3/files":
+            return 200, self._list(parse_qs(query).get("q", [""])[0])
+        if method == "DELETE" and re.fullmatch(r"/drive/v3/files/[^/]+", path):
+            self.stats["files_deleted"] += 1
+            return 204, {}
+        return 404, {"error": {"code": 404, "message": f"Unknown {method} {path}"}}
+
+    async def batch(self, request: web.Request) -> web.Response:
+        self.stats["batches"] += 1
+        boundary = re.search(
+            r'boundary="?([^";]+)"?', request.headers.get("Content-Type", "")
+        ).group(1)
+        text = (await request.text()).replace("\r\n", "\n")
+
+        responses = []
+        for part in text.split(f"--{boundary}"):
+            part = part.strip()
+            if not part or part == "--":
+                continue
+
+            part_headers, _, http_request = part.partition("\n\n")
+            content_id = re.search(r"Content-ID:\s*<item(\d+)>", part_headers, re.I)
+            request_line, _, rest = http_request.partition("\n")
+            _, _, body = rest.partition("\n\n")
+            method, path = request_line.split(" ")[:2]
+
+            status, response = self._dispatch(
+                method, path, json.loads(body) if body.strip() else {}
+            )
+            responses.append(
+                f"--batch_response\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-item{content_id.group(1)}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(response)}\r\n"
+            )
+        responses.append("--batch_response--\r\n")
+
+        return web.Response(
+            text="".join(responses),
+            headers={"Content-Type": "multipart/mixed; boundary=batch_response"},
+        )
+
+
+async def start_fake_drive(host: str, port: int, **options) -> tuple:
+    """
+    Запустить заглушку гугл диска в текущем event loop
+
+    :param options: параметры FakeDrive
+    :return: (заглушка, её http сервер)
+    """
+    drive = FakeDrive(**options)
+    runner = web.AppRunner(drive.app(f"http://{host}:{port}"))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    logger.info(f"Fake Drive API is listening on http://{host}:{port}")
+    return drive, runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Google Drive API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--throughput", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        start_fake_drive(
+            args.host,
+            args.port,
+            latency=args.latency,
+            throughput=args.throughput,
+            error_rate=args.error_rate,
+        )
+    )
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import random
+import argparse
+import asyncio
+
+from aiohttp import web
+from loguru import logger
+
+
+class FakeErudite:
+    """Заглушка NVR API эрудита, принимающая опубликованные записи"""
+
+    def __init__(self, latency: float = 0, error_rate: float = 0):
+        """
+        :param latency: задержка ответа на каждый запрос в секундах
+        :param error_rate: доля запросов, на которые отвечаем 503
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.records = []
+
+        self.stats = {"requests": 0, "failed": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/erudite/records", self.create_record)
+        app.router.add_get("/_stats", self.get_stats)
+        return app
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "records": len(self.records)})
+
+    async def create_record(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        record = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["failed"] += 1
+            return web.json_response({"error": "Service Unavailable"}, status=503)
+
+        self.records.append(record)
+        return web.json_response({"id": len(self.records), **record}, status=201)
+
+
+async def start_fake_erudite(host: str, port: int, **options) -> tuple:
+    """
+    Запустить заглушку эрудита в текущем event loop
+
+    :param options: параметры FakeErudite
+    :return: (заглушка, её http сервер)
+    """
+    erudite = FakeErudite(**options)
+    runner = web.AppRunner(erudite.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    logger.info(f"Fake NVR API is listening on http://{host}:{port}")
+    return erudite, runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake NVR API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        start_fake_erudite(
+            args.host, args.port, latency=args.latency, error_rate=args.error_rate
+        )
+    )
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import asyncio
+from asyncio.subprocess import DEVNULL
+
+from loguru import logger
+
+from benchmarks.utils import wait_listening
+
+# Конфиг mediamtx: только rtsp по tcp, публиковать и читать можно любой путь
+MEDIAMTX_CONFIG_TEMPLATE = """\
+logLevel: warn
+rtspAddress: :{port}
+rtspTransports: [tcp]
+rtmp: no
+hls: no
+webrtc: no
+srt: no
+paths:
+  all_others:
+"""
+
+# Тестовый ролик, который крутится по кругу во всех потоках.
+# Кодируется один раз, чтобы камеры-заглушки не нагружали процессор
+# и не искажали результаты бенчмарка
+FFMPEG_CLIP_CMD_TEMPLATE = (
+    "ffmpeg -hide_banner -loglevel error -y "
+    "-f lavfi -i testsrc2=size={resolution}:rate=25 "
+    "-f lavfi -i sine=frequency=440:sample_rate=48000 "
+    "-t {duration} -c:v libx264 -preset veryfast -g 50 -b:v {bitrate}k "
+    "-c:a aac -b:a 128k {output}"
+)
+
+# Публикация одной дорожки ролика в rtsp сервер
+FFMPEG_PUBLISH_CMD_TEMPLATE = (
+    "ffmpeg -hide_banner -loglevel error -re -stream_loop -1 -i {clip} "
+    "-map 0:{track} -c copy -f rtsp -rtsp_transport tcp {url}"
+)
+
+
+class FakeRtspServer:
+    """
+    Заглушка камер: rtsp сервер mediamtx, в который ffmpeg публикует
+    тестовый ролик – отдельно звук комнаты и видео каждой камеры
+    """
+
+    def __init__(
+        self,
+        workdir: str,
+        port: int = 8554,
+        bitrate: int = 4096,
+        resolution: str = "1920x1080",
+        mediamtx: str = "mediamtx",
+    ):
+        """
+        :param workdir: папка для конфига mediamtx и тестового ролика
+        :param port: порт rtsp сервера
+        :param bitrate: битрейт видео камер в кбит/с
+        :param resolution: разрешение видео камер
+        :param mediamtx: путь к исполняемому файлу mediamtx
+        """
+        self.port = port
+        self._workdir = workdir
+        self._bitrate = bitrate
+        self._resolution = resolution
+        self._mediamtx = mediamtx
+        self._clip_path = f"{workdir}/clip.mp4"
+        self._server = None
+        self._publishers = []
+
+    @property
+    def pids(self) -> set:
+        """pid процессов заглушки, чтобы не учитывать их в потреблении ресурсов"""
+        return {proc.pid for proc in self._publishers + [self._server] if proc}
+
+    def url(self, path: str) -> str:
+        return f"rtsp://127.0.0.1:{self.port}/{path}"
+
+    async def start(self) -> None:
+        for binary in (self._mediamtx, "ffmpeg"):
+            if shutil.which(binary) is None:
+                raise RuntimeError(f"{binary} is required for the fake rtsp server")
+
+        os.makedirs(self._workdir, exist_ok=True)
+        config_path = f"{self._workdir}/mediamtx.yml"
+        with open(config_path, "w") as config_file:
+            config_file.write(MEDIAMTX_CONFIG_TEMPLATE.format(port=self.port))
+
+        await self._make_clip()
+        self._server = await asyncio.create_subprocess_exec(
+            self._mediamtx, config_path, stdout=DEVNULL
+        )
+        await wait_listening("127.0.0.1", self.port)
+
+        logger.info(f"Fake rtsp server is listening on rtsp://127.0.0.1:{self.port}")
+
+    async def _make_clip(self) -> None:
+        if os.path.exists(self._clip_path):
+            return
+
+        proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_CLIP_CMD_TEMPLATE.format(
+                resolution=self._resolution,
+                duration=10,
+                bitrate=self._bitrate,
+                output=self._clip_path,
+            ).split(" ")
+        )
+        if await proc.wait():
+            raise RuntimeError("Failed to encode test clip")
+
+    async def publish(self, path: str, track: str) -> str:
+        """
+        Начать публикацию дорожки тестового ролика
+
+        :param path: путь потока на сервере
+        :param track: a – звук, v – видео
+        :return: rtsp адрес потока
+        """
+        url = self.url(path)
+        proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_PUBLISH_CMD_TEMPLATE.format(
+                clip=self._clip_path, track=track, url=url
+            ).split(" "),
+            stdin=DEVNULL,
+        )
+        self._publishers.append(proc)
+        return url
+
+    async def stop(self) -> None:
+        for proc in self._publishers + [self._server]:
+            if proc is not None and proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
+        self._publishers = []
+        self._server = None
@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import asyncio
+import tempfile
+from collections import deque
+
+from aiohttp import ClientSession
+from loguru import logger
+
+from benchmarks.fake_rtsp import FakeRtspServer
+from benchmarks.utils import free_port, wait_listening
+
+# Показатели отчёта, рост которых относительно базового отчёта считается регрессией
+REGRESSION_METRICS = (
+    ("start_skew", "max"),
+    ("slot_processing", "max"),
+    ("peak_rss_bytes",),
+    ("peak_fds",),
+    ("peak_disk_bytes",),
+)
+
+
+def _read_proc_status(pid) -> dict:
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        pass
+    return status
+
+
+def _rss(pid) -> int:
+    """RSS процесса в байтах"""
+    value = _read_proc_status(pid).get("VmRSS", "0 kB")
+    return int(value.split()[0]) * 1024
+
+
+def _children(pid: int) -> list:
+    """pid всех потомков процесса"""
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        ppid = _read_proc_status(name).get("PPid")
+        if ppid is not None:
+            parents.setdefault(int(ppid), []).append(int(name))
+
+    children, queue = [], [pid]
+    while queue:
+        for child in parents.get(queue.pop(), []):
+            children.append(child)
+            queue.append(child)
+    return children
+
+
+def _folder_size(folder: str) -> int:
+    """Размер записей в папке, без служебной базы autorecord"""
+    size = 0
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.startswith("."):
+            try:
+                size += entry.stat().st_size
+            except OSError:
+                pass
+    return size
+
+
+class ResourceSampler:
+    """
+    Периодически снимает потребление ресурсов autorecord:
+    память процесса и запущенных им ffmpeg, открытые файлы, место на диске
+    """
+
+    def __init__(self, records_folder: str, exclude_pids: set, interval: float = 0.5):
+        """
+        :param records_folder: папка с записями
+        :param exclude_pids: pid заглушек, которые тоже наши потомки, но не autorecord
+        :param interval: как часто снимать показатели в секундах
+        """
+        self._records_folder = records_folder
+        self._exclude_pids = exclude_pids
+        self._interval = interval
+        self._task = None
+
+        self.peak_rss = 0
+        self.peak_children_rss = 0
+        self.peak_children = 0
+        self.peak_fds = 0
+        self.peak_disk = 0
+
+    def sample(self) -> None:
+        pid = os.getpid()
+        children = [
+            child for child in _children(pid) if child not in self._exclude_pids
+        ]
+        own_rss = _rss(pid)
+        children_rss = sum(_rss(child) for child in children)
+
+        self.peak_rss = max(self.peak_rss, own_rss + children_rss)
+        self.peak_children_rss = max(self.peak_children_rss, children_rss)
+        self.peak_children = max(self.peak_children, len(children))
+        self.peak_fds = max(self.peak_fds, len(os.listdir("/proc/self/fd")))
+        self.peak_disk = max(self.peak_disk, _folder_size(self._records_folder))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await loop.run_in_executor(None, self.sample)
+            await asyncio.sleep(self._interval)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def _summary(values: list) -> dict:
+    if not values:
+        return {"avg": None, "max": None, "p95": None}
+
+    values = sorted(values)
+    return {
+        "avg": sum(values) / len(values),
+        "max": values[-1],
+        "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+    }
+
+
+async def _start_fake_service(module: str, port: int, *args) -> asyncio.subprocess.Process:
+    """Запустить заглушку http сервиса отдельным процессом, чтобы не мешать замерам"""
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", module, "--port", str(port), *map(str, args)
+    )
+    await wait_listening("127.0.0.1", port)
+    return proc
+
+
+async def _get_stats(port: int) -> dict:
+    async with ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/_stats") as resp:
+            return await resp.json()
+
+
+async def _sleep_until(loop, at: float) -> None:
+    delay = at - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def _configure(options, workdir: str, drive_port: int, erudite_port: int) -> None:
+    """
+    Настроить autorecord на заглушки через переменные окружения.
+    Вызывается до импорта autorecord, потому что настройки читаются при импорте
+    """
+    from google.oauth2.credentials import Credentials
+
+    token_path = f"{workdir}/token.pickle"
+    with open(token_path, "wb") as token:
+        pickle.dump(Credentials(token="benchmark"), token)
+
+    os.environ.update(
+        {
+            "RECORDS_FOLDER": f"{workdir}/records",
+            "GOOGLE_DRIVE_TOKEN_PATH": token_path,
+            "GOOGLE_DRIVE_SCOPES": '["https://www.googleapis.com/auth/drive"]',
+            "GOOGLE_API_URL": f"http://127.0.0.1:{drive_port}",
+            # Комнаты берутся не из бд, а задаются сценарием
+            "PSQL_URL": "postgres://benchmark@127.0.0.1:1/benchmark",
+            "ROOMS_CACHE_TTL": str(10 ** 9),
+            "ROOMS_REFRESH_INTERVAL": str(10 ** 9),
+            "SHARD_ENABLED": "false",
+            "NVR_API_URL": f"http://127.0.0.1:{erudite_port}",
+            "NVR_API_KEY": "benchmark",
+            "RECORD_MODE": options.mode,
+            "RECORD_DURATION": str(options.slot),
+            "METRICS_PORT": "0",
+            "LOGURU_LEVEL": options.log_level,
+        }
+    )
+    os.makedirs(f"{workdir}/records", exist_ok=True)
+
+
+async def run_scenario(options) -> dict:
+    """
+    Записать options.slots слотов по options.slot минут в options.rooms комнатах
+    по options.sources камер, обработать записи и собрать отчёт
+    """
+    loop = asyncio.get_event_loop()
+    workdir = tempfile.mkdtemp(prefix="autorecord_bench_")
+    drive_port, erudite_port = free_port(), free_port()
+
+    rtsp = FakeRtspServer(
+        f"{workdir}/rtsp",
+        port=free_port(),
+        bitrate=options.bitrate,
+        resolution=options.resolution,
+        mediamtx=options.mediamtx,
+    )
+    services = []
+    try:
+        services.append(
+            await _start_fake_service(
+                "benchmarks.fake_drive",
+                drive_port,
+                "--latency", options.drive_latency,
+                "--throughput", options.drive_throughput * 1024 * 1024 / 8,
+                "--error-rate", options.drive_error_rate,
+            )
+        )
+        services.append(
+            await _start_fake_service(
+                "benchmarks.fake_erudite",
+                erudite_port,
+                "--latency", options.erudite_latency,
+                "--error-rate", options.erudite_error_rate,
+            )
+        )
+        await rtsp.start()
+
+        rooms = []
+        for room_id in range(1, options.rooms + 1):
+            sources = [
+                {
+                    "id": room_id * 100 + source_index,
+                    "room_id": room_id,
+                    "ip": f"10.0.{room_id}.{source_index}",
+                    "rtsp": await rtsp.publish(f"{room_id}_{source_index}", "v"),
+                }
+                for source_index in range(1, options.sources + 1)
+            ]
+            rooms.append(
+                {
+                    "id": room_id,
+                    "name": f"benchmark-{room_id}",
+                    "sound_source": await rtsp.publish(f"sound_{room_id}", "a"),
+                    "drive": "https://drive.google.com/drive/folders/benchmark",
+                    "sources": sources,
+                }
+            )
+        # Даём публикациям подключиться к rtsp серверу
+        await asyncio.sleep(options.warmup)
+
+        _configure(options, workdir, drive_port, erudite_port)
+        from autorecord.app import Autorecord
+        from autorecord.core.settings import config
+        from autorecord.core.utils import ROOM_CATALOG
+        from autorecord.core.managers import Uploader, Publisher
+
+        ROOM_CATALOG.load(rooms)
+        autorec = Autorecord(loop)
+        # Слоты переключает сценарий, а не расписание
+        autorec._scheduler.shutdown(wait=False)
+
+        exclude_pids = rtsp.pids | {proc.pid for proc in services}
+        sampler = ResourceSampler(config.records_folder, exclude_pids)
+        sampler.start()
+
+        async def process_slot(recorders: deque) -> dict:
+            started_at = loop.time()
+            record_dt = recorders[0].record_dt
+            await asyncio.gather(
+                *[autorec.finish_record(recorder) for recorder in recorders]
+            )
+            return {
+                "record_dt": record_dt.isoformat(),
+                "recorders": len(recorders),
+                "processing_seconds": loop.time() - started_at,
+            }
+
+        # Как и по расписанию, слоты начинаются с начала минуты
+        slot_start = loop.time() + 60 - time.time() % 60
+        skews, processing = [], []
+        for slot_index in range(options.slots + 1):
+            await _sleep_until(loop, slot_start)
+            slot_start += options.slot * 60
+            last = slot_index == options.slots
+
+            previous, autorec._recorders = autorec._recorders, deque()
+            if previous and not config.gapless_rotation:
+                processing.append(asyncio.ensure_future(process_slot(previous)))
+
+            if not last:
+                await autorec.start_records()
+                skews += [
+                    recorder.start_skew
+                    for recorder in autorec._recorders
+                    if recorder.start_skew is not None
+                ]
+
+            if previous and config.gapless_rotation:
+                if not last:
+                    await asyncio.sleep(config.rotation_overlap)
+                processing.append(asyncio.ensure_future(process_slot(previous)))
+
+        slots = await asyncio.gather(*processing)
+        await sampler.stop()
+
+        report = {
+            "scenario": {
+                "rooms": options.rooms,
+                "sources": options.sources,
+                "slot_minutes": options.slot,
+                "slots": options.slots,
+                "mode": options.mode,
+                "bitrate_kbps": options.bitrate,
+                "drive_latency": options.drive_latency,
+                "drive_throughput_mbps": options.drive_throughput,
+                "drive_error_rate": options.drive_error_rate,
+            },
+            "start_skew": _summary(skews),
+            "slot_processing": _summary([slot["processing_seconds"] for slot in slots]),
+            "slots": slots,
+            "records": {
+                "expected": options.rooms * options.sources * options.slots,
+                "published": (await _get_stats(erudite_port))["records"],
+            },
+            "peak_rss_bytes": sampler.peak_rss,
+            "peak_ffmpeg_rss_bytes": sampler.peak_children_rss,
+            "peak_ffmpeg_processes": sampler.peak_children,
+            "peak_fds": sampler.peak_fds,
+            "peak_disk_bytes": sampler.peak_disk,
+            "final_disk_bytes": _folder_size(config.records_folder),
+            "drive": await _get_stats(drive_port),
+            "erudite": await _get_stats(erudite_port),
+        }
+
+        await autorec._pipeline.stop()
+        await Uploader.GDRIVE._client.close()
+        await Publisher.NVR_API.close()
+        return report
+    finally:
+        await rtsp.stop()
+        for proc in services:
+            proc.terminate()
+            await proc.wait()
+        if options.keep:
+            logger.info(f"Benchmark files are kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def find_regressions(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Сравнить отчёт с базовым
+
+    :param tolerance: допустимый относительный рост показателя, 0.2 – на 20%
+    :return: описания регрессий
+    """
+    regressions = []
+    for path in REGRESSION_METRICS:
+        current, previous = report, baseline
+        for key in path:
+            current = (current or {}).get(key)
+            previous = (previous or {}).get(key)
+
+        if current is None or not previous:
+            continue
+        if current > previous * (1 + tolerance):
+            regressions.append(f"{'.'.join(path)}: {previous} -> {current}")
+
+    records = report["records"]
+    if records["published"] < records["expected"]:
+        regressions.append(
+            f"published {records['published']} of {records['expected']} records"
+        )
+
+    return regressions
+
+
+def save_report(report: dict, path: str) -> None:
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
@@ -0,0 +1,25 @@
+import socket
+import asyncio
+
+
+def free_port() -> int:
+    """Свободный tcp порт на localhost"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_listening(host: str, port: int, timeout: float = 10) -> None:
+    """Дождаться, пока на порту начнут принимать подключения"""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if loop.time() > deadline:
+                raise RuntimeError(f"Nothing is listening on {host}:{port}")
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
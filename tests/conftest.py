@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Настройки читаются при импорте autorecord, поэтому обязательные задаём заранее
+os.environ.setdefault("GOOGLE_DRIVE_TOKEN_PATH", "/dev/null")
+os.environ.setdefault("GOOGLE_DRIVE_SCOPES", '["drive"]')
+os.environ.setdefault("PSQL_URL", "postgres://test@127.0.0.1:1/test")
+os.environ.setdefault("NVR_API_URL", "http://127.0.0.1:1")
+os.environ.setdefault("NVR_API_KEY", "test")
+os.environ.setdefault("RECORDS_FOLDER", tempfile.mkdtemp(prefix="autorecord_test_"))
@@ -0,0 +1,41 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from autorecord.core.pipeline import Pipeline, Job
+
+
+def _job(source_id: int) -> Job:
+    recorder = SimpleNamespace(record_name="record", record_dt=datetime(2020, 1, 1))
+    return Job(recorder, SimpleNamespace(id=source_id))
+
+
+def test_paused_stage_does_not_run_new_jobs():
+    async def scenario():
+        handled = []
+
+        async def handler(job):
+            handled.append(job.source.id)
+
+        pipeline = Pipeline()
+        pipeline.add_stage("map", handler, workers=4)
+        pipeline.start(asyncio.get_event_loop())
+        # Даём воркерам дойти до ожидания задач
+        await asyncio.sleep(0)
+
+        pipeline.pause("map")
+        jobs = [await pipeline.submit(_job(source_id)) for source_id in range(6)]
+        await asyncio.sleep(0.05)
+        assert handled == []
+        assert pipeline.is_paused("map")
+
+        pipeline.resume("map")
+        results = await asyncio.wait_for(
+            asyncio.gather(*[job.done for job in jobs]), 1
+        )
+        await pipeline.stop()
+
+        assert results == [True] * 6
+        assert sorted(handled) == list(range(6))
+
+    asyncio.run(scenario())